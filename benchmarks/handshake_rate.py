@@ -0,0 +1,77 @@
+"""
+Handshakes per second over loopback for RSA and X25519 key exchange.
+
+Every handshake is a new download: the client makes its keys, connects to
+server.handle_client, gets the AES key and the size of an empty file and
+disconnects.
+
+Usage:
+    uv run python -m benchmarks.handshake_rate [handshakes]
+"""
+
+import asyncio
+import contextlib
+import functools
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from zapfiles.client import ClientKeys, open_session
+from zapfiles.core.catalog import FileCatalog
+from zapfiles.core.protocol import KEY_EXCHANGE_RSA, KEY_EXCHANGE_X25519, ByteRange
+from zapfiles.server import handle_client
+
+
+async def run(file_path: Path, key_exchange: str, handshakes: int) -> float:
+    catalog = FileCatalog([file_path])
+    catalog.scan()
+
+    server = await asyncio.start_server(
+        functools.partial(handle_client, catalog=catalog), "127.0.0.1", 0
+    )
+    port = server.sockets[0].getsockname()[1]
+
+    async with server:
+        start = time.perf_counter()
+        for _ in range(handshakes):
+            session = await open_session(
+                "127.0.0.1", port, ClientKeys(key_exchange), ByteRange(0, 0), None
+            )
+            session.writer.close()
+            await session.writer.wait_closed()
+        return time.perf_counter() - start
+
+
+def main() -> None:
+    handshakes = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        file_path = Path(f.name)
+
+    try:
+        results = {}
+        for key_exchange in (KEY_EXCHANGE_RSA, KEY_EXCHANGE_X25519):
+            # Server prints every connection
+            with open(os.devnull, "w") as devnull:
+                with (
+                    contextlib.redirect_stdout(devnull),
+                    contextlib.redirect_stderr(devnull),
+                ):
+                    results[key_exchange] = asyncio.run(
+                        run(file_path, key_exchange, handshakes)
+                    )
+    finally:
+        os.remove(file_path)
+
+    print(f"{handshakes} handshakes over loopback")
+    for key_exchange, elapsed in results.items():
+        print(
+            f"{key_exchange:>8}: {handshakes / elapsed:8.1f} handshakes/s "
+            f"({elapsed * 1000 / handshakes:.2f} ms each)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Throughput of core.hash digest modes.
+
+Compares the original 4 KiB sha256 loop with large-buffer, mmap and tree hashing
+for sha256 and blake2b across several file sizes. The hash cache is bypassed.
+
+Usage:
+    uv run python -m benchmarks.hash_throughput [size_mib ...]
+"""
+
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+from zapfiles.core.hash import get_file_hash
+
+
+def legacy_hash(file_path: str) -> str:
+    hash_func = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for byte_block in iter(lambda: f.read(4096), b""):
+            hash_func.update(byte_block)
+    return hash_func.hexdigest()
+
+
+VARIANTS = {
+    "legacy sha256 (4 KiB)": legacy_hash,
+    "sha256 flat": lambda p: get_file_hash(p, "sha256", False, "flat", False),
+    "sha256 flat mmap": lambda p: get_file_hash(p, "sha256", False, "flat", True),
+    "blake2b flat": lambda p: get_file_hash(p, "blake2b", False, "flat", False),
+    "sha256 tree": lambda p: get_file_hash(p, "sha256", False, "tree", False),
+    "sha256 tree mmap": lambda p: get_file_hash(p, "sha256", False, "tree", True),
+    "blake2b tree": lambda p: get_file_hash(p, "blake2b", False, "tree", False),
+}
+
+
+def measure(hash_file, file_path: str) -> float:
+    hash_file(file_path)  # warming up page cache
+
+    start = time.perf_counter()
+    hash_file(file_path)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    sizes = [int(arg) for arg in sys.argv[1:]] or [16, 128, 512]
+
+    for size_mib in sizes:
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            for _ in range(size_mib):
+                f.write(os.urandom(1024 * 1024))
+            file_path = f.name
+
+        try:
+            print(f"{size_mib} MiB")
+            for name, hash_file in VARIANTS.items():
+                elapsed = measure(hash_file, file_path)
+                print(f"{name:>24}: {size_mib / elapsed:8.1f} MiB/s ({elapsed:.3f} s)")
+        finally:
+            os.remove(file_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Loopback throughput of the server send loop.
+
+Compares the original 4 KiB read/encrypt/drain loop with SendEngine.
+
+Usage:
+    uv run python -m benchmarks.send_throughput [size_mib] [chunk_size]
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from zapfiles.core.transfer.sender import DEFAULT_CHUNK_SIZE, SendEngine
+
+
+def create_encryptor():
+    return Cipher(algorithms.AES(os.urandom(32)), modes.CTR(b"0" * 16)).encryptor()
+
+
+async def legacy_send(writer: asyncio.StreamWriter, file_path: str) -> None:
+    encryptor = create_encryptor()
+    with open(file_path, "rb") as f:
+        while True:
+            file_data = f.read(4096)
+            if not file_data:
+                break
+            writer.write(encryptor.update(file_data))
+            await writer.drain()
+    writer.write(encryptor.finalize())
+    await writer.drain()
+
+
+async def engine_send(
+    writer: asyncio.StreamWriter, file_path: str, chunk_size: int
+) -> None:
+    engine = SendEngine(chunk_size=chunk_size)
+    with open(file_path, "rb", buffering=0) as f:
+        await engine.send(writer, create_encryptor(), f)
+
+
+async def run(send, file_size: int) -> float:
+    async def handle(reader, writer):
+        await send(writer)
+        writer.close()
+        await writer.wait_closed()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    async with server:
+        start = time.perf_counter()
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        received = 0
+        while data := await reader.read(1024 * 1024):
+            received += len(data)
+        elapsed = time.perf_counter() - start
+        writer.close()
+
+    assert received == file_size, f"received {received} of {file_size} bytes"
+    return elapsed
+
+
+def main() -> None:
+    size_mib = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_CHUNK_SIZE
+    file_size = size_mib * 1024 * 1024
+
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        for _ in range(size_mib):
+            f.write(os.urandom(1024 * 1024))
+        file_path = f.name
+
+    try:
+        results = {
+            "legacy (4 KiB)": asyncio.run(
+                run(lambda w: legacy_send(w, file_path), file_size)
+            ),
+            f"SendEngine ({chunk_size // 1024} KiB)": asyncio.run(
+                run(lambda w: engine_send(w, file_path, chunk_size), file_size)
+            ),
+        }
+    finally:
+        os.remove(file_path)
+
+    print(f"{size_mib} MiB over loopback")
+    for name, elapsed in results.items():
+        print(f"{name:>24}: {size_mib / elapsed:8.1f} MiB/s ({elapsed:.2f} s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Loopback throughput and server CPU per GiB of the two server transports,
+StreamReaderProtocol (asyncio.start_server) and ConnectionProtocol, on the
+default event loop and on uvloop if it's installed.
+
+Every client downloads the same in-memory data, written in chunks with a
+drain() after each like the send loop does. Clients run in a child process,
+so only the server's CPU time is counted.
+
+Usage:
+    uv run python -m benchmarks.transport_throughput [clients] [size_mib] [chunk_size]
+"""
+
+import asyncio
+import subprocess
+import sys
+import time
+
+from zapfiles.core.transfer.connection import get_loop_factory, start_protocol_server
+
+
+async def receive(port: int) -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    received = 0
+    while data := await reader.read(1024 * 1024):
+        received += len(data)
+    writer.close()
+    return received
+
+
+async def run_clients(port: int, clients: int) -> None:
+    sizes = await asyncio.gather(*(receive(port) for _ in range(clients)))
+    print(sum(sizes))
+
+
+async def run(transport: str, clients: int, size: int, chunk_size: int):
+    chunk = bytes(chunk_size)
+
+    async def handle(reader, writer):
+        for _ in range(size // chunk_size):
+            writer.write(chunk)
+            await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+
+    if transport == "protocol":
+        server = await start_protocol_server(handle, "127.0.0.1", 0)
+    else:
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    async with server:
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "benchmarks.transport_throughput",
+            "--clients",
+            str(port),
+            str(clients),
+            stdout=subprocess.PIPE,
+        )
+        output, _ = await process.communicate()
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+
+    received = int(output)
+    expected = clients * (size // chunk_size) * chunk_size
+    assert received == expected, f"received {received} of {expected} bytes"
+    return elapsed, cpu
+
+
+def main() -> None:
+    if sys.argv[1:2] == ["--clients"]:
+        asyncio.run(run_clients(int(sys.argv[2]), int(sys.argv[3])))
+        return
+
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    size_mib = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    chunk_size = int(sys.argv[3]) if len(sys.argv) > 3 else 64 * 1024
+    total_gib = clients * size_mib / 1024
+
+    loops = {"asyncio": get_loop_factory(use_uvloop=False)}
+    if get_loop_factory() is not loops["asyncio"]:
+        loops["uvloop"] = get_loop_factory()
+
+    print(
+        f"{clients} clients x {size_mib} MiB in {chunk_size // 1024} KiB chunks "
+        "over loopback"
+    )
+    for loop_name, loop_factory in loops.items():
+        for transport in ("streams", "protocol"):
+            with asyncio.Runner(loop_factory=loop_factory) as runner:
+                elapsed, cpu = runner.run(
+                    run(transport, clients, size_mib * 1024 * 1024, chunk_size)
+                )
+
+            name = f"{transport} on {loop_name}"
+            print(
+                f"{name:>20}: {total_gib * 1024 / elapsed:8.1f} MiB/s, "
+                f"{cpu / total_gib:6.2f} CPU s/GiB ({elapsed:.2f} s)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,134 @@
-import asyncio
+import argparse
 import ctypes
-import json
 import os
 import sys
 from pathlib import Path
 import questionary
 
-from zapfiles.cli import clear_console, title
-from zapfiles.client import client, connect
+from zapfiles.cli import clear_console, err, title
+from zapfiles.client import client, connect, stream_to
+from zapfiles.client.batch import (
+    ZAPFILE_SUFFIX,
+    batch_client,
+    load_zapfile,
+    parse_server_key,
+)
 from zapfiles.core.config.app_configuration import config
 from zapfiles.core.config.experiments_configuration import experiments_config
 from zapfiles.core.localization import lang
+from zapfiles.core.transfer.connection import run
 from zapfiles.core.updater import check_for_updates
-from zapfiles.server import server
-
-
-async def handle_zapfile() -> int:
-    if len(sys.argv) > 1:
-        try:
-            file_path = Path(sys.argv[1])
-            if file_path.is_file():
-                with open(file_path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    host = data.get("host", "localhost")
-                    port = data.get("port", 8888)
-                    filename = data.get("filename", "filename")
-                    file_hash = data.get("hash", "hash")
-                    await connect(host, port, filename, file_hash)
-                    return 1
-        except Exception as e:
-            print(e)
+from zapfiles.server import server, stream_server
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="zapfiles", description=lang.get_string("main.args.description")
+    )
+    parser.add_argument("inputs", nargs="*", help=lang.get_string("main.args.inputs"))
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=config.get_value("batch_concurrency"),
+        help=lang.get_string("main.args.concurrency"),
+    )
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        default=config.get_value("batch_per_host"),
+        help=lang.get_string("main.args.perHost"),
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=config.get_value("batch_retries"),
+        help=lang.get_string("main.args.retries"),
+    )
+    parser.add_argument("-o", "--output", help=lang.get_string("main.args.output"))
+    parser.add_argument("--stream", help=lang.get_string("main.args.stream"))
+    parser.add_argument(
+        "--name", default="stream", help=lang.get_string("main.args.name")
+    )
+    parser.add_argument(
+        "--port", type=int, default=8888, help=lang.get_string("main.args.port")
+    )
+    parser.add_argument("--host", help=lang.get_string("main.args.host"))
+    return parser.parse_args()
+
+
+async def handle_pipe(args: argparse.Namespace) -> int:
+    """
+    Shares a stream or downloads into --output without asking anything.
+
+    Args:
+        args (argparse.Namespace): parsed arguments
+
+    Returns:
+        int: exit code
+    """
+    if args.stream is not None:
+        sent = await stream_server(args.stream, args.name, args.port, args.host)
+        return 0 if sent else 1
+
+    if len(args.inputs) != 1:
+        err(lang.get_string("main.error.singleInput"))
+        return 2
+
+    try:
+        file_path = Path(args.inputs[0])
+        if file_path.is_file():
+            item = load_zapfile(file_path)
+        else:
+            item = parse_server_key(args.inputs[0])
+    except (OSError, ValueError, TypeError, KeyError, AttributeError):
+        err(lang.get_string("client.error.invalidKey"))
+        return 2
+
+    if args.output == "-":
+        # Downloaded data goes to stdout, everything printed goes to stderr
+        output = sys.stdout.buffer
+        sys.stdout = sys.stderr
+        received = await stream_to(
+            item.host, item.port, item.file_hash, output, item.addresses
+        )
+        output.flush()
+    else:
+        with open(args.output, "wb") as output:
+            received = await stream_to(
+                item.host, item.port, item.file_hash, output, item.addresses
+            )
+    return 0 if received else 1
+
+
+async def handle_zapfile(args: argparse.Namespace) -> int:
+    if not args.inputs:
+        return 0
+
+    try:
+        file_path = Path(args.inputs[0])
+        if (
+            len(args.inputs) == 1
+            and file_path.is_file()
+            and file_path.suffix == ZAPFILE_SUFFIX
+        ):
+            # Single zapfile, e.g. opened from the file manager
+            item = load_zapfile(file_path)
+            await connect(
+                item.host,
+                item.port,
+                item.filename,
+                item.file_hash,
+                mirrors=item.mirrors,
+                addresses=item.addresses,
+            )
+        else:
+            await batch_client(
+                args.inputs, args.concurrency, args.per_host, args.retries
+            )
+        return 1
+    except Exception as e:
+        print(e)
     return 0
 
 
@@ -41,10 +140,14 @@ def main() -> None:
         )
 
     try:
+        args = parse_args()
+        if args.stream is not None or args.output is not None:
+            sys.exit(run(handle_pipe(args), config.get_value("use_uvloop")))
+
         clear_console()
         title()
 
-        if asyncio.run(handle_zapfile()) == 1:
+        if run(handle_zapfile(args), config.get_value("use_uvloop")) == 1:
             return
 
         if config.get_value("check_for_updates") and os.name == "nt":
@@ -71,9 +174,9 @@ def main() -> None:
         title()
 
         if mode == "host":
-            asyncio.run(server())
+            run(server(), config.get_value("use_uvloop"))
         elif mode == "get":
-            asyncio.run(client())
+            run(client(), config.get_value("use_uvloop"))
         elif mode == "scan_lan":
             print("Not implemented yet")
 
@@ -1,5 +1,7 @@
 import os
+from contextvars import ContextVar
 from enum import Enum
+from typing import Optional
 
 import colorama as clr
 from colorama import Fore
@@ -21,6 +23,21 @@ class ColorEnum(str, Enum):
         return self.value
 
 
+# Set by batch downloads, messages of a download are collected instead of
+# printed, so they don't break up the shared progress display
+captured_messages: ContextVar[Optional[list[tuple[ColorEnum, str]]]] = ContextVar(
+    "captured_messages", default=None
+)
+
+
+def _print(msg: str, color_start: ColorEnum) -> None:
+    messages = captured_messages.get()
+    if messages is not None:
+        messages.append((color_start, msg))
+    else:
+        print(color(msg, color_start))
+
+
 def title() -> None:
     """
     Prints title.
@@ -64,7 +81,7 @@ def info(msg: str) -> None:
     Returns:
         None
     """
-    print(color(msg, ColorEnum.INFO))
+    _print(msg, ColorEnum.INFO)
 
 
 def warn(msg: str) -> None:
@@ -77,7 +94,7 @@ def warn(msg: str) -> None:
     Returns:
         None
     """
-    print(color(msg, ColorEnum.WARN))
+    _print(msg, ColorEnum.WARN)
 
 
 def err(msg: str) -> None:
@@ -90,7 +107,7 @@ def err(msg: str) -> None:
     Returns:
         None
     """
-    print(color(msg, ColorEnum.ERROR))
+    _print(msg, ColorEnum.ERROR)
 
 
 def success(msg: str) -> None:
@@ -103,7 +120,7 @@ def success(msg: str) -> None:
     Returns:
         None
     """
-    print(color(msg, ColorEnum.SUCCESS))
+    _print(msg, ColorEnum.SUCCESS)
 
 
 def color(
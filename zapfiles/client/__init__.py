@@ -1,27 +1,160 @@
 import asyncio
 import os
+import time
 from asyncio import StreamReader, StreamWriter
+from collections import deque
+from contextvars import ContextVar
+from functools import partial
 from os import PathLike
 from pathlib import Path
+from typing import BinaryIO, Callable, NamedTuple, Optional, Sequence
 
 import questionary
-from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey, RSAPublicKey
-from cryptography.hazmat.primitives.ciphers import (
-    Cipher,
-    algorithms,
-    modes,
-    CipherContext,
-)
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
 from tqdm import tqdm
 
-from zapfiles.cli import info, warn, err, success, clear_console, title, ColorEnum
+from zapfiles.cli import (
+    info,
+    warn,
+    err,
+    success,
+    clear_console,
+    title,
+    ColorEnum,
+    captured_messages,
+)
+from zapfiles.core.compression import get_codec
 from zapfiles.core.config.app_configuration import config
 from zapfiles.core.config.experiments_configuration import experiments_config
-from zapfiles.core.hash import get_file_hash
+from zapfiles.core.crypto import (
+    RESUMPTION_NONCE_SIZE,
+    RESUMPTION_SECRET_SIZE,
+    X25519_WRAPPED_KEY_SIZE,
+    create_decryptor,
+    get_x25519_public_bytes,
+    ticket_unwrap_key,
+    x25519_unwrap_key,
+)
+from zapfiles.core.delta import DeltaReceiver, compute_signatures, get_block_size
+from zapfiles.core.hash import (
+    StreamHasher,
+    file_hash_matches,
+    format_hash,
+    parse_hash,
+)
 from zapfiles.core.localization import lang
+from zapfiles.core.protocol import (
+    ENCRYPTED_KEY_SIZE,
+    FILE_SIZE_SIZE,
+    KEY_EXCHANGE_RSA,
+    KEY_EXCHANGE_TICKET,
+    KEY_EXCHANGE_X25519,
+    PROTOCOL_VERSION,
+    TRANSPORT_CHUNKED,
+    TRANSPORT_DELTA,
+    TRANSPORT_FRAMED,
+    TRANSPORT_STREAM,
+    TRANSPORT_TLS,
+    ByteRange,
+    ClientRequest,
+    TicketRejectedError,
+    UnknownFileError,
+    read_header,
+    send_hello,
+    send_range_request,
+    send_ready,
+    send_transport_request,
+    send_x25519_offer,
+)
+from zapfiles.core.store import content_store, place_copy
+from zapfiles.core.tickets import Ticket, ticket_store
+from zapfiles.core.transfer import ktls
+from zapfiles.core.transfer.connection import run
+from zapfiles.core.transfer.framing import (
+    FRAME_SIZE,
+    CorruptedFrameError,
+    FramedReceiver,
+)
+from zapfiles.core.transfer.journal import (
+    DownloadJournal,
+    JournaledWriter,
+    get_part_path,
+)
+from zapfiles.core.transfer.packing import (
+    MalformedPackError,
+    PackedWriter,
+    get_directory_hash,
+    is_directory_hash,
+)
+from zapfiles.core.transfer.streaming import (
+    ChunkedReceiver,
+    StreamDigestError,
+    get_stream_hasher,
+    is_stream_id,
+)
+from zapfiles.core.transfer.receiver import (
+    HashingWriter,
+    PositionalWriter,
+    Readable,
+    ReceivePipeline,
+    Writable,
+    preallocate,
+)
+
+# Stripes smaller than this aren't worth an extra connection
+MIN_STRIPE_SIZE = 8 * 1024 * 1024
+
+# Swarm downloads hand out missing data in chunks of this size
+SWARM_CHUNK_SIZE = 8 * 1024 * 1024
+
+# How many times a stripe is requested again after a frame fails authentication
+MAX_FRAME_RETRIES = 3
+
+# How long to wait for the protocol v2 header before falling back to v1
+HEADER_TIMEOUT = 10
+
+
+# Set by batch downloads, progress of every download goes to their shared display
+progress_hook: ContextVar[Optional[Callable[[int], object]]] = ContextVar(
+    "progress_hook", default=None
+)
+
+
+class FileChangedError(Exception):
+    """
+    Raised when the server announces a different hash than the server key has.
+    """
+
+
+class _HookedProgressBar(tqdm):
+    """
+    Hidden progress bar reporting its updates to progress_hook.
+    """
+
+    def __init__(self, hook: Callable[[int], object], **kwargs):
+        self._hook = hook
+        super().__init__(disable=True, **kwargs)
+
+    def update(self, n: float | None = 1) -> bool | None:
+        self._hook(int(n or 0))
+        return super().update(n)
+
+
+def create_progress_bar(**kwargs) -> tqdm:
+    """
+    Args:
+        **kwargs: tqdm arguments
+
+    Returns:
+        tqdm: progress bar, hidden while progress_hook is set
+    """
+    hook = progress_hook.get()
+    if hook is None:
+        return tqdm(**kwargs)
+    return _HookedProgressBar(hook, **kwargs)
 
 
 def get_download_path(filename: str) -> Path:
@@ -73,35 +206,421 @@ async def receive_encrypted_key(reader: StreamReader) -> bytes:
     Returns:
         bytes: encrypted AES key
     """
-    return await reader.read(256)
+    return await reader.readexactly(ENCRYPTED_KEY_SIZE)
 
 
-def create_aes_cipher(aes_key: bytes) -> Cipher:
+def decrypt_aes_key(private_key: RSAPrivateKey, encrypted_aes_key: bytes) -> bytes:
     """
-    Creates AES cipher.
+    Decrypts AES key received from server.
 
     Args:
-        aes_key (bytes): AES key
+        private_key (RSAPrivateKey): private RSA key
+        encrypted_aes_key (bytes): encrypted AES key
 
     Returns:
-        Cipher: AES cipher
+        bytes: AES key
+
+    Raises:
+        ValueError: If the key can't be decrypted.
     """
-    return Cipher(
-        algorithms.AES(aes_key), modes.CTR(b"0" * 16), backend=default_backend()
+    return private_key.decrypt(
+        encrypted_aes_key,
+        padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None,
+        ),
     )
 
 
+class ClientKeys:
+    """
+    Keys the client offers to servers.
+    X25519 keys are ephemeral and made for every connection. The RSA key pair is
+    only generated once a server turns out not to support X25519.
+    Protocol version drops to 1 once a server turns out not to support v2.
+    """
+
+    def __init__(
+        self,
+        key_exchange: str = KEY_EXCHANGE_X25519,
+        protocol_version: int = PROTOCOL_VERSION,
+    ):
+        """
+        Args:
+            key_exchange (str): "x25519" or "rsa"
+            protocol_version (int): protocol version to start with
+        """
+        self.key_exchange = key_exchange
+        self.protocol_version = protocol_version
+        self._rsa_keys: Optional[tuple[RSAPrivateKey, RSAPublicKey]] = None
+
+    @property
+    def rsa_keys(self) -> tuple[RSAPrivateKey, RSAPublicKey]:
+        """
+        Returns:
+            tuple[RSAPrivateKey, RSAPublicKey]: RSA key pair, generated on first use
+        """
+        if self._rsa_keys is None:
+            self._rsa_keys = generate_rsa()
+        return self._rsa_keys
+
+
+class Session(NamedTuple):
+    reader: Readable
+    writer: StreamWriter
+    aes_key: bytes
+    file_size: int
+    transport: int
+    # Only sent by protocol v2 servers
+    frame_size: int = FRAME_SIZE
+    file_hash: Optional[str] = None
+    # Codec of the framed transport, if any
+    codec: Optional[str] = None
+
+
+def check_file_hash(session: Session, file_hash: str) -> None:
+    """
+    Checks that the server sends the file the server key was made for.
+
+    Args:
+        session (Session): session returned by open_session
+        file_hash (str): hash string from the server key
+
+    Returns:
+        None
+
+    Raises:
+        FileChangedError: If the server has a different file.
+    """
+    if session.file_hash is None:
+        return
+
+    expected, announced = parse_hash(file_hash), parse_hash(session.file_hash)
+    # Hashes made with another algorithm or mode can't be compared
+    if expected[:2] == announced[:2] and expected != announced:
+        raise FileChangedError(session.file_hash)
+
+
+def get_offered_codecs() -> tuple[str, ...]:
+    """
+    Returns:
+        tuple[str, ...]: compression codecs to offer the server
+    """
+    codec = config.get_value("compression")
+    return () if get_codec(codec) is None else (codec,)
+
+
+def get_requested_transport() -> Optional[int]:
+    """
+    Returns:
+        Optional[int]: transport to ask the server for, None for the AES-CTR
+            stream
+    """
+    # Only frames can be compressed
+    if config.get_value("framed_transfer") or get_offered_codecs():
+        return TRANSPORT_FRAMED
+    if config.get_value("ktls"):
+        return TRANSPORT_TLS
+    return None
+
+
+async def open_session(
+    ip: str,
+    port: int,
+    keys: ClientKeys,
+    byte_range: Optional[ByteRange] = None,
+    transport: Optional[int] = -1,
+    file_id: Optional[str] = None,
+) -> Session:
+    """
+    Connects to server and exchanges keys.
+    Protocol v2 is tried first, servers that drop the connection or don't answer
+    are spoken to with v1.
+
+    Args:
+        ip (str): IP address of server
+        port (int): port of server
+        keys (ClientKeys): keys offered to server
+        byte_range (ByteRange, optional): part of file to request, whole file if None
+        transport (int, optional): transport to ask for, None for the AES-CTR
+            stream, picked from config if -1
+        file_id (str, optional): hash string of file to ask for, v1 servers
+            only have one file
+
+    Returns:
+        Session: session with the transport picked by server, its reader returns
+            plaintext for TLS records
+
+    Raises:
+        ValueError: If the AES key can't be decrypted.
+    """
+    if transport == -1:
+        transport = get_requested_transport()
+
+    if keys.protocol_version >= 2:
+        try:
+            return await _open_session_v2(
+                ip, port, keys, byte_range, transport, file_id
+            )
+        except (asyncio.IncompleteReadError, ConnectionResetError, TimeoutError):
+            # Server only speaks v1, using it for the rest of the download
+            keys.protocol_version = 1
+
+    return await _open_session_v1(ip, port, keys, byte_range, transport)
+
+
+async def _open_session_v2(
+    ip: str,
+    port: int,
+    keys: ClientKeys,
+    byte_range: Optional[ByteRange],
+    transport: Optional[int],
+    file_id: Optional[str],
+) -> Session:
+    ticket = ticket_store.get(ip, port) if config.get_value("session_tickets") else None
+    reader, writer = await asyncio.open_connection(ip, port)
+
+    try:
+        key_exchange = keys.key_exchange
+        if ticket is not None:
+            # Resuming the previous session without asymmetric cryptography
+            key_exchange = KEY_EXCHANGE_TICKET
+            public_key = os.urandom(RESUMPTION_NONCE_SIZE)
+            unwrap_key = partial(ticket_unwrap_key, ticket.secret, public_key)
+        elif key_exchange == KEY_EXCHANGE_X25519:
+            x25519_key = X25519PrivateKey.generate()
+            public_key = get_x25519_public_bytes(x25519_key)
+            unwrap_key = partial(x25519_unwrap_key, x25519_key)
+        else:
+            private_key, rsa_public_key = keys.rsa_keys
+            public_key = rsa_public_key.public_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PublicFormat.SubjectPublicKeyInfo,
+            )
+            unwrap_key = partial(decrypt_aes_key, private_key)
+
+        await send_hello(
+            writer,
+            ClientRequest(
+                byte_range,
+                transport,
+                key_exchange,
+                public_key,
+                PROTOCOL_VERSION,
+                None if ticket is None else ticket.ticket,
+                file_id,
+                get_offered_codecs() if transport == TRANSPORT_FRAMED else (),
+                queue_updates=True,
+                wrapped_secret=True,
+            ),
+        )
+
+        loop = asyncio.get_running_loop()
+        position = None
+        async with asyncio.timeout(HEADER_TIMEOUT) as header_timeout:
+
+            def on_queued(new_position: int) -> None:
+                nonlocal position
+                # Busy server keeps telling where we are, waiting is fine then
+                header_timeout.reschedule(loop.time() + HEADER_TIMEOUT)
+                if new_position != position:
+                    position = new_position
+                    info(lang.get_string("client.info.queued").format(position))
+
+            header = await read_header(reader, on_queued)
+        key_material = unwrap_key(header.wrapped_key)
+    except (TicketRejectedError, ValueError):
+        writer.close()
+        if ticket is None:
+            raise
+
+        # Ticket has expired or the server has restarted, doing a full exchange
+        ticket_store.remove(ip, port)
+        return await _open_session_v2(ip, port, keys, byte_range, transport, file_id)
+    except BaseException:
+        writer.close()
+        raise
+
+    # Secret of the new ticket follows the AES key
+    aes_key = key_material[:32]
+    secret = key_material[32:]
+    if header.ticket is not None and len(secret) == RESUMPTION_SECRET_SIZE:
+        ticket_store.put(
+            ip,
+            port,
+            Ticket(header.ticket, secret, time.time() + header.ticket_lifetime),
+        )
+
+    session_reader: Readable = reader
+    if header.transport == TRANSPORT_TLS:
+        session_reader = await _start_tls(reader, writer, aes_key, PROTOCOL_VERSION)
+
+    return Session(
+        session_reader,
+        writer,
+        aes_key,
+        header.file_size,
+        header.transport,
+        header.chunk_size,
+        header.file_hash,
+        header.codec,
+    )
+
+
+async def _open_session_v1(
+    ip: str,
+    port: int,
+    keys: ClientKeys,
+    byte_range: Optional[ByteRange],
+    transport: Optional[int],
+) -> Session:
+    reader, writer = await asyncio.open_connection(ip, port)
+
+    try:
+        if byte_range is not None:
+            await send_range_request(writer, byte_range)
+        if transport is not None:
+            await send_transport_request(writer, transport)
+
+        # Getting encrypted AES key and total size of file from server
+        if keys.key_exchange == KEY_EXCHANGE_X25519:
+            x25519_key = X25519PrivateKey.generate()
+            await send_x25519_offer(writer, get_x25519_public_bytes(x25519_key))
+            aes_key = x25519_unwrap_key(
+                x25519_key, await reader.readexactly(X25519_WRAPPED_KEY_SIZE)
+            )
+        else:
+            private_key, public_key = keys.rsa_keys
+            await send_public_key(writer, public_key)
+            aes_key = decrypt_aes_key(private_key, await receive_encrypted_key(reader))
+        file_size = int.from_bytes(await reader.readexactly(FILE_SIZE_SIZE), "big")
+
+        picked = TRANSPORT_STREAM
+        if transport is not None:
+            picked = (await reader.readexactly(1))[0]
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        writer.close()
+        if keys.key_exchange == KEY_EXCHANGE_X25519:
+            # Server doesn't know X25519, using RSA for the rest of the download
+            keys.key_exchange = KEY_EXCHANGE_RSA
+            return await _open_session_v1(ip, port, keys, byte_range, transport)
+        if transport is None:
+            raise
+
+        # Server doesn't know transport requests, trying again without one
+        return await _open_session_v1(ip, port, keys, byte_range, transport=None)
+    except BaseException:
+        writer.close()
+        raise
+
+    session_reader: Readable = reader
+    if picked == TRANSPORT_TLS:
+        session_reader = await _start_tls(reader, writer, aes_key, version=1)
+
+    return Session(session_reader, writer, aes_key, file_size, picked)
+
+
+async def _start_tls(
+    reader: StreamReader, writer: StreamWriter, aes_key: bytes, version: int
+) -> Readable:
+    # Records are decrypted by the kernel if possible and in user space otherwise
+    tls_keys = ktls.derive_tls_keys(aes_key)
+    sock = writer.get_extra_info("socket")
+    session_reader: Readable = reader
+    if not (ktls.attach(sock) and ktls.install(sock, ktls.TLS_RX, tls_keys)):
+        session_reader = ktls.TlsRecordReader(reader, tls_keys)
+
+    await send_ready(writer, version)
+    return session_reader
+
+
+async def receive_range(
+    session: Session,
+    target: Writable,
+    byte_range: ByteRange,
+    on_progress: Optional[Callable[[int], object]] = None,
+) -> int:
+    """
+    Receives byte range of file with the transport picked by server.
+
+    Args:
+        session (Session): session returned by open_session
+        target (Writable): file-like writer positioned at the range offset
+        byte_range (ByteRange): range sent by server
+        on_progress (Callable[[int], object], optional): called with the number
+            of received bytes
+
+    Returns:
+        int: number of bytes written
+
+    Raises:
+        CorruptedFrameError: If a frame fails authentication.
+    """
+    if session.transport == TRANSPORT_FRAMED:
+        receiver = FramedReceiver(
+            session.frame_size,
+            queue_depth=config.get_value("receive_queue_depth"),
+            codec=get_codec(session.codec),
+        )
+        return await receiver.receive(
+            session.reader, session.aes_key, target, byte_range, on_progress
+        )
+
+    pipeline = ReceivePipeline(
+        chunk_size=config.get_value("transfer_chunk_size"),
+        queue_depth=config.get_value("receive_queue_depth"),
+    )
+    decryptor = (
+        create_decryptor(session.aes_key, byte_range.offset)
+        if session.transport == TRANSPORT_STREAM
+        else None
+    )
+    return await pipeline.receive(
+        session.reader, decryptor, target, byte_range.length, on_progress
+    )
+
+
+def split_into_stripes(
+    ranges: list[ByteRange], connections: int, alignment: int = 16
+) -> list[ByteRange]:
+    """
+    Splits byte ranges into stripes that can be downloaded in parallel.
+
+    Args:
+        ranges (list[ByteRange]): byte ranges to download
+        connections (int): maximum number of connections
+        alignment (int): stripes start at multiples of this value (default: 16,
+            the AES block size)
+
+    Returns:
+        list[ByteRange]: stripes covering all ranges
+    """
+    total = sum(byte_range.length for byte_range in ranges)
+    stripe_size = max(MIN_STRIPE_SIZE, -(-total // max(connections, 1)))
+    stripe_size += -stripe_size % alignment
+
+    return [
+        ByteRange(offset, min(stripe_size, byte_range.end - offset))
+        for byte_range in ranges
+        for offset in range(byte_range.offset, byte_range.end, stripe_size)
+    ]
+
+
 async def download_and_decrypt_file(
-    reader: StreamReader, file_path: Path, decryptor: CipherContext, file_size: int
+    session: Session,
+    file_path: Path,
+    journal: Optional[DownloadJournal] = None,
+    hasher: Optional[StreamHasher] = None,
 ) -> None:
     """
     Downloads file from server.
 
     Args:
-        reader (StreamReader): asyncio StreamReader
+        session (Session): session returned by open_session
         file_path (str): path to save file
-        decryptor (CipherContext): decryptor
-        file_size (int): size of file
+        journal (DownloadJournal, optional): journal to record written blocks in
+        hasher (StreamHasher, optional): hasher to update with decrypted data
 
     Returns:
         None
@@ -111,19 +630,31 @@ async def download_and_decrypt_file(
 
     print(ColorEnum.SUCCESS, end="", flush=True)
 
+    file_size = session.file_size
+
     # Creating progressbar with total size of file
-    with tqdm(
+    with create_progress_bar(
         total=file_size, unit="B", unit_scale=True, desc=os.path.basename(file_path)
     ) as progress_bar:
         with open(file_path, "wb") as f:
-            while True:
-                data = await reader.read(4096)
-                if not data:
-                    break
-                f.write(decryptor.update(data))
-                progress_bar.update(len(data))
+            preallocate(f, file_size)
+
+            target: Writable = f if journal is None else JournaledWriter(f, journal)
+            if hasher is not None:
+                target = HashingWriter(target, hasher)
 
-            f.write(decryptor.finalize())
+            written = 0
+            try:
+                written = await receive_range(
+                    session,
+                    target,
+                    ByteRange(0, file_size),
+                    on_progress=progress_bar.update,
+                )
+            finally:
+                # Dropping preallocated space if the transfer was cut short
+                if written < file_size:
+                    f.truncate(f.tell())
 
 
 def generate_rsa() -> tuple[RSAPrivateKey, RSAPublicKey]:
@@ -137,81 +668,952 @@ def generate_rsa() -> tuple[RSAPrivateKey, RSAPublicKey]:
     return private_key, private_key.public_key()
 
 
-async def connect(ip: str, port: int, filename: str, file_hash: str) -> None:
+async def download_stripe(
+    ip: str,
+    port: int,
+    keys: ClientKeys,
+    file_hash: str,
+    f: BinaryIO,
+    byte_range: ByteRange,
+    journal: DownloadJournal,
+    on_progress: Callable[[int], object],
+) -> int:
     """
-    Establishes connection to server.
+    Downloads a single byte range into the preallocated file.
 
     Args:
         ip (str): IP address of server
         port (int): port of server
-        filename (str): name of file to download
+        keys (ClientKeys): keys offered to server
         file_hash (str): hash of file to download
+        f (BinaryIO): target file opened for writing
+        byte_range (ByteRange): range to download
+        journal (DownloadJournal): journal to record written blocks in
+        on_progress (Callable[[int], object]): called with the number of
+            received bytes, negative when received data is thrown away
 
     Returns:
-        None
+        int: number of bytes written
     """
-    # Generating RSA keys
-    private_key, public_key = generate_rsa()
+    offset = byte_range.offset
 
-    # Connecting to server
-    reader, writer = await asyncio.open_connection(ip, port)
-    await send_public_key(writer, public_key)
+    for attempt in range(MAX_FRAME_RETRIES + 1):
+        session = await open_session(
+            ip,
+            port,
+            keys,
+            ByteRange(offset, byte_range.end - offset),
+            file_id=file_hash,
+        )
+        target = PositionalWriter(f, offset)
+        received = 0
+
+        def on_received(size: int) -> None:
+            nonlocal received
+            received += size
+            on_progress(size)
 
-    # Getting encrypted AES key from server
-    encrypted_aes_key = await receive_encrypted_key(reader)
+        try:
+            return (offset - byte_range.offset) + await receive_range(
+                session,
+                JournaledWriter(target, journal, offset),
+                ByteRange(offset, byte_range.end - offset),
+                on_progress=on_received,
+            )
+        except CorruptedFrameError as e:
+            if attempt == MAX_FRAME_RETRIES:
+                raise
+            warn(lang.get_string("client.warning.corruptedFrame").format(e.offset))
 
+            # Requesting the rest again from the block containing the bad frame
+            restart = max(e.offset - e.offset % journal.block_size, byte_range.offset)
+            on_progress(restart - (offset + received))
+            offset = restart
+        finally:
+            target.close()
+            session.writer.close()
+            await session.writer.wait_closed()
+
+    return 0  # unreachable, the last attempt returns or raises
+
+
+async def download_ranges(
+    ip: str,
+    port: int,
+    keys: ClientKeys,
+    file_hash: str,
+    part_path: Path,
+    journal: Optional[DownloadJournal],
+    connections: int,
+) -> Optional[DownloadJournal]:
+    """
+    Downloads missing parts of file with range requests.
+    Missing ranges are split into stripes that are fetched over several connections.
+
+    Args:
+        ip (str): IP address of server
+        port (int): port of server
+        keys (ClientKeys): keys offered to server
+        file_hash (str): hash of file to download
+        part_path (Path): path to partial file
+        journal (DownloadJournal, optional): journal of a previous attempt
+        connections (int): maximum number of connections
+
+    Returns:
+        Optional[DownloadJournal]: journal of the download or None if server
+            doesn't support range requests
+    """
+    # Empty range request only tells the file size
     try:
-        # Decrypting AES key
-        aes_key = private_key.decrypt(
-            encrypted_aes_key,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None,
-            ),
+        session = await open_session(ip, port, keys, ByteRange(0, 0), file_id=file_hash)
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        return None
+
+    file_size = session.file_size
+    session.writer.close()
+    await session.writer.wait_closed()
+    check_file_hash(session, file_hash)
+
+    # Starting over if the file has changed since the previous attempt
+    resume = journal is not None and journal.file_size == file_size
+    if journal is None or not resume:
+        journal = DownloadJournal(part_path, file_hash, file_size)
+
+    stripes = split_into_stripes(
+        journal.missing_ranges(), connections, journal.block_size
+    )
+    semaphore = asyncio.Semaphore(connections)
+
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+
+    print(ColorEnum.SUCCESS, end="", flush=True)
+
+    with create_progress_bar(
+        total=file_size,
+        initial=journal.committed,
+        unit="B",
+        unit_scale=True,
+        desc=os.path.basename(part_path.with_suffix("")),
+        postfix={
+            lang.get_string("client.progress.connections"): min(
+                connections, len(stripes)
+            )
+        },
+    ) as progress_bar:
+        with open(part_path, "r+b" if resume else "wb") as f:
+            preallocate(f, file_size)
+
+            async def download(stripe: ByteRange) -> int:
+                async with semaphore:
+                    return await download_stripe(
+                        ip,
+                        port,
+                        keys,
+                        file_hash,
+                        f,
+                        stripe,
+                        journal,
+                        progress_bar.update,
+                    )
+
+            try:
+                async with asyncio.TaskGroup() as group:
+                    for stripe in stripes:
+                        group.create_task(download(stripe))
+            except ExceptionGroup as e:
+                raise e.exceptions[0]
+            finally:
+                journal.save()
+
+    return journal
+
+
+async def download_swarm(
+    sources: list[tuple[str, int]],
+    file_hash: str,
+    part_path: Path,
+    journal: Optional[DownloadJournal],
+    connections: int,
+) -> Optional[DownloadJournal]:
+    """
+    Downloads missing parts of file from several servers sharing it at once.
+    Idle connections take chunks from a shared queue, so faster servers fetch
+    more of them. Once the queue is empty, idle connections also fetch chunks
+    still in flight elsewhere and the first copy to arrive wins.
+
+    Args:
+        sources (list[tuple[str, int]]): IP addresses and ports of servers
+        file_hash (str): hash of file to download
+        part_path (Path): path to partial file
+        journal (DownloadJournal, optional): journal of a previous attempt
+        connections (int): number of connections to every server
+
+    Returns:
+        Optional[DownloadJournal]: journal of the download or None if no server
+            supports range requests
+    """
+    # Servers fall back to older protocols on their own
+    keys = {source: ClientKeys(config.get_value("key_exchange")) for source in sources}
+
+    async def probe(source: tuple[str, int]) -> Optional[int]:
+        # Empty range request only tells the file size
+        try:
+            session = await open_session(
+                *source, keys[source], ByteRange(0, 0), file_id=file_hash
+            )
+        except (EOFError, OSError, ValueError, UnknownFileError):
+            return None
+
+        session.writer.close()
+        await session.writer.wait_closed()
+        try:
+            check_file_hash(session, file_hash)
+        except FileChangedError:
+            return None
+        return session.file_size
+
+    sizes = await asyncio.gather(*(probe(source) for source in sources))
+    file_size = next((size for size in sizes if size is not None), None)
+    if file_size is None:
+        return None
+
+    # Servers with another size of the file have another file
+    sources = [source for source, size in zip(sources, sizes) if size == file_size]
+
+    # Starting over if the file has changed since the previous attempt
+    resume = journal is not None and journal.file_size == file_size
+    if journal is None or not resume:
+        journal = DownloadJournal(part_path, file_hash, file_size)
+
+    chunk_size = SWARM_CHUNK_SIZE + -SWARM_CHUNK_SIZE % journal.block_size
+    chunks = deque(
+        ByteRange(offset, min(chunk_size, byte_range.end - offset))
+        for byte_range in journal.missing_ranges()
+        for offset in range(byte_range.offset, byte_range.end, chunk_size)
+    )
+    # Attempts of every chunk being downloaded and their servers
+    in_flight: dict[ByteRange, dict[asyncio.Task[int], tuple[str, int]]] = {}
+    changed = asyncio.Event()
+
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+
+    print(ColorEnum.SUCCESS, end="", flush=True)
+
+    with create_progress_bar(
+        total=file_size,
+        initial=journal.committed,
+        unit="B",
+        unit_scale=True,
+        desc=os.path.basename(part_path.with_suffix("")),
+        postfix={lang.get_string("client.progress.servers"): len(sources)},
+    ) as progress_bar:
+        with open(part_path, "r+b" if resume else "wb") as f:
+            preallocate(f, file_size)
+
+            def take_chunk(source: tuple[str, int]) -> Optional[ByteRange]:
+                if chunks:
+                    return chunks.popleft()
+
+                # Racing the oldest chunk no other connection is racing yet
+                for chunk, attempts in in_flight.items():
+                    if len(attempts) == 1 and source not in attempts.values():
+                        return chunk
+                return None
+
+            async def fetch(source: tuple[str, int], chunk: ByteRange) -> int:
+                received = 0
+
+                def on_progress(size: int) -> None:
+                    nonlocal received
+                    received += size
+                    progress_bar.update(size)
+
+                try:
+                    written = await download_stripe(
+                        *source,
+                        keys[source],
+                        file_hash,
+                        f,
+                        chunk,
+                        journal,
+                        on_progress,
+                    )
+                    if written < chunk.length:
+                        raise ConnectionResetError("Chunk was cut short")
+                    return written
+                except BaseException:
+                    # Data of a lost race or a failed server is counted again
+                    progress_bar.update(-received)
+                    raise
+
+            async def worker(source: tuple[str, int]) -> None:
+                while True:
+                    chunk = take_chunk(source)
+                    if chunk is None:
+                        if not in_flight:
+                            return
+                        changed.clear()
+                        await changed.wait()
+                        continue
+
+                    task = asyncio.create_task(fetch(source, chunk))
+                    attempts = in_flight.setdefault(chunk, {})
+                    attempts[task] = source
+                    await asyncio.wait([task])
+                    attempts.pop(task, None)
+
+                    if task.cancelled():
+                        pass  # another server was faster
+                    elif task.exception() is None:
+                        # Chunk is on disk, dropping slower copies of it
+                        for other in in_flight.pop(chunk, {}):
+                            other.cancel()
+                    else:
+                        # Server has failed, giving its chunk to the others
+                        if not attempts:
+                            in_flight.pop(chunk, None)
+                            chunks.appendleft(chunk)
+                        changed.set()
+                        return
+                    changed.set()
+
+            try:
+                await asyncio.gather(
+                    *(
+                        worker(source)
+                        for source in sources
+                        for _ in range(max(connections, 1))
+                    )
+                )
+            finally:
+                for attempts in in_flight.values():
+                    for task in attempts:
+                        task.cancel()
+                journal.save()
+
+    return journal
+
+
+async def download_directory(
+    ip: str, port: int, keys: ClientKeys, dirname: str, file_hash: str
+) -> bool:
+    """
+    Downloads shared directory as a single packed stream and unpacks it while
+    it's received.
+
+    Args:
+        ip (str): IP address of server
+        port (int): port of server
+        keys (ClientKeys): keys offered to server
+        dirname (str): name of directory to download
+        file_hash (str): hash string of directory
+
+    Returns:
+        bool: True if every file was received with a correct hash
+    """
+    target_dir = get_download_path(dirname)
+    unpacker = PackedWriter(target_dir)
+
+    try:
+        session = await open_session(ip, port, keys, file_id=file_hash)
+        if keys.protocol_version < 2:
+            # v1 servers only share single files
+            session.writer.close()
+            err(lang.get_string("client.error.directoriesNotSupported"))
+            return False
+
+        try:
+            check_file_hash(session, file_hash)
+            print(ColorEnum.SUCCESS, end="", flush=True)
+            with create_progress_bar(
+                total=session.file_size, unit="B", unit_scale=True, desc=dirname
+            ) as progress_bar:
+                written = await receive_range(
+                    session,
+                    unpacker,
+                    ByteRange(0, session.file_size),
+                    on_progress=progress_bar.update,
+                )
+        finally:
+            session.writer.close()
+            await session.writer.wait_closed()
+            unpacker.close()
+    except FileChangedError:
+        err(lang.get_string("client.hash.incorrectDirectory"))
+        return False
+    except UnknownFileError:
+        err(lang.get_string("client.error.fileNotShared"))
+        return False
+    except ValueError:
+        err(lang.get_string("client.error.invalidEncryptionKey"))
+        return False
+    except (
+        asyncio.IncompleteReadError,
+        ConnectionError,
+        CorruptedFrameError,
+        MalformedPackError,
+    ):
+        err(lang.get_string("client.error.downloadInterrupted"))
+        return False
+
+    if written < session.file_size:
+        err(lang.get_string("client.error.downloadInterrupted"))
+        return False
+
+    success(
+        lang.get_string("client.info.directoryReceived").format(len(unpacker.entries))
+    )
+
+    if config.get_value("content_store"):
+        failed = set(unpacker.failed)
+        content_store.add_many(
+            (entry.file_hash, entry.path)
+            for entry in unpacker.entries
+            if entry.path is not None and entry.name not in failed
+        )
+
+    # Every file is checked against its own hash and the list of files against
+    # the hash of the directory
+    if unpacker.failed:
+        err(
+            lang.get_string("client.hash.incorrectFiles").format(
+                len(unpacker.failed), ", ".join(unpacker.failed[:10])
+            )
+        )
+        return False
+    if get_directory_hash(unpacker.entries, parse_hash(file_hash)[0]) != file_hash:
+        err(lang.get_string("client.hash.incorrectDirectory"))
+        return False
+
+    success(lang.get_string("client.hash.correct"))
+    return True
+
+
+async def download_delta(
+    ip: str, port: int, keys: ClientKeys, file_path: Path, file_hash: str
+) -> bool:
+    """
+    Updates an older copy of the file instead of downloading it whole. The
+    server only sends the data the copy lacks, the new version is rebuilt into
+    a temporary file that replaces the copy once its hash is correct.
+
+    Args:
+        ip (str): IP address of server
+        port (int): port of server
+        keys (ClientKeys): keys offered to server
+        file_path (Path): path to the older copy
+        file_hash (str): hash string of file
+
+    Returns:
+        bool: True if the file was updated, False if the server can't send a
+            delta or it failed
+    """
+    info(lang.get_string("client.info.computingSignatures"))
+    block_size = get_block_size(os.path.getsize(file_path))
+    signatures = await asyncio.get_running_loop().run_in_executor(
+        None, compute_signatures, file_path, block_size
+    )
+
+    temp_path = file_path.with_name(file_path.name + ".delta")
+    hasher = StreamHasher.from_hash(file_hash)
+
+    try:
+        session = await open_session(
+            ip, port, keys, transport=TRANSPORT_DELTA, file_id=file_hash
+        )
+        try:
+            if session.transport != TRANSPORT_DELTA:
+                return False  # server can't send deltas
+            check_file_hash(session, file_hash)
+
+            info(lang.get_string("client.info.deltaUpdating"))
+            print(ColorEnum.SUCCESS, end="", flush=True)
+            with (
+                open(file_path, "rb") as base,
+                open(temp_path, "wb") as target,
+                create_progress_bar(
+                    total=session.file_size,
+                    unit="B",
+                    unit_scale=True,
+                    desc=file_path.name,
+                ) as progress_bar,
+            ):
+                written = await DeltaReceiver().receive(
+                    session.reader,
+                    session.writer,
+                    session.aes_key,
+                    base,
+                    signatures,
+                    block_size,
+                    HashingWriter(target, hasher),
+                    on_progress=progress_bar.update,
+                )
+        finally:
+            session.writer.close()
+            await session.writer.wait_closed()
+
+        matches = (
+            written == session.file_size
+            and hasher.hexdigest() == parse_hash(file_hash)[2]
         )
+    except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+        matches = False
+
+    if not matches:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+    os.replace(temp_path, file_path)
+    success(lang.get_string("client.info.fileReceived"))
+    success(lang.get_string("client.hash.correct"))
+    if config.get_value("content_store"):
+        content_store.add(file_hash, file_path)
+    return True
+
+
+async def restore_from_store(file_path: Path, file_hash: str) -> bool:
+    """
+    Places a file the client already has under another name at file_path,
+    without connecting to the server.
+
+    Args:
+        file_path (Path): path to download file to
+        file_hash (str): hash string of file
+
+    Returns:
+        bool: True if the file was restored
+    """
+    source = content_store.find(file_hash)
+    if source is None:
+        return False
+    if source == file_path.resolve():
+        return True
+
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            place_copy,
+            source,
+            file_path,
+            config.get_value("content_store_hardlinks"),
+        )
+    except OSError:
+        return False
+
+    content_store.add(file_hash, file_path)
+    success(lang.get_string("client.info.restoredFromStore").format(source))
+    return True
+
+
+async def race_addresses(
+    addresses: Sequence[str], port: int, file_hash: str, delay: float
+) -> Optional[str]:
+    """
+    Connects to every address of a server with staggered starts, Happy Eyeballs
+    style, and picks the one whose handshake finishes first. Every attempt asks
+    for the file, so an address of some other machine never wins.
+
+    Args:
+        addresses (Sequence[str]): IP addresses of server, most likely first
+        port (int): port of server
+        file_hash (str): hash string of file to download
+        delay (float): seconds between the starts of two attempts, the next one
+            also starts as soon as one fails
+
+    Returns:
+        Optional[str]: fastest address or None if none of them works
+    """
+
+    async def attempt(address: str) -> str:
+        # Own keys, so a v1 fallback on one address doesn't affect the others
+        keys = ClientKeys(config.get_value("key_exchange"))
+        session = await open_session(
+            address, port, keys, ByteRange(0, 0), file_id=file_hash
+        )
+        try:
+            check_file_hash(session, file_hash)
+        finally:
+            session.writer.close()
+        return address
+
+    waiting = deque(addresses)
+    pending: set[asyncio.Task[str]] = set()
+    try:
+        while waiting or pending:
+            if waiting:
+                pending.add(asyncio.create_task(attempt(waiting.popleft())))
+
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=delay if waiting else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def pick_address(
+    ip: str, addresses: Sequence[str], port: int, file_hash: str
+) -> str:
+    """
+    Picks the fastest address of a server by racing connections to all of them.
+
+    Args:
+        ip (str): main IP address of server
+        addresses (Sequence[str]): other IP addresses of server
+        port (int): port of server
+        file_hash (str): hash string of file to download
+
+    Returns:
+        str: fastest address, ip if there's nothing to pick from or none works
+    """
+    candidates = list(dict.fromkeys([*addresses, ip]))
+    if len(candidates) < 2:
+        return ip
+
+    info(lang.get_string("client.info.racingAddresses").format(len(candidates)))
+    fastest = await race_addresses(
+        candidates,
+        port,
+        file_hash,
+        config.get_value("connection_race_delay_ms") / 1000,
+    )
+    if fastest is None:
+        return ip  # errors are reported by the download itself
+
+    info(lang.get_string("client.info.pickedAddress").format(fastest))
+    return fastest
+
+
+async def download_stream(
+    ip: str, port: int, keys: ClientKeys, file_hash: str, target: Writable
+) -> bool:
+    """
+    Receives a stream or a whole file as chunks of unknown total length, so it
+    can go straight to a pipe.
+
+    Args:
+        ip (str): IP address of server
+        port (int): port of server
+        keys (ClientKeys): keys offered to server
+        file_hash (str): stream id or hash string of file
+        target (Writable): writer for the data, e.g. stdout
+
+    Returns:
+        bool: True if everything was received and the digest is correct
+    """
+    session = await open_session(
+        ip, port, keys, transport=TRANSPORT_CHUNKED, file_id=file_hash
+    )
+    try:
+        if session.transport != TRANSPORT_CHUNKED:
+            err(lang.get_string("client.error.streamingNotSupported"))
+            return False
+        check_file_hash(session, file_hash)
+
+        hasher = get_stream_hasher(file_hash)
+        with create_progress_bar(
+            total=None if is_stream_id(file_hash) else session.file_size,
+            unit="B",
+            unit_scale=True,
+            desc=parse_hash(file_hash)[2][:16],
+        ) as progress_bar:
+            await ChunkedReceiver(session.frame_size).receive(
+                session.reader,
+                session.aes_key,
+                target,
+                hasher,
+                on_progress=progress_bar.update,
+            )
+    except StreamDigestError:
+        err(lang.get_string("client.hash.incorrect"))
+        return False
+    finally:
+        session.writer.close()
+        await session.writer.wait_closed()
+
+    # Digest of a file also has to match the key, a stream is only known now
+    digest = format_hash(hasher.hexdigest(), hasher.algorithm, hasher.mode)
+    if not is_stream_id(file_hash) and hasher.hexdigest() != parse_hash(file_hash)[2]:
+        err(lang.get_string("client.hash.incorrect"))
+        return False
+
+    success(lang.get_string("client.info.streamReceived").format(digest))
+    return True
+
+
+async def stream_to(
+    ip: str,
+    port: int,
+    file_hash: str,
+    target: Writable,
+    addresses: Sequence[str] = (),
+) -> bool:
+    """
+    Downloads a stream or a file into target in a single pass, e.g. to stdout.
+
+    Args:
+        ip (str): IP address of server
+        port (int): port of server
+        file_hash (str): stream id or hash string of file
+        target (Writable): writer for the data
+        addresses (Sequence[str]): other IP addresses of the same server
+
+    Returns:
+        bool: True if everything was received and the digest is correct
+    """
+    if is_directory_hash(file_hash):
+        err(lang.get_string("client.error.directoryOutput"))
+        return False
+
+    try:
+        ip = await pick_address(ip, addresses, port, file_hash)
+        keys = ClientKeys(config.get_value("key_exchange"))
+        return await download_stream(ip, port, keys, file_hash, target)
+    except FileChangedError:
+        err(lang.get_string("client.error.fileChanged"))
+    except UnknownFileError:
+        err(lang.get_string("client.error.fileNotShared"))
     except ValueError:
         err(lang.get_string("client.error.invalidEncryptionKey"))
-        return
+    except (asyncio.IncompleteReadError, ConnectionError, CorruptedFrameError):
+        err(lang.get_string("client.error.downloadInterrupted"))
+    return False
 
-    # Getting total size of file from server
-    file_size_data = await reader.read(8)
-    file_size = int.from_bytes(file_size_data, "big")
 
-    # Creating decryptor
-    decryptor = create_aes_cipher(aes_key).decryptor()
+async def connect(
+    ip: str,
+    port: int,
+    filename: str,
+    file_hash: str,
+    connections: Optional[int] = None,
+    mirrors: Sequence[tuple[str, int]] = (),
+    addresses: Sequence[str] = (),
+) -> bool:
+    """
+    Establishes connection to server.
+    File is downloaded into a .part file next to its final path and renamed once
+    complete. An interrupted download resumes from the blocks already on disk.
 
-    # Creating file path
+    Args:
+        ip (str): IP address of server
+        port (int): port of server
+        filename (str): name of file to download
+        file_hash (str): hash of file to download
+        connections (int, optional): number of parallel connections,
+            parallel_connections from config if None
+        mirrors (Sequence[tuple[str, int]]): IP addresses and ports of other
+            servers sharing the file, downloaded from at the same time
+        addresses (Sequence[str]): other IP addresses of the same server, the
+            fastest of them and ip is used
+
+    Returns:
+        bool: True if the file is in place and its hash is correct
+    """
+    connection_count: int = (
+        config.get_value("parallel_connections") if connections is None else connections
+    )
+
+    # RSA keys are only generated if the server can't do X25519
+    keys = ClientKeys(config.get_value("key_exchange"))
+
+    if is_directory_hash(file_hash):
+        ip = await pick_address(ip, addresses, port, file_hash)
+        return await download_directory(ip, port, keys, filename, file_hash)
+
+    # Creating file paths
     file_path = get_download_path(filename)
+    part_path = get_part_path(file_path)
 
-    # Saving file
-    await download_and_decrypt_file(reader, file_path, decryptor, file_size)
+    if is_stream_id(file_hash):
+        # Streams can't be resumed or found locally, they're received whole
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+        try:
+            with open(part_path, "wb") as f:
+                received = await stream_to(ip, port, file_hash, f, addresses)
+            if received:
+                os.replace(part_path, file_path)
+                success(lang.get_string("client.info.fileSaved"))
+            return received
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
 
-    success(lang.get_string("client.info.fileReceived"))
-    await validate_file(file_path, file_hash)
+    # Same content downloaded before under any name is copied locally
+    if config.get_value("content_store") and await restore_from_store(
+        file_path, file_hash
+    ):
+        return True
+
+    ip = await pick_address(ip, addresses, port, file_hash)
+
+    # Hashing a single stream while it's received, unless asked to re-read the file
+    hasher = (
+        None
+        if config.get_value("verify_from_disk")
+        else StreamHasher.from_hash(file_hash)
+    )
+
+    # Checking for a previous attempt
+    journal = DownloadJournal.load(part_path, file_hash)
+    if journal is not None:
+        info(lang.get_string("client.info.checkingPartialFile"))
+        committed = journal.verify()
+        info(
+            lang.get_string("client.info.resuming").format(
+                committed * 100 // max(journal.file_size, 1)
+            )
+        )
+
+    try:
+        # Updating an older copy by fetching only what it lacks
+        if (
+            config.get_value("delta_transfer")
+            and journal is None
+            and file_path.is_file()
+        ):
+            if await download_delta(ip, port, keys, file_path, file_hash):
+                return True
+            warn(lang.get_string("client.warning.deltaFailed"))
+
+        ranged_journal = None
+        if mirrors:
+            # Fetching chunks from every server sharing the file at once
+            hasher = None
+            ranged_journal = await download_swarm(
+                list(dict.fromkeys([(ip, port), *mirrors])),
+                file_hash,
+                part_path,
+                journal,
+                connection_count,
+            )
+
+            if ranged_journal is None:
+                # No server understands range requests, using a single stream
+                warn(lang.get_string("client.warning.rangesNotSupported"))
+        elif journal is not None or connection_count > 1:
+            # Stripes and resumed blocks arrive out of order, file is hashed from disk
+            hasher = None
+            ranged_journal = await download_ranges(
+                ip,
+                port,
+                keys,
+                file_hash,
+                part_path,
+                journal,
+                connection_count,
+            )
+
+            if ranged_journal is None:
+                # Server doesn't understand range requests, using a single stream
+                warn(lang.get_string("client.warning.rangesNotSupported"))
+
+        if ranged_journal is None:
+            session = await open_session(ip, port, keys, file_id=file_hash)
+            try:
+                check_file_hash(session, file_hash)
+            except FileChangedError:
+                session.writer.close()
+                raise
+            ranged_journal = DownloadJournal(part_path, file_hash, session.file_size)
+
+            # Saving file
+            try:
+                await download_and_decrypt_file(
+                    session, part_path, ranged_journal, hasher
+                )
+            except CorruptedFrameError as e:
+                warn(lang.get_string("client.warning.corruptedFrame").format(e.offset))
+                corrupted = True
+            else:
+                corrupted = False
+            finally:
+                ranged_journal.save()
+                session.writer.close()
+                await session.writer.wait_closed()
+
+            if corrupted:
+                # Blocks before the bad frame are kept, fetching the rest again
+                hasher = None
+                ranged_journal = await download_ranges(
+                    ip,
+                    port,
+                    keys,
+                    file_hash,
+                    part_path,
+                    ranged_journal,
+                    connection_count,
+                )
+                if ranged_journal is None:
+                    err(lang.get_string("client.error.downloadInterrupted"))
+                    return False
+
+        journal = ranged_journal
+    except FileChangedError:
+        err(lang.get_string("client.error.fileChanged"))
+        return False
+    except UnknownFileError:
+        err(lang.get_string("client.error.fileNotShared"))
+        return False
+    except ValueError:
+        err(lang.get_string("client.error.invalidEncryptionKey"))
+        return False
+    except (asyncio.IncompleteReadError, ConnectionError, CorruptedFrameError):
+        err(lang.get_string("client.error.downloadInterrupted"))
+        return False
 
-    writer.close()
-    await writer.wait_closed()
+    if not journal.is_complete():
+        err(lang.get_string("client.error.downloadInterrupted"))
+        return False
 
+    # Download is complete, moving it to its final path
+    os.replace(part_path, file_path)
+    journal.remove()
 
-async def validate_file(file_path: PathLike[str], file_hash: str) -> None:
+    success(lang.get_string("client.info.fileReceived"))
+    return await validate_file(
+        file_path, file_hash, None if hasher is None else hasher.hexdigest()
+    )
+
+
+async def validate_file(
+    file_path: PathLike[str], file_hash: str, digest: Optional[str] = None
+) -> bool:
     """
     Validates file hash.
 
     Args:
         file_path (PathLike[str]): path to file to validate
-        file_hash (str): file hash
+        file_hash (str): file hash, optionally prefixed with algorithm and mode
+        digest (str, optional): digest computed while receiving the file,
+            file is re-read from disk if None
 
     Returns:
-        None
+        bool: True if the hash is correct
     """
     # Checking file hash
-    info(lang.get_string("client.hash.checking"))
-    if get_file_hash(file_path) == file_hash:
-        success(lang.get_string("client.hash.correct"))
+    if digest is not None:
+        matches = digest == parse_hash(file_hash)[2]
     else:
-        err(lang.get_string("client.hash.incorrect"))
-        await handle_file_deletion(file_path)
+        info(lang.get_string("client.hash.checking"))
+        matches = file_hash_matches(file_path, file_hash)
+
+    if matches:
+        success(lang.get_string("client.hash.correct"))
+        if config.get_value("content_store"):
+            content_store.add(file_hash, file_path)
+        return True
+
+    err(lang.get_string("client.hash.incorrect"))
+    await handle_file_deletion(file_path)
+    return False
 
 
 async def handle_file_deletion(file_path: PathLike[str]) -> bool | None:
@@ -226,9 +1628,12 @@ async def handle_file_deletion(file_path: PathLike[str]) -> bool | None:
     """
     try:
         if os.path.exists(file_path):
-            if await questionary.confirm(
-                lang.get_string("client.choose.delete")
-            ).ask_async():
+            # Nobody is asked during batch downloads, the file is downloaded again
+            if captured_messages.get() is not None or (
+                await questionary.confirm(
+                    lang.get_string("client.choose.delete")
+                ).ask_async()
+            ):
                 os.remove(file_path)
                 success(lang.get_string("client.info.fileDeleted"))
                 return True
@@ -261,29 +1666,45 @@ async def client() -> None:
     if not server_key:
         return
 
-    # Parsing server key
+    # Parsing server key, other addresses of the server come before the main one
     try:
-        ip, port, filename, file_hash = server_key.split(":")
+        hosts, port, filename, file_hash = server_key.split(":")
+        *addresses, ip = hosts.split(",")
         port = int(port)  # converting port to int
     except ValueError:
         err(lang.get_string("client.error.invalidKey"))
         return
 
+    # Directories are unpacked over whatever is already there
+    if is_directory_hash(file_hash):
+        await connect(ip, port, filename, file_hash, addresses=addresses)
+        return
+
     # Checking if client already have that file
     file_path = get_download_path(filename)
-    if os.path.exists(file_path) and get_file_hash(file_path) == file_hash:
+    if (
+        not is_stream_id(file_hash)
+        and os.path.exists(file_path)
+        and file_hash_matches(file_path, file_hash)
+    ):
         warn(lang.get_string("client.warning.fileAlreadyExists"))
+        if config.get_value("content_store"):
+            content_store.add(file_hash, file_path)
         if not await handle_file_deletion(file_path):
             return  # if file was not deleted don't download it again
 
     elif os.path.exists(file_path):
         warn(lang.get_string("client.warning.fileWithSameNameExists"))
-        if not await handle_file_deletion(file_path):
+        # Older copies are updated in place with delta transfers, streams
+        # always replace them
+        if (
+            is_stream_id(file_hash) or not config.get_value("delta_transfer")
+        ) and not await handle_file_deletion(file_path):
             return
 
-    await connect(ip, port, filename, file_hash)
+    await connect(ip, port, filename, file_hash, addresses=addresses)
 
 
 if __name__ == "__main__":
-    asyncio.run(client())
+    run(client(), config.get_value("use_uvloop"))
     input(lang.get_string("main.enterToExit"))
@@ -0,0 +1,276 @@
+import asyncio
+import json
+import random
+import time
+from os import PathLike
+from pathlib import Path
+from typing import Iterable, NamedTuple, Optional
+
+from tqdm import tqdm
+
+from zapfiles.cli import ColorEnum, captured_messages, err, success
+from zapfiles.client import connect, progress_hook
+from zapfiles.core.hash import DEFAULT_ALGORITHM, format_hash
+from zapfiles.core.localization import lang
+
+ZAPFILE_SUFFIX = ".zapfile"
+
+# Waits between attempts of a failed download, doubling up to the maximum
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 30.0
+
+# Shared progress display is redrawn at most this often
+PROGRESS_INTERVAL = 0.5
+
+
+class BatchItem(NamedTuple):
+    host: str
+    port: int
+    filename: str
+    # Hash string created by format_hash
+    file_hash: str
+    # Other servers sharing the file
+    mirrors: tuple[tuple[str, int], ...] = ()
+    # Other addresses of the same server
+    addresses: tuple[str, ...] = ()
+
+
+class BatchResult(NamedTuple):
+    item: BatchItem
+    ok: bool
+    attempts: int
+    # Last error message of a failed download
+    error: Optional[str] = None
+
+
+def load_zapfile(file_path: PathLike[str]) -> BatchItem:
+    """
+    Args:
+        file_path (PathLike[str]): path to zapfile
+
+    Returns:
+        BatchItem: download described by zapfile
+
+    Raises:
+        OSError: If zapfile can't be read.
+        ValueError: If zapfile is malformed.
+        KeyError: If a mirror has no host or port.
+    """
+    with open(file_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    return BatchItem(
+        data.get("host", "localhost"),
+        int(data.get("port", 8888)),
+        data.get("filename", "filename"),
+        format_hash(
+            data.get("hash", "hash"),
+            data.get("hash_algorithm", DEFAULT_ALGORITHM),
+            data.get("hash_mode", "flat"),
+        ),
+        tuple(
+            (mirror["host"], int(mirror["port"])) for mirror in data.get("mirrors", [])
+        ),
+        tuple(str(address) for address in data.get("addresses", [])),
+    )
+
+
+def parse_server_key(server_key: str) -> BatchItem:
+    """
+    Args:
+        server_key (str): server key, other addresses of the server come before
+            the main one
+
+    Returns:
+        BatchItem: download described by server key
+
+    Raises:
+        ValueError: If server key is malformed.
+    """
+    hosts, port, filename, file_hash = server_key.split(":")
+    *addresses, host = hosts.split(",")
+    return BatchItem(host, int(port), filename, file_hash, addresses=tuple(addresses))
+
+
+def collect_zapfiles(inputs: Iterable[PathLike[str]]) -> list[Path]:
+    """
+    Expands inputs into zapfile paths. An input is a zapfile, a directory with
+    zapfiles or a list file with a path on every line.
+
+    Args:
+        inputs (Iterable[PathLike[str]]): paths given by user
+
+    Returns:
+        list[Path]: zapfiles without duplicates, in the order given
+    """
+    found: dict[Path, None] = {}
+
+    for path in map(Path, inputs):
+        if path.is_dir():
+            paths = sorted(path.glob(f"*{ZAPFILE_SUFFIX}"))
+        elif path.suffix == ZAPFILE_SUFFIX:
+            paths = [path]
+        else:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    lines = [line.strip() for line in f]
+            except (OSError, UnicodeDecodeError):
+                lines = []
+            # Relative paths in a list file are relative to it
+            paths = [path.parent / line for line in lines if line]
+
+        for zapfile in paths:
+            found.setdefault(zapfile, None)
+
+    return list(found)
+
+
+async def download_batch(
+    items: list[BatchItem],
+    concurrency: int,
+    per_host: int,
+    retries: int,
+) -> tuple[list[BatchResult], int]:
+    """
+    Downloads items concurrently with one shared progress display. A failed
+    download waits before its next attempt without holding its slots.
+
+    Args:
+        items (list[BatchItem]): downloads
+        concurrency (int): maximum number of downloads at once
+        per_host (int): maximum number of downloads from one server at once
+        retries (int): number of extra attempts of a failed download
+
+    Returns:
+        tuple[list[BatchResult], int]: results in the order of items and the
+            number of bytes received
+    """
+    slots = asyncio.Semaphore(max(concurrency, 1))
+    host_slots: dict[tuple[str, int], asyncio.Semaphore] = {}
+    succeeded = failed = received = 0
+
+    def get_postfix() -> dict[str, str]:
+        return {
+            lang.get_string("batch.progress.done"): f"{succeeded}/{len(items)}",
+            lang.get_string("batch.progress.failed"): str(failed),
+        }
+
+    progress_bar = tqdm(
+        unit="B",
+        unit_scale=True,
+        mininterval=PROGRESS_INTERVAL,
+        postfix=get_postfix(),
+    )
+
+    def on_progress(size: int) -> None:
+        nonlocal received
+        received += size
+        progress_bar.update(size)
+
+    async def download(item: BatchItem) -> BatchResult:
+        nonlocal succeeded, failed
+        host_slot = host_slots.setdefault(
+            (item.host, item.port), asyncio.Semaphore(max(per_host, 1))
+        )
+        error = None
+
+        for attempt in range(1, retries + 2):
+            # Every attempt has its own messages, the last error is reported
+            messages: list[tuple[ColorEnum, str]] = []
+            captured_messages.set(messages)
+            progress_hook.set(on_progress)
+
+            async with host_slot, slots:
+                try:
+                    ok = await connect(
+                        item.host,
+                        item.port,
+                        item.filename,
+                        item.file_hash,
+                        mirrors=item.mirrors,
+                        addresses=item.addresses,
+                    )
+                except Exception as e:
+                    ok = False
+                    messages.append((ColorEnum.ERROR, str(e)))
+
+            if ok:
+                succeeded += 1
+                progress_bar.set_postfix(get_postfix(), refresh=False)
+                return BatchResult(item, True, attempt)
+
+            error = next(
+                (msg for level, msg in reversed(messages) if level == ColorEnum.ERROR),
+                None,
+            )
+            if attempt <= retries:
+                delay = min(RETRY_DELAY * 2 ** (attempt - 1), MAX_RETRY_DELAY)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
+        failed += 1
+        progress_bar.set_postfix(get_postfix(), refresh=False)
+        return BatchResult(item, False, retries + 1, error)
+
+    with progress_bar:
+        # Tasks copy the context, so hooks set by one download don't leak
+        results = await asyncio.gather(*(download(item) for item in items))
+    return list(results), received
+
+
+async def batch_client(
+    inputs: Iterable[PathLike[str]],
+    concurrency: int,
+    per_host: int,
+    retries: int,
+) -> int:
+    """
+    Downloads every zapfile found in inputs and prints a summary.
+
+    Args:
+        inputs (Iterable[PathLike[str]]): zapfiles, directories and list files
+        concurrency (int): maximum number of downloads at once
+        per_host (int): maximum number of downloads from one server at once
+        retries (int): number of extra attempts of a failed download
+
+    Returns:
+        int: number of failed downloads
+    """
+    items = []
+    failed = 0
+    for zapfile in collect_zapfiles(inputs):
+        try:
+            items.append(load_zapfile(zapfile))
+        except (OSError, ValueError, TypeError, KeyError, AttributeError):
+            err(lang.get_string("batch.error.invalidZapfile").format(zapfile))
+            failed += 1
+
+    if not items:
+        err(lang.get_string("batch.error.noZapfiles"))
+        return max(failed, 1)
+
+    started = time.monotonic()
+    results, received = await download_batch(items, concurrency, per_host, retries)
+    elapsed = max(time.monotonic() - started, 1e-6)
+
+    for result in results:
+        if not result.ok:
+            failed += 1
+            err(
+                lang.get_string("batch.error.failed").format(
+                    result.item.filename,
+                    result.attempts,
+                    result.error or lang.get_string("batch.error.unknown"),
+                )
+            )
+
+    succeeded = sum(result.ok for result in results)
+    success(
+        lang.get_string("batch.info.summary").format(
+            succeeded,
+            len(results),
+            tqdm.format_sizeof(received, "B"),
+            elapsed,
+            tqdm.format_sizeof(received / elapsed, "B"),
+        )
+    )
+    return failed
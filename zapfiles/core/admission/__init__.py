@@ -0,0 +1,222 @@
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Optional, Sequence
+
+# Queued clients hear from the server at least this often, even if their
+# position stays the same
+QUEUE_UPDATE_INTERVAL = 5.0
+
+# Idle buckets fill up to this many seconds of their rate
+BURST_SECONDS = 0.25
+
+
+class TokenBucket:
+    """
+    Paces data to rate bytes per second.
+
+    Callers wait in a single FIFO line and each takes only what it's about to
+    send, so connections sharing a bucket get turns one chunk at a time and an
+    equal share of the rate.
+    """
+
+    def __init__(self, rate: int, burst: Optional[int] = None):
+        """
+        Args:
+            rate (int): bytes per second
+            burst (int, optional): bytes an idle bucket can hold, a quarter of
+                a second of rate if None
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self.rate = rate
+        self.burst = burst if burst is not None else int(rate * BURST_SECONDS)
+        self._tokens = float(self.burst)
+        self._updated: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    async def consume(self, amount: int) -> None:
+        """
+        Takes amount bytes from the bucket, waiting until they are available.
+        Amounts larger than the bucket are allowed and are paid off by waiting.
+
+        Args:
+            amount (int): number of bytes
+
+        Returns:
+            None
+        """
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            if self._updated is not None:
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+            self._updated = now
+
+            self._tokens -= amount
+            if self._tokens < 0:
+                # Holding the line, nobody sends before the debt is paid
+                await asyncio.sleep(-self._tokens / self.rate)
+
+
+class RateLimiter:
+    """
+    Paces a single transfer by every bucket it is subject to, e.g. the one of
+    its client and the one of the whole server.
+    """
+
+    def __init__(self, client: str, buckets: Sequence[TokenBucket] = ()):
+        """
+        Args:
+            client (str): IP address of client
+            buckets (Sequence[TokenBucket]): buckets to take sent bytes from
+        """
+        self.client = client
+        self.buckets = tuple(buckets)
+
+    async def consume(self, amount: int) -> None:
+        """
+        Waits until amount bytes can be sent.
+
+        Args:
+            amount (int): number of bytes about to be sent
+
+        Returns:
+            None
+        """
+        for bucket in self.buckets:
+            await bucket.consume(amount)
+
+
+class _Waiter:
+    def __init__(self):
+        self.admitted = False
+        # Set whenever the queue moves
+        self.moved = asyncio.Event()
+
+
+class AdmissionControl:
+    """
+    Limits the number of transfers served at once and their bandwidth.
+
+    Transfers past max_active wait in a FIFO queue and learn their position
+    through a callback. Every admitted transfer gets a RateLimiter with the
+    bucket of its client, shared by all its connections, and the bucket of
+    the server. A limit of 0 means no limit.
+    """
+
+    def __init__(self, max_active: int = 0, client_rate: int = 0, server_rate: int = 0):
+        """
+        Args:
+            max_active (int): maximum number of transfers served at once
+            client_rate (int): bytes per second for all transfers of a client
+            server_rate (int): bytes per second for all transfers together
+        """
+        self.max_active = max_active
+        self.client_rate = client_rate
+        self.active = 0
+
+        self._waiting: deque[_Waiter] = deque()
+        self._server_bucket = TokenBucket(server_rate) if server_rate > 0 else None
+        # Bucket and number of admitted transfers of every client
+        self._client_buckets: dict[str, tuple[TokenBucket, int]] = {}
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiting)
+
+    def _has_room(self) -> bool:
+        return self.max_active <= 0 or self.active < self.max_active
+
+    async def admit(
+        self,
+        client: str,
+        on_position: Optional[Callable[[int], Awaitable[object]]] = None,
+    ) -> RateLimiter:
+        """
+        Waits for a free slot. Cancelling the wait leaves the queue.
+
+        Args:
+            client (str): IP address of client
+            on_position (Callable[[int], Awaitable[object]], optional): called
+                with the position in the queue, starting at 1, whenever it
+                changes and at least every QUEUE_UPDATE_INTERVAL seconds
+
+        Returns:
+            RateLimiter: limiter of the transfer, must be given back to release()
+        """
+        if not self._waiting and self._has_room():
+            self.active += 1
+            return self._get_limiter(client)
+
+        waiter = _Waiter()
+        self._waiting.append(waiter)
+
+        try:
+            while not waiter.admitted:
+                # Clearing first, so moves during the callback aren't missed
+                waiter.moved.clear()
+                if on_position is not None:
+                    await on_position(self._waiting.index(waiter) + 1)
+                if waiter.admitted:
+                    break
+
+                try:
+                    await asyncio.wait_for(waiter.moved.wait(), QUEUE_UPDATE_INTERVAL)
+                except TimeoutError:
+                    pass
+        except BaseException:
+            if waiter.admitted:
+                self.active -= 1
+            else:
+                self._waiting.remove(waiter)
+            self._advance()
+            raise
+
+        return self._get_limiter(client)
+
+    def release(self, limiter: RateLimiter) -> None:
+        """
+        Frees the slot of a finished transfer and admits the next one.
+
+        Args:
+            limiter (RateLimiter): limiter returned by admit()
+
+        Returns:
+            None
+        """
+        self.active -= 1
+
+        bucket, transfers = self._client_buckets.get(limiter.client, (None, 0))
+        if bucket is not None:
+            if transfers > 1:
+                self._client_buckets[limiter.client] = (bucket, transfers - 1)
+            else:
+                del self._client_buckets[limiter.client]
+
+        self._advance()
+
+    def _get_limiter(self, client: str) -> RateLimiter:
+        buckets = []
+        if self.client_rate > 0:
+            if client in self._client_buckets:
+                bucket, transfers = self._client_buckets[client]
+            else:
+                bucket, transfers = TokenBucket(self.client_rate), 0
+            self._client_buckets[client] = (bucket, transfers + 1)
+            buckets.append(bucket)
+        if self._server_bucket is not None:
+            buckets.append(self._server_bucket)
+        return RateLimiter(client, buckets)
+
+    def _advance(self) -> None:
+        while self._waiting and self._has_room():
+            waiter = self._waiting.popleft()
+            waiter.admitted = True
+            self.active += 1
+            waiter.moved.set()
+
+        # Everyone left in the queue has moved up
+        for waiter in self._waiting:
+            waiter.moved.set()
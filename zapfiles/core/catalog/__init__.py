@@ -0,0 +1,236 @@
+import asyncio
+import os
+import time
+from os import PathLike
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+from zapfiles.core.hash import (
+    DEFAULT_ALGORITHM,
+    format_hash,
+    get_file_hash,
+    hash_cache,
+)
+from zapfiles.core.persistence import get_signature
+from zapfiles.core.transfer.packing import (
+    PackedEntry,
+    get_directory_hash,
+    get_packed_size,
+)
+
+# Lookups of unknown hashes rescan the directories at most this often
+MIN_RESCAN_INTERVAL = 1.0
+
+
+class CatalogEntry(NamedTuple):
+    path: Path
+    # Path relative to the shared directory
+    name: str
+    size: int
+    digest: str
+    # Hash string created by format_hash, clients ask for files by it
+    file_hash: str
+    # Signature created by get_signature
+    signature: dict[str, int]
+
+
+class DirectoryEntry(NamedTuple):
+    path: Path
+    # Hash string created by get_directory_hash
+    file_hash: str
+    entries: list[PackedEntry]
+    packed_size: int
+
+
+class FileCatalog:
+    """
+    In-memory index of the files shared by a server, looked up by hash string.
+
+    Every file is hashed once. Rescans only hash files again once their size,
+    mtime_ns or inode change, so keeping the index fresh costs a stat per file.
+    """
+
+    def __init__(
+        self,
+        roots: Iterable[PathLike[str]],
+        algorithm: str = DEFAULT_ALGORITHM,
+        mode: str = "flat",
+    ):
+        """
+        Args:
+            roots (Iterable[PathLike[str]]): shared files and directories
+            algorithm (str): hash algorithm (default: sha256)
+            mode (str): hash mode (default: flat)
+        """
+        self.roots = [Path(root).resolve() for root in roots]
+        self.algorithm = algorithm
+        self.mode = mode
+        self._by_path: dict[Path, CatalogEntry] = {}
+        self._by_hash: dict[str, CatalogEntry] = {}
+        self._directories: dict[str, DirectoryEntry] = {}
+        self._lock = asyncio.Lock()
+        self._scanned_at = 0.0
+
+    @property
+    def directories(self) -> list[DirectoryEntry]:
+        """
+        Returns:
+            list[DirectoryEntry]: shared directories
+        """
+        return list(self._directories.values())
+
+    @property
+    def entries(self) -> list[CatalogEntry]:
+        """
+        Returns:
+            list[CatalogEntry]: shared files sorted by name
+        """
+        return sorted(self._by_path.values(), key=lambda entry: entry.name)
+
+    def _iter_files(self) -> Iterator[tuple[Path, Path, str]]:
+        for root in self.roots:
+            if root.is_file():
+                yield root, root, root.name
+                continue
+
+            for directory, _, filenames in os.walk(root):
+                for filename in filenames:
+                    path = Path(directory) / filename
+                    yield root, path, path.relative_to(root).as_posix()
+
+    def scan(self) -> None:
+        """
+        Updates the index with added, changed and removed files. Blocks while
+        new and changed files are hashed.
+
+        Returns:
+            None
+        """
+        by_path = {}
+        members: dict[Path, list[CatalogEntry]] = {}
+
+        files = list(self._iter_files())
+        # Keeping digests of every shared file, whatever the configured limit
+        hash_cache.reserve(len(files))
+
+        for root, path, name in files:
+            try:
+                stat = os.stat(path)
+                entry = self._by_path.get(path)
+                if entry is None or entry.signature != get_signature(stat):
+                    digest = get_file_hash(path, self.algorithm, mode=self.mode)
+                    entry = CatalogEntry(
+                        path,
+                        name,
+                        stat.st_size,
+                        digest,
+                        format_hash(digest, self.algorithm, self.mode),
+                        get_signature(stat),
+                    )
+            except OSError:
+                continue  # removed or unreadable, skipping it until the next scan
+            by_path[path] = entry
+            if root != path:
+                members.setdefault(root, []).append(entry)
+        hash_cache.flush()
+
+        # Shared directories can also be downloaded whole as a packed stream
+        directories = {}
+        for root, files in members.items():
+            packed = [
+                PackedEntry(entry.name, entry.size, entry.file_hash, entry.path)
+                for entry in sorted(files, key=lambda entry: entry.name)
+            ]
+            directory = DirectoryEntry(
+                root,
+                get_directory_hash(packed, self.algorithm),
+                packed,
+                get_packed_size(packed),
+            )
+            directories[directory.file_hash] = directory
+
+        # Swapping whole indexes, lookups never see a half-built one
+        self._by_path = by_path
+        self._by_hash = {entry.file_hash: entry for entry in by_path.values()}
+        self._directories = directories
+        self._scanned_at = time.monotonic()
+
+    async def refresh(self) -> None:
+        """
+        Rescans the shared files in an executor. Concurrent calls share a scan.
+
+        Returns:
+            None
+        """
+        scanned_at = self._scanned_at
+        async with self._lock:
+            if self._scanned_at != scanned_at:
+                return  # another call has just scanned
+            await asyncio.get_running_loop().run_in_executor(None, self.scan)
+
+    async def refresh_periodically(self, interval: float) -> None:
+        """
+        Args:
+            interval (float): seconds between rescans
+
+        Returns:
+            None
+        """
+        while True:
+            await asyncio.sleep(interval)
+            await self.refresh()
+
+    @staticmethod
+    def _is_current(entry: CatalogEntry) -> bool:
+        try:
+            return get_signature(os.stat(entry.path)) == entry.signature
+        except OSError:
+            return False
+
+    def _find(self, file_hash: Optional[str]) -> Optional[CatalogEntry]:
+        if file_hash is None:
+            entries = list(self._by_path.values())
+            return entries[0] if len(entries) == 1 else None
+        return self._by_hash.get(file_hash)
+
+    async def get(self, file_hash: Optional[str]) -> Optional[CatalogEntry]:
+        """
+        Finds shared file by hash string. Unknown and changed files trigger a
+        rescan, so files added after startup are found too.
+
+        Args:
+            file_hash (str, optional): hash string from the server key, None for
+                clients that can't ask for a file
+
+        Returns:
+            Optional[CatalogEntry]: file or None if it isn't shared, or None was
+                asked for while several files are shared
+        """
+        entry = self._find(file_hash)
+        if entry is not None and self._is_current(entry):
+            return entry
+
+        if time.monotonic() - self._scanned_at >= MIN_RESCAN_INTERVAL:
+            await self.refresh()
+
+        entry = self._find(file_hash)
+        return entry if entry is not None and self._is_current(entry) else None
+
+    async def get_directory(self, file_hash: str) -> Optional[DirectoryEntry]:
+        """
+        Finds shared directory by hash string. Unknown hashes trigger a rescan,
+        a directory gets a new hash once any of its files changes.
+
+        Args:
+            file_hash (str): hash string from the server key
+
+        Returns:
+            Optional[DirectoryEntry]: directory or None if it isn't shared
+        """
+        directory = self._directories.get(file_hash)
+        if directory is None and (
+            time.monotonic() - self._scanned_at >= MIN_RESCAN_INTERVAL
+        ):
+            await self.refresh()
+            directory = self._directories.get(file_hash)
+        return directory
@@ -0,0 +1,219 @@
+import lzma
+import math
+import os
+import zlib
+from collections import Counter
+from os import PathLike
+from pathlib import Path
+from typing import Optional, Sequence
+
+# Formats that are compressed already, another pass only costs CPU
+COMPRESSED_EXTENSIONS = frozenset(
+    (
+        ".7z .aac .apk .avi .avif .br .bz2 .cab .deb .docx .epub .flac .gif .gz "
+        ".heic .jar .jpeg .jpg .lz .lz4 .lzma .m4a .m4v .mkv .mov .mp3 .mp4 .odt "
+        ".ogg .opus .png .pptx .rar .rpm .tgz .txz .webm .webp .whl .xlsx .xz "
+        ".zip .zst"
+    ).split()
+)
+
+# Files are judged by a few samples spread over them
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_COUNT = 4
+
+# Bits per byte above which data isn't worth compressing, random data is close to 8
+MAX_ENTROPY = 7.5
+
+# Frames that shrink less than this are sent as they are
+MIN_SAVING = 0.05
+
+
+class Codec:
+    """
+    Compresses frames of the framed transport. Every frame is compressed on
+    its own, so frames stay independent and offsets stay in uncompressed bytes.
+    """
+
+    name = ""
+
+    def compress(self, data: bytes) -> bytes:
+        """
+        Args:
+            data (bytes): frame
+
+        Returns:
+            bytes: compressed frame
+        """
+        raise NotImplementedError
+
+    def decompress(self, data: bytes, size: int) -> bytes:
+        """
+        Args:
+            data (bytes): compressed frame
+            size (int): size of the frame
+
+        Returns:
+            bytes: frame
+
+        Raises:
+            ValueError: If data doesn't decompress to exactly size bytes.
+        """
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+    """
+    Fast codec for links slower than the sender's CPU.
+    """
+
+    name = "zlib"
+
+    def __init__(self, level: int = 1):
+        """
+        Args:
+            level (int): compression level from 1 to 9
+        """
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = zlib.compressobj(self.level)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes, size: int) -> bytes:
+        decompressor = zlib.decompressobj()
+        try:
+            # Never inflating past the frame size, whatever the data says
+            frame = decompressor.decompress(data, size)
+        except zlib.error as e:
+            raise ValueError(f"Invalid zlib frame: {e}") from None
+        if len(frame) != size or not decompressor.eof:
+            raise ValueError("zlib frame doesn't match its size")
+        return frame
+
+
+class LzmaCodec(Codec):
+    """
+    Slow codec with a better ratio for slow links.
+    """
+
+    name = "lzma"
+
+    def __init__(self, preset: int = 1):
+        """
+        Args:
+            preset (int): compression preset from 0 to 9
+        """
+        self.preset = preset
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = lzma.LZMACompressor(lzma.FORMAT_XZ, preset=self.preset)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes, size: int) -> bytes:
+        decompressor = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+        try:
+            frame = decompressor.decompress(data, size)
+        except lzma.LZMAError as e:
+            raise ValueError(f"Invalid lzma frame: {e}") from None
+        if len(frame) != size or not decompressor.eof:
+            raise ValueError("lzma frame doesn't match its size")
+        return frame
+
+
+codecs: dict[str, Codec] = {}
+
+
+def register_codec(codec: Codec) -> None:
+    """
+    Makes codec available for negotiation under its name.
+
+    Args:
+        codec (Codec): codec
+
+    Returns:
+        None
+    """
+    codecs[codec.name] = codec
+
+
+register_codec(ZlibCodec())
+register_codec(LzmaCodec())
+
+
+def get_codec(name: Optional[str]) -> Optional[Codec]:
+    """
+    Args:
+        name (str, optional): codec name
+
+    Returns:
+        Optional[Codec]: codec or None if name is None or unknown
+    """
+    return None if name is None else codecs.get(name)
+
+
+def get_entropy(data: bytes) -> float:
+    """
+    Args:
+        data (bytes): sample
+
+    Returns:
+        float: Shannon entropy in bits per byte
+    """
+    if not data:
+        return 0.0
+
+    size = len(data)
+    return -sum(
+        count / size * math.log2(count / size) for count in Counter(data).values()
+    )
+
+
+def is_compressible(file_path: PathLike[str]) -> bool:
+    """
+    Guesses whether compressing file saves anything, by its extension and the
+    entropy of a few samples.
+
+    Args:
+        file_path (PathLike[str]): path to file
+
+    Returns:
+        bool: True if file is worth compressing
+    """
+    if Path(file_path).suffix.lower() in COMPRESSED_EXTENSIONS:
+        return False
+
+    try:
+        with open(file_path, "rb") as f:
+            file_size = os.fstat(f.fileno()).st_size
+            step = max((file_size - SAMPLE_SIZE) // max(SAMPLE_COUNT - 1, 1), 1)
+
+            samples = []
+            for offset in range(0, max(file_size - SAMPLE_SIZE, 0) + 1, step):
+                f.seek(offset)
+                samples.append(f.read(SAMPLE_SIZE))
+                if len(samples) == SAMPLE_COUNT:
+                    break
+    except OSError:
+        return False
+
+    sample = b"".join(samples)
+    return bool(sample) and get_entropy(sample) <= MAX_ENTROPY
+
+
+def pick_codec(file_path: PathLike[str], offered: Sequence[str]) -> Optional[Codec]:
+    """
+    Picks codec for a transfer of file.
+
+    Args:
+        file_path (PathLike[str]): path to file
+        offered (Sequence[str]): codecs the client can decode, most preferred
+            first
+
+    Returns:
+        Optional[Codec]: first offered codec known here or None if there is
+            none or file isn't worth compressing
+    """
+    codec = next((codecs[name] for name in offered if name in codecs), None)
+    if codec is None or not is_compressible(file_path):
+        return None
+    return codec
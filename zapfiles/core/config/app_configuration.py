@@ -1,4 +1,5 @@
 import os
+import sys
 from getpass import getuser
 from os import PathLike
 from pathlib import Path
@@ -21,6 +22,41 @@ DEFAULT_CONFIG = {
     "clear_mode": "ASCII",
     "downloads_path": str(get_default_download_directory()),
     "enable_tips": True,
+    "transfer_chunk_size": 1024 * 1024,
+    "send_high_water_mark": 4 * 1024 * 1024,
+    "read_ahead_depth": 4,
+    "send_use_mmap": False,
+    "server_transport": "streams",
+    "use_uvloop": True,
+    "max_active_transfers": 0,
+    "client_rate_limit": 0,
+    "server_rate_limit": 0,
+    "receive_queue_depth": 4,
+    "parallel_connections": 1,
+    "hash_cache": True,
+    "hash_cache_max_entries": 1024,
+    "hash_algorithm": "sha256",
+    "hash_mode": "flat",
+    "hash_use_mmap": False,
+    "verify_from_disk": False,
+    "ciphertext_cache": False,
+    "ciphertext_cache_max_size": 4 * 1024 * 1024 * 1024,
+    "ktls": False,
+    "framed_transfer": False,
+    "key_exchange": "x25519",
+    "session_tickets": False,
+    "session_ticket_lifetime": 12 * 60 * 60,
+    "catalog_refresh_interval": 30,
+    "delta_transfer": False,
+    "content_store": True,
+    "content_store_hardlinks": False,
+    "batch_concurrency": 4,
+    "batch_per_host": 2,
+    "batch_retries": 3,
+    "zapfile_mirrors": [],
+    "advertise_local_addresses": True,
+    "connection_race_delay_ms": 250,
+    "compression": "none",
 }
 
 
@@ -32,8 +68,10 @@ class Configuration(BaseConfig):
     def _check_downloads_path(self):
         downloads_path = Path(self.get_value("downloads_path"))
         if not downloads_path.exists() or not downloads_path.is_dir():
+            # Not on stdout, it may carry a download
             print(
-                "Config path does not exist or is not a directory, using default path"
+                "Config path does not exist or is not a directory, using default path",
+                file=sys.stderr,
             )
             self.config["downloads_path"] = self.default_config["downloads_path"]
 
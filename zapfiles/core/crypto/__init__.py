@@ -0,0 +1,234 @@
+import os
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import (
+    X25519PrivateKey,
+    X25519PublicKey,
+)
+from cryptography.hazmat.primitives.ciphers import (
+    Cipher,
+    CipherContext,
+    algorithms,
+    modes,
+)
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+CTR_NONCE = b"0" * 16
+AES_BLOCK_SIZE = 16
+
+X25519_KEY_SIZE = 32
+X25519_KEY_DERIVATION_INFO = b"zapfiles x25519"
+
+# Server public key followed by the sealed AES key and its tag
+X25519_WRAPPED_KEY_SIZE = X25519_KEY_SIZE + 32 + 16
+
+# Wrapping keys are used once, so a constant nonce is safe
+WRAP_NONCE = bytes(12)
+
+RESUMPTION_NONCE_SIZE = 32
+# Random secret of a session ticket, wrapped right after the AES key, so it's
+# never derived from a key other clients may share
+RESUMPTION_SECRET_SIZE = 32
+TICKET_KEY_DERIVATION_INFO = b"zapfiles ticket"
+
+# Server nonce followed by the sealed AES key and its tag
+TICKET_WRAPPED_KEY_SIZE = RESUMPTION_NONCE_SIZE + 32 + 16
+
+
+def create_aes_cipher(aes_key: bytes, offset: int = 0) -> Cipher:
+    """
+    Creates AES-CTR cipher whose keystream starts at the block containing offset.
+
+    Args:
+        aes_key (bytes): AES key
+        offset (int): byte offset in the stream (default: 0)
+
+    Returns:
+        Cipher: AES cipher
+    """
+    counter = int.from_bytes(CTR_NONCE, "big") + offset // AES_BLOCK_SIZE
+    counter_block = (counter % (1 << 128)).to_bytes(AES_BLOCK_SIZE, "big")
+
+    return Cipher(
+        algorithms.AES(aes_key), modes.CTR(counter_block), backend=default_backend()
+    )
+
+
+def _skip_keystream(context: CipherContext, offset: int) -> CipherContext:
+    """
+    Advances context to an offset that is not aligned to the AES block size.
+
+    Args:
+        context (CipherContext): context created by create_aes_cipher
+        offset (int): byte offset in the stream
+
+    Returns:
+        CipherContext: the same context
+    """
+    skip = offset % AES_BLOCK_SIZE
+    if skip:
+        context.update(bytes(skip))
+    return context
+
+
+def create_encryptor(aes_key: bytes, offset: int = 0) -> CipherContext:
+    """
+    Creates AES-CTR encryptor positioned at offset.
+
+    Args:
+        aes_key (bytes): AES key
+        offset (int): byte offset in the stream (default: 0)
+
+    Returns:
+        CipherContext: encryptor
+    """
+    return _skip_keystream(create_aes_cipher(aes_key, offset).encryptor(), offset)
+
+
+def create_decryptor(aes_key: bytes, offset: int = 0) -> CipherContext:
+    """
+    Creates AES-CTR decryptor positioned at offset.
+
+    Args:
+        aes_key (bytes): AES key
+        offset (int): byte offset in the stream (default: 0)
+
+    Returns:
+        CipherContext: decryptor
+    """
+    return _skip_keystream(create_aes_cipher(aes_key, offset).decryptor(), offset)
+
+
+def get_x25519_public_bytes(private_key: X25519PrivateKey) -> bytes:
+    """
+    Args:
+        private_key (X25519PrivateKey): X25519 private key
+
+    Returns:
+        bytes: raw public key
+    """
+    return private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw
+    )
+
+
+def _derive_wrapping_key(
+    private_key: X25519PrivateKey,
+    peer_public: bytes,
+    client_public: bytes,
+    server_public: bytes,
+) -> AESGCM:
+    shared = private_key.exchange(X25519PublicKey.from_public_bytes(peer_public))
+    key = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=client_public + server_public,
+        info=X25519_KEY_DERIVATION_INFO,
+    ).derive(shared)
+    return AESGCM(key)
+
+
+def x25519_wrap_key(aes_key: bytes, client_public: bytes) -> bytes:
+    """
+    Wraps AES key for a client with an ephemeral X25519 key agreement.
+
+    Args:
+        aes_key (bytes): AES key, optionally followed by a resumption secret
+        client_public (bytes): raw X25519 public key of client
+
+    Returns:
+        bytes: server public key and sealed AES key, X25519_WRAPPED_KEY_SIZE bytes
+            for a bare AES key
+
+    Raises:
+        ValueError: If the client key is invalid.
+    """
+    private_key = X25519PrivateKey.generate()
+    server_public = get_x25519_public_bytes(private_key)
+
+    aead = _derive_wrapping_key(
+        private_key, client_public, client_public, server_public
+    )
+    return server_public + aead.encrypt(WRAP_NONCE, aes_key, None)
+
+
+def x25519_unwrap_key(private_key: X25519PrivateKey, wrapped_key: bytes) -> bytes:
+    """
+    Unwraps AES key wrapped by x25519_wrap_key.
+
+    Args:
+        private_key (X25519PrivateKey): ephemeral private key of client
+        wrapped_key (bytes): data returned by x25519_wrap_key
+
+    Returns:
+        bytes: AES key
+
+    Raises:
+        ValueError: If the key can't be unwrapped.
+    """
+    server_public = wrapped_key[:X25519_KEY_SIZE]
+    aead = _derive_wrapping_key(
+        private_key, server_public, get_x25519_public_bytes(private_key), server_public
+    )
+
+    try:
+        return aead.decrypt(WRAP_NONCE, wrapped_key[X25519_KEY_SIZE:], None)
+    except InvalidTag:
+        raise ValueError("AES key can't be unwrapped") from None
+
+
+def _derive_ticket_wrapping_key(
+    secret: bytes, client_nonce: bytes, server_nonce: bytes
+) -> AESGCM:
+    key = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=client_nonce + server_nonce,
+        info=TICKET_KEY_DERIVATION_INFO,
+    ).derive(secret)
+    return AESGCM(key)
+
+
+def ticket_wrap_key(aes_key: bytes, secret: bytes, client_nonce: bytes) -> bytes:
+    """
+    Wraps AES key for a client that presented a session ticket.
+
+    Args:
+        aes_key (bytes): AES key, optionally followed by a new resumption secret
+        secret (bytes): resumption secret from the ticket
+        client_nonce (bytes): random nonce sent by client
+
+    Returns:
+        bytes: server nonce and sealed AES key, TICKET_WRAPPED_KEY_SIZE bytes
+            for a bare AES key
+    """
+    server_nonce = os.urandom(RESUMPTION_NONCE_SIZE)
+    aead = _derive_ticket_wrapping_key(secret, client_nonce, server_nonce)
+    return server_nonce + aead.encrypt(WRAP_NONCE, aes_key, None)
+
+
+def ticket_unwrap_key(secret: bytes, client_nonce: bytes, wrapped_key: bytes) -> bytes:
+    """
+    Unwraps AES key wrapped by ticket_wrap_key.
+
+    Args:
+        secret (bytes): resumption secret of the ticket
+        client_nonce (bytes): nonce sent to server
+        wrapped_key (bytes): data returned by ticket_wrap_key
+
+    Returns:
+        bytes: AES key
+
+    Raises:
+        ValueError: If the key can't be unwrapped.
+    """
+    server_nonce = wrapped_key[:RESUMPTION_NONCE_SIZE]
+    aead = _derive_ticket_wrapping_key(secret, client_nonce, server_nonce)
+
+    try:
+        return aead.decrypt(WRAP_NONCE, wrapped_key[RESUMPTION_NONCE_SIZE:], None)
+    except InvalidTag:
+        raise ValueError("AES key can't be unwrapped") from None
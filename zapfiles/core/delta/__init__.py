@@ -0,0 +1,547 @@
+import asyncio
+import hashlib
+import math
+import struct
+import zlib
+from asyncio import StreamWriter
+from concurrent.futures import ThreadPoolExecutor
+from os import PathLike
+from typing import BinaryIO, Callable, Iterator, KeysView, Optional
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from zapfiles.core.admission import RateLimiter
+from zapfiles.core.transfer.receiver import Readable, Writable, read_exactly
+
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+
+# Signatures of more blocks than this aren't accepted by the server
+MAX_BLOCK_COUNT = 1 << 22
+
+# Weak checksum is Adler-32, which zlib computes for whole blocks and which
+# can be rolled one byte at a time
+ADLER_MODULUS = 65521
+STRONG_DIGEST_SIZE = 16
+
+SIGNATURE_HEADER = struct.Struct(">IQQ")
+SIGNATURE = struct.Struct(">I16s")
+SIGNATURES_PER_MESSAGE = 64 * 1024
+
+OP_END = 0
+OP_COPY = 1
+OP_LITERAL = 2
+COPY = struct.Struct(">BQI")
+LITERAL = struct.Struct(">BI")
+
+# Literal data is cut into runs of this size, so every message stays small
+MAX_LITERAL_SIZE = 1024 * 1024
+
+# Rolling runs in Python at about 2 MiB/s on data without matches, after this
+# much data without a match only block-aligned windows are probed, so a single
+# transfer can't hold the GIL for long
+MAX_UNMATCHED_SIZE = 4 * 1024 * 1024
+READ_SIZE = 4 * 1024 * 1024
+
+KEY_DERIVATION_INFO = b"zapfiles delta"
+MESSAGE_LENGTH = struct.Struct(">I")
+MAX_MESSAGE_SIZE = 4 * 1024 * 1024
+CLIENT_NONCE_PREFIX = b"\x00\x00\x00\x01"
+SERVER_NONCE_PREFIX = b"\x00\x00\x00\x02"
+
+# Copy of count blocks starting at block, or literal data
+Op = tuple[int, int, int] | bytes
+
+
+def get_block_size(file_size: int) -> int:
+    """
+    Picks block size close to the square root of the file size, which keeps
+    both the signatures and the unmatched data around each change small.
+
+    Args:
+        file_size (int): size of the local copy in bytes
+
+    Returns:
+        int: block size in bytes, a multiple of 1 KiB
+    """
+    size = -(-math.isqrt(file_size) // 1024) * 1024
+    return min(MAX_BLOCK_SIZE, max(MIN_BLOCK_SIZE, size))
+
+
+def _strong_digest(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=STRONG_DIGEST_SIZE).digest()
+
+
+def compute_signatures(file_path: PathLike[str], block_size: int) -> bytes:
+    """
+    Computes weak and strong checksums of every block of the local copy.
+
+    Args:
+        file_path (PathLike[str]): path to the local copy
+        block_size (int): block size in bytes
+
+    Returns:
+        bytes: SIGNATURE records, one per block
+    """
+    signatures = bytearray()
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+
+    with open(file_path, "rb", buffering=0) as f:
+        while read := f.readinto(buffer):
+            block = view[:read]
+            signatures += SIGNATURE.pack(zlib.adler32(block), _strong_digest(block))
+
+    return bytes(signatures)
+
+
+class SignatureIndex:
+    """
+    Blocks of the client's copy looked up by weak checksum.
+    """
+
+    def __init__(self, signatures: bytes, block_size: int, base_size: int):
+        """
+        Args:
+            signatures (bytes): SIGNATURE records sent by client
+            block_size (int): block size in bytes
+            base_size (int): size of the client's copy in bytes
+        """
+        self.block_size = block_size
+        self.base_size = base_size
+        self._blocks: dict[int, list[tuple[bytes, int]]] = {}
+
+        for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(signatures)):
+            self._blocks.setdefault(weak, []).append((strong, index))
+
+    @property
+    def weak_checksums(self) -> KeysView[int]:
+        """
+        Returns:
+            KeysView[int]: weak checksums of all blocks
+        """
+        return self._blocks.keys()
+
+    def get_block_length(self, index: int, count: int = 1) -> int:
+        start = index * self.block_size
+        return min(start + count * self.block_size, self.base_size) - start
+
+    def find(self, weak: int, data) -> Optional[int]:
+        """
+        Args:
+            weak (int): Adler-32 of data
+            data (bytes-like): candidate block
+
+        Returns:
+            Optional[int]: index of a block with the same content or None
+        """
+        candidates = self._blocks.get(weak)
+        if not candidates:
+            return None
+
+        strong = _strong_digest(data)
+        for candidate, index in candidates:
+            if candidate == strong and self.get_block_length(index) == len(data):
+                return index
+        return None
+
+
+def iter_delta(source: BinaryIO, index: SignatureIndex) -> Iterator[Op]:
+    """
+    Finds blocks of the client's copy in source, rolling the weak checksum
+    byte by byte between matches. After MAX_UNMATCHED_SIZE bytes without a
+    match only windows on the block grid of the last match are probed, with a
+    block of rolling after every MAX_UNMATCHED_SIZE bytes probed, until a block
+    matches again.
+
+    Args:
+        source (BinaryIO): new version of file
+        index (SignatureIndex): blocks of the client's copy
+
+    Returns:
+        Iterator[Op]: copies and literal data rebuilding source, consecutive
+            copies are merged
+    """
+    block_size = index.block_size
+    weak_checksums = index.weak_checksums
+    buffer = b""
+    position = 0  # start of the window in buffer
+    literal_start = 0
+    # End of the last match in buffer, probed windows are aligned to it
+    anchor = 0
+    # Bytes left to roll through before probing only aligned windows
+    rolling_budget = MAX_UNMATCHED_SIZE
+    probed = 0
+    eof = False
+    weak: Optional[tuple[int, int]] = None
+    pending_copy: Optional[list[int]] = None
+
+    def flush_copy() -> Iterator[Op]:
+        nonlocal pending_copy
+        if pending_copy is not None:
+            yield OP_COPY, pending_copy[0], pending_copy[1]
+            pending_copy = None
+
+    while True:
+        # Keeping a whole window and the byte after it in the buffer
+        while not eof and len(buffer) - position <= block_size:
+            data = source.read(READ_SIZE)
+            eof = not data
+            buffer = buffer[literal_start:] + data
+            position -= literal_start
+            anchor -= literal_start
+            literal_start = 0
+
+        size = min(block_size, len(buffer) - position)
+        if size == 0:
+            break
+
+        if weak is None:
+            checksum = zlib.adler32(buffer[position : position + size])
+            weak = (checksum & 0xFFFF, checksum >> 16)
+        a, b = weak
+
+        # Slicing the window only for the strong digest of a weak match
+        block = None
+        if a | (b << 16) in weak_checksums:
+            block = index.find(a | (b << 16), buffer[position : position + size])
+        if block is not None:
+            if literal_start < position:
+                yield from flush_copy()
+                yield buffer[literal_start:position]
+
+            if pending_copy is not None and pending_copy[0] + pending_copy[1] == block:
+                pending_copy[1] += 1
+            else:
+                yield from flush_copy()
+                pending_copy = [block, 1]
+
+            position += size
+            literal_start = anchor = position
+            rolling_budget = MAX_UNMATCHED_SIZE
+            probed = 0
+            weak = None
+            continue
+
+        if size < block_size or position + size >= len(buffer):
+            # Tail shorter than a block is sent as it is
+            position = len(buffer)
+            break
+
+        if rolling_budget:
+            # Rolling the window forward until the next weak match, the end of
+            # the buffer, the end of a literal run or of the budget
+            start = position
+            limit = min(
+                len(buffer) - size,
+                literal_start + MAX_LITERAL_SIZE,
+                position + rolling_budget,
+            )
+            while position < limit:
+                removed, added = buffer[position], buffer[position + size]
+                a = (a - removed + added) % ADLER_MODULUS
+                b = (b - size * removed + a - 1) % ADLER_MODULUS
+                position += 1
+                if a | (b << 16) in weak_checksums:
+                    break
+            weak = (a, b)
+            rolling_budget -= position - start
+        else:
+            # Rolling costs too much in a long changed region, data changed in
+            # place still matches on the grid of the last match, and a block of
+            # rolling now and then finds data that has moved
+            step = (anchor - position) % block_size or block_size
+            position += step
+            probed += step
+            weak = None
+            if probed >= MAX_UNMATCHED_SIZE:
+                rolling_budget = block_size
+                probed = 0
+
+        while position - literal_start >= MAX_LITERAL_SIZE:
+            yield from flush_copy()
+            yield buffer[literal_start : literal_start + MAX_LITERAL_SIZE]
+            literal_start += MAX_LITERAL_SIZE
+
+    yield from flush_copy()
+    for offset in range(literal_start, len(buffer), MAX_LITERAL_SIZE):
+        yield buffer[offset : min(offset + MAX_LITERAL_SIZE, len(buffer))]
+
+
+def encode_ops(ops: list[Op]) -> bytes:
+    """
+    Args:
+        ops (list[Op]): copies and literal data
+
+    Returns:
+        bytes: encoded ops
+    """
+    parts = []
+    for op in ops:
+        if isinstance(op, tuple):
+            parts.append(COPY.pack(*op))
+        else:
+            parts.append(LITERAL.pack(OP_LITERAL, len(op)))
+            parts.append(op)
+    return b"".join(parts)
+
+
+def decode_ops(data: bytes) -> Iterator[Optional[Op]]:
+    """
+    Args:
+        data (bytes): ops encoded by encode_ops, optionally followed by OP_END
+
+    Returns:
+        Iterator[Optional[Op]]: ops, None for OP_END
+
+    Raises:
+        ValueError: If data is malformed.
+    """
+    position = 0
+    view = memoryview(data)
+
+    while position < len(data):
+        op = data[position]
+        if op == OP_COPY:
+            yield COPY.unpack_from(data, position)
+            position += COPY.size
+        elif op == OP_LITERAL:
+            _, length = LITERAL.unpack_from(data, position)
+            position += LITERAL.size
+            if position + length > len(data):
+                raise ValueError("Truncated literal")
+            yield bytes(view[position : position + length])
+            position += length
+        elif op == OP_END:
+            yield None
+            position += 1
+        else:
+            raise ValueError(f"Unknown delta op: {op}")
+
+
+class DeltaChannel:
+    """
+    Length-prefixed AES-GCM messages under a key derived from the session key.
+    Each direction has its own nonce prefix and counter.
+    """
+
+    def __init__(self, aes_key: bytes, is_server: bool):
+        """
+        Args:
+            aes_key (bytes): session key
+            is_server (bool): True on the server side
+        """
+        key = HKDF(
+            algorithm=hashes.SHA256(), length=32, salt=None, info=KEY_DERIVATION_INFO
+        ).derive(aes_key)
+        self._aead = AESGCM(key)
+        self._send_prefix = SERVER_NONCE_PREFIX if is_server else CLIENT_NONCE_PREFIX
+        self._receive_prefix = CLIENT_NONCE_PREFIX if is_server else SERVER_NONCE_PREFIX
+        self._sent = 0
+        self._received = 0
+
+    def seal(self, data: bytes) -> bytes:
+        """
+        Args:
+            data (bytes): message
+
+        Returns:
+            bytes: length-prefixed sealed message
+        """
+        nonce = self._send_prefix + self._sent.to_bytes(8, "big")
+        self._sent += 1
+        sealed = self._aead.encrypt(nonce, data, None)
+        return MESSAGE_LENGTH.pack(len(sealed)) + sealed
+
+    async def receive(self, reader: Readable) -> bytes:
+        """
+        Args:
+            reader (Readable): asyncio StreamReader
+
+        Returns:
+            bytes: message
+
+        Raises:
+            ValueError: If the message is too large or fails authentication.
+        """
+        (length,) = MESSAGE_LENGTH.unpack(
+            await read_exactly(reader, MESSAGE_LENGTH.size)
+        )
+        if length > MAX_MESSAGE_SIZE:
+            raise ValueError(f"Delta message is too large: {length}")
+
+        nonce = self._receive_prefix + self._received.to_bytes(8, "big")
+        self._received += 1
+        try:
+            return self._aead.decrypt(nonce, await read_exactly(reader, length), None)
+        except InvalidTag:
+            raise ValueError("Delta message failed authentication") from None
+
+
+class DeltaSender:
+    """
+    Server side of a delta transfer: receives block signatures of the client's
+    copy and sends the new file as copies of those blocks and literal data.
+    """
+
+    async def send(
+        self,
+        reader: Readable,
+        writer: StreamWriter,
+        aes_key: bytes,
+        source: BinaryIO,
+        on_progress: Optional[Callable[[int], object]] = None,
+        limiter: Optional[RateLimiter] = None,
+    ) -> int:
+        """
+        Args:
+            reader (Readable): asyncio StreamReader
+            writer (StreamWriter): asyncio StreamWriter
+            aes_key (bytes): session key
+            source (BinaryIO): new version of file
+            on_progress (Callable[[int], object], optional): called with the
+                number of bytes of source covered by each message
+            limiter (RateLimiter, optional): paces the sent data
+
+        Returns:
+            int: number of literal bytes sent
+
+        Raises:
+            ValueError: If the signatures are malformed.
+        """
+        loop = asyncio.get_running_loop()
+        channel = DeltaChannel(aes_key, is_server=True)
+
+        block_size, base_size, count = SIGNATURE_HEADER.unpack(
+            await channel.receive(reader)
+        )
+        if not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE or (
+            count > MAX_BLOCK_COUNT or count != -(-base_size // block_size)
+        ):
+            raise ValueError("Malformed delta signatures")
+
+        signatures = bytearray()
+        while len(signatures) < count * SIGNATURE.size:
+            signatures += await channel.receive(reader)
+        if len(signatures) != count * SIGNATURE.size:
+            raise ValueError("Malformed delta signatures")
+
+        index = SignatureIndex(bytes(signatures), block_size, base_size)
+        ops = iter_delta(source, index)
+        literal_sent = 0
+
+        def next_batch() -> tuple[list[Op], int]:
+            # Batches cover up to MAX_LITERAL_SIZE of literal data
+            batch: list[Op] = []
+            literal_size = covered = 0
+            for op in ops:
+                batch.append(op)
+                if isinstance(op, tuple):
+                    covered += index.get_block_length(op[1], op[2])
+                else:
+                    literal_size += len(op)
+                    covered += len(op)
+                if literal_size >= MAX_LITERAL_SIZE or len(batch) >= 4096:
+                    break
+            return batch, covered
+
+        # Rolling checksums are CPU-bound, finding matches in a worker thread
+        with ThreadPoolExecutor(1) as pool:
+            while True:
+                batch, covered = await loop.run_in_executor(pool, next_batch)
+                if not batch:
+                    break
+
+                literal_sent += sum(len(op) for op in batch if isinstance(op, bytes))
+                message = channel.seal(encode_ops(batch))
+                if limiter is not None:
+                    await limiter.consume(len(message))
+                writer.write(message)
+                await writer.drain()
+                if on_progress is not None:
+                    on_progress(covered)
+
+        writer.write(channel.seal(bytes([OP_END])))
+        await writer.drain()
+        return literal_sent
+
+
+class DeltaReceiver:
+    """
+    Client side of a delta transfer: sends block signatures of the local copy
+    and rebuilds the new file from its blocks and the received literal data.
+    """
+
+    async def receive(
+        self,
+        reader: Readable,
+        writer: StreamWriter,
+        aes_key: bytes,
+        base: BinaryIO,
+        signatures: bytes,
+        block_size: int,
+        target: Writable,
+        on_progress: Optional[Callable[[int], object]] = None,
+    ) -> int:
+        """
+        Args:
+            reader (Readable): asyncio StreamReader
+            writer (StreamWriter): asyncio StreamWriter
+            aes_key (bytes): session key
+            base (BinaryIO): local copy opened for reading
+            signatures (bytes): signatures returned by compute_signatures
+            block_size (int): block size of signatures
+            target (Writable): file-like writer for the new file
+            on_progress (Callable[[int], object], optional): called with the
+                number of bytes written
+
+        Returns:
+            int: number of bytes written
+
+        Raises:
+            ValueError: If a message is malformed or fails authentication.
+        """
+        channel = DeltaChannel(aes_key, is_server=False)
+        base.seek(0, 2)
+        base_size = base.tell()
+
+        count = len(signatures) // SIGNATURE.size
+        writer.write(channel.seal(SIGNATURE_HEADER.pack(block_size, base_size, count)))
+        step = SIGNATURES_PER_MESSAGE * SIGNATURE.size
+        for offset in range(0, len(signatures), step):
+            writer.write(channel.seal(signatures[offset : offset + step]))
+            await writer.drain()
+        await writer.drain()
+
+        def put(data: bytes) -> None:
+            nonlocal written
+            target.write(data)
+            written += len(data)
+            if on_progress is not None:
+                on_progress(len(data))
+
+        written = 0
+        while True:
+            for op in decode_ops(await channel.receive(reader)):
+                if op is None:
+                    return written
+                if isinstance(op, bytes):
+                    put(op)
+                    continue
+
+                _, block, blocks = op
+                if block + blocks > count:
+                    raise ValueError(f"Delta copy past the end: {block + blocks}")
+
+                # Copies can span the whole file, reading them in parts
+                base.seek(block * block_size)
+                remaining = min((block + blocks) * block_size, base_size) - base.tell()
+                while remaining > 0:
+                    data = base.read(min(remaining, READ_SIZE))
+                    if not data:
+                        raise ValueError("Local copy has changed")
+                    put(data)
+                    remaining -= len(data)
@@ -1,24 +1,431 @@
+import atexit
 import hashlib
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from os import PathLike
+from pathlib import Path
+from typing import BinaryIO, Optional
 
+from zapfiles.constants import ROOT_DIR
+from zapfiles.core.config.app_configuration import config
+from zapfiles.core.persistence import JsonIndex, get_signature, has_signature
 
-def get_file_hash(file_path: PathLike[str], algorithm: str = "sha256") -> str:
+# Files modified this recently may still change within the same mtime tick
+RACY_WINDOW_NS = 2_000_000_000
+
+READ_BUFFER_SIZE = 1024 * 1024
+
+# Part of the tree hash format, changing it changes every tree digest
+TREE_CHUNK_SIZE = 4 * 1024 * 1024
+
+DEFAULT_ALGORITHM = "sha256"
+HASH_MODES = ("flat", "tree")
+HASH_SEPARATOR = "."
+
+# Changes are written at most this often, and at the end of a scan and at exit
+SAVE_INTERVAL = 5.0
+
+
+class HashCache:
+    """
+    Persistent LRU cache of file digests.
+
+    Entries are looked up by resolved path and algorithm and are only valid while
+    size, mtime_ns and inode of the file stay the same. Changes are kept in
+    memory and written by flush(), or by put() once SAVE_INTERVAL has passed.
+    """
+
+    def __init__(self, cache_path: PathLike[str], max_entries: int):
+        """
+        Args:
+            cache_path (PathLike[str]): path to cache file
+            max_entries (int): maximum number of cached digests, raised by
+                reserve() to fit every shared file
+        """
+        self.cache_path = Path(cache_path)
+        self.max_entries = max_entries
+        self._index = JsonIndex(cache_path)
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_key(file_path: Path, algorithm: str, mode: str) -> str:
+        return f"{algorithm}{HASH_SEPARATOR}{mode}:{file_path}"
+
+    def _save(self) -> None:
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self._index.save()
+
+    def flush(self) -> None:
+        """
+        Writes changed entries to the cache file.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def reserve(self, count: int) -> None:
+        """
+        Raises the limit to at least count entries, so scanning that many files
+        doesn't evict digests the next scan needs.
+
+        Args:
+            count (int): number of files hashed together, e.g. of a catalog
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.max_entries = max(self.max_entries, count)
+
+    def get(
+        self, file_path: Path, stat: os.stat_result, algorithm: str, mode: str
+    ) -> Optional[str]:
+        """
+        Returns cached digest if the file hasn't changed since it was hashed.
+
+        Args:
+            file_path (Path): resolved path to file
+            stat (os.stat_result): current stat of file
+            algorithm (str): hash algorithm
+            mode (str): hash mode
+
+        Returns:
+            Optional[str]: digest or None
+        """
+        key = self._make_key(file_path, algorithm, mode)
+
+        with self._lock:
+            entries = self._index.load()
+            entry = entries.get(key)
+            if entry is None:
+                return None
+
+            if not has_signature(entry, stat):
+                del entries[key]
+                self._dirty = True
+                return None
+
+            entries.move_to_end(key)
+            return entry["digest"]
+
+    def put(
+        self,
+        file_path: Path,
+        stat: os.stat_result,
+        algorithm: str,
+        mode: str,
+        digest: str,
+    ) -> None:
+        """
+        Stores digest of file and evicts least recently used entries over the limit.
+
+        Args:
+            file_path (Path): resolved path to file
+            stat (os.stat_result): stat of file taken before hashing
+            algorithm (str): hash algorithm
+            mode (str): hash mode
+            digest (str): file digest
+
+        Returns:
+            None
+        """
+        key = self._make_key(file_path, algorithm, mode)
+
+        with self._lock:
+            entries = self._index.load()
+            entries[key] = {**get_signature(stat), "digest": digest}
+            entries.move_to_end(key)
+
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+            self._dirty = True
+            if time.monotonic() - self._saved_at > SAVE_INTERVAL:
+                self._save()
+
+
+hash_cache = HashCache(
+    Path(ROOT_DIR) / "cache" / "hashes.json", config.get_value("hash_cache_max_entries")
+)
+atexit.register(hash_cache.flush)
+
+
+def _hash_flat(file_path: PathLike[str], algorithm: str, use_mmap: bool) -> str:
+    """
+    Hashes the whole file as a single stream.
+
+    Args:
+        file_path (PathLike[str]): path to file to hash
+        algorithm (str): hash algorithm
+        use_mmap (bool): hash a memory map of the file instead of reading it
+
+    Returns:
+        str: hex digest
+    """
+    hash_func = hashlib.new(algorithm)
+
+    with open(file_path, "rb", buffering=0) as f:
+        if use_mmap and os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    hash_func.update(view)
+        else:
+            # Reading file by large chunks into a single buffer
+            buffer = bytearray(READ_BUFFER_SIZE)
+            view = memoryview(buffer)
+            while read := f.readinto(buffer):
+                hash_func.update(view[:read])
+
+    return hash_func.hexdigest()
+
+
+def _hash_tree(file_path: PathLike[str], algorithm: str, use_mmap: bool) -> str:
+    """
+    Hashes fixed-size chunks of the file in a thread pool and returns the digest
+    of the concatenated chunk digests.
+
+    Args:
+        file_path (PathLike[str]): path to file to hash
+        algorithm (str): hash algorithm
+        use_mmap (bool): hash a memory map of the file instead of reading it
+
+    Returns:
+        str: hex digest of the root
+    """
+    with open(file_path, "rb", buffering=0) as f, ExitStack() as stack:
+        file_size = os.fstat(f.fileno()).st_size
+
+        view: Optional[memoryview] = None
+        if use_mmap and file_size:
+            mapped = stack.enter_context(
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            )
+            view = stack.enter_context(memoryview(mapped))
+
+        # Without positional reads (Windows) every worker uses its own handle
+        local = threading.local()
+        handles: list[BinaryIO] = []
+        stack.callback(lambda: [handle.close() for handle in handles])
+
+        def read_chunk(offset: int) -> bytes | memoryview:
+            if view is not None:
+                return view[offset : offset + TREE_CHUNK_SIZE]
+            if hasattr(os, "pread"):
+                return os.pread(f.fileno(), TREE_CHUNK_SIZE, offset)
+
+            if not hasattr(local, "file"):
+                local.file = open(file_path, "rb")
+                handles.append(local.file)
+            local.file.seek(offset)
+            return local.file.read(TREE_CHUNK_SIZE)
+
+        def hash_chunk(offset: int) -> bytes:
+            return hashlib.new(algorithm, read_chunk(offset)).digest()
+
+        with ThreadPoolExecutor() as pool:
+            digests = list(pool.map(hash_chunk, range(0, file_size, TREE_CHUNK_SIZE)))
+
+    root = hashlib.new(algorithm)
+    for digest in digests:
+        root.update(digest)
+
+    return root.hexdigest()
+
+
+def _hash_file(
+    file_path: PathLike[str], algorithm: str, mode: str, use_mmap: bool
+) -> str:
+    if mode == "tree":
+        return _hash_tree(file_path, algorithm, use_mmap)
+    elif mode == "flat":
+        return _hash_flat(file_path, algorithm, use_mmap)
+    raise ValueError(f"Unknown hash mode: {mode}")
+
+
+def format_hash(
+    digest: str, algorithm: str = DEFAULT_ALGORITHM, mode: str = "flat"
+) -> str:
+    """
+    Builds hash string for server keys, e.g. blake2b.tree.<digest>.
+    Plain sha256 digests stay as they are, so older keys keep working.
+
+    Args:
+        digest (str): hex digest
+        algorithm (str): hash algorithm (default: sha256)
+        mode (str): hash mode (default: flat)
+
+    Returns:
+        str: hash string
+    """
+    if algorithm == DEFAULT_ALGORITHM and mode == "flat":
+        return digest
+    return HASH_SEPARATOR.join((algorithm, mode, digest))
+
+
+def parse_hash(file_hash: str) -> tuple[str, str, str]:
+    """
+    Splits hash string created by format_hash.
+
+    Args:
+        file_hash (str): hash string
+
+    Returns:
+        tuple[str, str, str]: algorithm, mode and hex digest
+    """
+    parts = file_hash.split(HASH_SEPARATOR)
+    if len(parts) == 3:
+        return parts[0], parts[1], parts[2]
+    return DEFAULT_ALGORITHM, "flat", file_hash
+
+
+class StreamHasher:
+    """
+    Hashes data written to it sequentially and gives the same digest as
+    get_file_hash would give for a file with that content.
+    """
+
+    def __init__(self, algorithm: str = DEFAULT_ALGORITHM, mode: str = "flat"):
+        """
+        Args:
+            algorithm (str): hash algorithm (default: sha256)
+            mode (str): hash mode (default: flat)
+        """
+        if mode not in HASH_MODES:
+            raise ValueError(f"Unknown hash mode: {mode}")
+
+        self.algorithm = algorithm
+        self.mode = mode
+        self._hash = hashlib.new(algorithm)
+
+        # Tree mode only
+        self._root = hashlib.new(algorithm)
+        self._chunk_filled = 0
+
+    @classmethod
+    def from_hash(cls, file_hash: str) -> "StreamHasher":
+        """
+        Creates hasher matching the hash string created by format_hash.
+
+        Args:
+            file_hash (str): hash string
+
+        Returns:
+            StreamHasher: hasher
+        """
+        algorithm, mode, _ = parse_hash(file_hash)
+        return cls(algorithm, mode)
+
+    def update(self, data) -> None:
+        """
+        Args:
+            data (bytes-like): next part of data
+
+        Returns:
+            None
+        """
+        view = memoryview(data).cast("B")
+
+        if self.mode == "flat":
+            self._hash.update(view)
+            return
+
+        while view:
+            part = view[: TREE_CHUNK_SIZE - self._chunk_filled]
+            self._hash.update(part)
+            self._chunk_filled += len(part)
+            view = view[len(part) :]
+
+            if self._chunk_filled == TREE_CHUNK_SIZE:
+                self._root.update(self._hash.digest())
+                self._hash = hashlib.new(self.algorithm)
+                self._chunk_filled = 0
+
+    def hexdigest(self) -> str:
+        """
+        Returns:
+            str: hex digest of data written so far
+        """
+        if self.mode == "flat":
+            return self._hash.hexdigest()
+
+        root = self._root.copy()
+        if self._chunk_filled:
+            root.update(self._hash.digest())
+        return root.hexdigest()
+
+
+def get_file_hash(
+    file_path: PathLike[str],
+    algorithm: str = DEFAULT_ALGORITHM,
+    use_cache: bool = True,
+    mode: str = "flat",
+    use_mmap: Optional[bool] = None,
+) -> str:
     """
     Returns file hash.
-    By default, uses sha256.
+    By default, uses sha256. Digests are cached on disk and reused while the file
+    stays unchanged.
 
     Args:
         file_path (str): path to file to hash
         algorithm (str): hash algorithm (default: sha256)
+        use_cache (bool): look up and store digest in the hash cache (default: True)
+        mode (str): "flat" hashes the file as one stream, "tree" hashes
+            TREE_CHUNK_SIZE chunks in parallel and hashes their digests
+            (default: flat)
+        use_mmap (bool, optional): read file through mmap, hash_use_mmap from
+            config if None
 
     Returns:
         Str: file hash
     """
-    hash_func = hashlib.new(algorithm)
+    if use_mmap is None:
+        use_mmap = bool(config.get_value("hash_use_mmap"))
 
-    # Reading file by chunks
-    with open(file_path, "rb") as f:
-        for block in iter(lambda: f.read(4096), b""):
-            hash_func.update(block)
+    if not use_cache or not config.get_value("hash_cache"):
+        return _hash_file(file_path, algorithm, mode, use_mmap)
 
-    return hash_func.hexdigest()
+    resolved_path = Path(file_path).resolve()
+    stat = os.stat(resolved_path)
+
+    digest = hash_cache.get(resolved_path, stat, algorithm, mode)
+    if digest is not None:
+        return digest
+
+    started_ns = time.time_ns()
+    digest = _hash_file(resolved_path, algorithm, mode, use_mmap)
+
+    # Not caching files that changed while hashing or could still change unnoticed
+    after = os.stat(resolved_path)
+    if (
+        get_signature(after) == get_signature(stat)
+        and started_ns - stat.st_mtime_ns > RACY_WINDOW_NS
+    ):
+        hash_cache.put(resolved_path, stat, algorithm, mode, digest)
+
+    return digest
+
+
+def file_hash_matches(file_path: PathLike[str], file_hash: str) -> bool:
+    """
+    Checks file against hash string created by format_hash.
+
+    Args:
+        file_path (PathLike[str]): path to file to check
+        file_hash (str): expected hash string
+
+    Returns:
+        bool: True if file hash is the same
+    """
+    algorithm, mode, digest = parse_hash(file_hash)
+    return get_file_hash(file_path, algorithm, mode=mode) == digest
@@ -0,0 +1,106 @@
+import json
+import os
+from collections import OrderedDict
+from os import PathLike
+from pathlib import Path
+from typing import Any, Optional
+
+# Stat fields that change whenever a file is edited or replaced
+SIGNATURE_FIELDS = ("size", "mtime_ns", "inode")
+
+
+def get_signature(stat: os.stat_result) -> dict[str, int]:
+    """
+    Args:
+        stat (os.stat_result): stat of file
+
+    Returns:
+        dict[str, int]: size, mtime_ns and inode of file
+    """
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "inode": stat.st_ino}
+
+
+def has_signature(entry: dict[str, Any], stat: os.stat_result) -> bool:
+    """
+    Args:
+        entry (dict[str, Any]): stored entry holding the signature fields
+        stat (os.stat_result): current stat of file
+
+    Returns:
+        bool: True if the file hasn't changed since the entry was stored
+    """
+    signature = get_signature(stat)
+    return all(entry.get(field) == signature[field] for field in SIGNATURE_FIELDS)
+
+
+def write_json(path: PathLike[str], data: Any, private: bool = False) -> None:
+    """
+    Replaces file with data as JSON, readers never see a half-written file.
+
+    Args:
+        path (PathLike[str]): path to file
+        data (Any): JSON serializable data
+        private (bool): create the file readable by its owner only
+
+    Returns:
+        None
+
+    Raises:
+        OSError: If the file can't be written.
+    """
+    path = Path(path)
+    os.makedirs(path.parent, exist_ok=True)
+    temp_path = path.with_name(path.name + ".tmp")
+
+    mode = 0o600 if private else 0o666
+    with open(
+        temp_path,
+        "w",
+        encoding="utf-8",
+        opener=lambda file, flags: os.open(file, flags, mode),
+    ) as f:
+        f.write(json.dumps(data, ensure_ascii=False))
+    os.replace(temp_path, path)
+
+
+class JsonIndex:
+    """
+    Entries of a JSON object file, loaded on first use and kept in memory in
+    insertion order. A missing or broken file is an empty index.
+    """
+
+    def __init__(self, path: PathLike[str], private: bool = False):
+        """
+        Args:
+            path (PathLike[str]): path to index file
+            private (bool): keep the file readable by its owner only
+        """
+        self.path = Path(path)
+        self.private = private
+        self._entries: Optional[OrderedDict[str, Any]] = None
+
+    def load(self) -> OrderedDict[str, Any]:
+        """
+        Returns:
+            OrderedDict[str, Any]: entries, changes are written by save()
+        """
+        if self._entries is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._entries = OrderedDict(json.load(f))
+            except (OSError, ValueError, TypeError):
+                self._entries = OrderedDict()
+        return self._entries
+
+    def save(self) -> None:
+        """
+        Writes entries to the index file. Failures are ignored, indexes are
+        only an optimization.
+
+        Returns:
+            None
+        """
+        try:
+            write_json(self.path, self.load(), self.private)
+        except OSError:
+            pass
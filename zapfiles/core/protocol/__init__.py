@@ -0,0 +1,557 @@
+import struct
+from asyncio import StreamReader, StreamWriter
+from typing import Callable, NamedTuple, Optional
+
+from zapfiles.core.crypto import X25519_KEY_SIZE
+
+# Protocol v2: magic and version byte followed by length-prefixed messages
+PROTOCOL_MAGIC = b"ZAP"
+PROTOCOL_VERSION = 2
+MESSAGE = struct.Struct(">BI")
+MAX_MESSAGE_SIZE = 64 * 1024
+
+MESSAGE_HELLO = 1
+MESSAGE_HEADER = 2
+MESSAGE_READY = 3
+# Sent instead of the header when the session ticket isn't accepted
+MESSAGE_RETRY = 4
+# Sent instead of the header when the server doesn't share the requested file
+MESSAGE_NOT_FOUND = 5
+# Sent before the header while the transfer waits for a free slot, only to
+# clients that asked for it
+MESSAGE_QUEUED = 6
+
+# Message fields are encoded as id, length and value. Unknown fields are skipped,
+# so new ones can be added without a new version.
+FIELD = struct.Struct(">BH")
+FIELD_KEY_EXCHANGE = 1
+FIELD_PUBLIC_KEY = 2
+FIELD_RANGE = 3
+FIELD_TRANSPORT = 4
+FIELD_TICKET = 5
+FIELD_FILE_ID = 6
+FIELD_CODECS = 7
+FIELD_QUEUE_UPDATES = 8
+FIELD_WRAPPED_SECRET = 9
+FIELD_WRAPPED_KEY = 16
+FIELD_FILE_SIZE = 17
+FIELD_CHUNK_SIZE = 18
+FIELD_FILE_HASH = 19
+FIELD_CAPABILITIES = 20
+FIELD_NEW_TICKET = 21
+FIELD_TICKET_LIFETIME = 22
+FIELD_CODEC = 23
+FIELD_QUEUE_POSITION = 24
+
+# Capabilities reported by server
+CAPABILITY_RANGES = 1 << 0
+CAPABILITY_TLS = 1 << 1
+CAPABILITY_FRAMED = 1 << 2
+CAPABILITY_X25519 = 1 << 3
+CAPABILITY_TICKETS = 1 << 4
+CAPABILITY_DELTA = 1 << 5
+CAPABILITY_CHUNKED = 1 << 6
+CAPABILITY_COMPRESSION = 1 << 7
+
+U8 = struct.Struct(">B")
+U32 = struct.Struct(">I")
+U64 = struct.Struct(">Q")
+
+# Protocol v1
+# Legacy clients start the conversation with a PEM public key, so a request
+# with this prefix can't be mistaken for one
+RANGE_REQUEST_MAGIC = b"ZAPR"
+RANGE_REQUEST = struct.Struct(">4sQQ")
+
+# Asks for a transport other than the AES-CTR stream, the server answers with the
+# transport it picked right after the file size
+TRANSPORT_REQUEST_MAGIC = b"ZAPT"
+TRANSPORT_REQUEST = struct.Struct(">4sB")
+TRANSPORT_STREAM = 0
+TRANSPORT_TLS = 1
+TRANSPORT_FRAMED = 2
+# Protocol v2 only, the client sends block signatures of its copy and gets
+# the file as copies of its blocks and literal data
+TRANSPORT_DELTA = 3
+# Protocol v2 only, data of any length in sealed chunks followed by its digest,
+# the only way to get a stream
+TRANSPORT_CHUNKED = 4
+
+# Replaces the PEM public key with an X25519 public key. It's terminated like a
+# PEM, so servers without X25519 fail to parse it and close the connection
+X25519_OFFER_MAGIC = b"ZAPX"
+
+# Sent by the client once it's ready for TLS records
+TLS_READY = b"\x01"
+
+# PEM keys written by cryptography end with a newline, which is part of the key
+PEM_END_MARKER = b"-----END PUBLIC KEY-----\n"
+
+# v1 servers read the client public key until this marker, so they reject a
+# v2 hello right away instead of waiting for more data
+HELLO_END = PEM_END_MARKER
+
+KEY_EXCHANGE_RSA = "rsa"
+KEY_EXCHANGE_X25519 = "x25519"
+# Protocol v2 only, public key is a random nonce of the client
+KEY_EXCHANGE_TICKET = "ticket"
+ENCRYPTED_KEY_SIZE = 256
+FILE_SIZE_SIZE = 8
+
+
+class ByteRange(NamedTuple):
+    offset: int
+    length: int
+
+    @property
+    def end(self) -> int:
+        return self.offset + self.length
+
+
+class ClientRequest(NamedTuple):
+    # None for the whole file
+    byte_range: Optional[ByteRange]
+    # None if the client didn't ask for a transport
+    transport: Optional[int]
+    key_exchange: str
+    # PEM for RSA, raw key for X25519
+    public_key: bytes
+    version: int = 1
+    ticket: Optional[bytes] = None
+    # Hash string of the requested file, None for the only file of the server
+    file_id: Optional[str] = None
+    # Compression codecs the client can decode, most preferred first
+    codecs: tuple[str, ...] = ()
+    # Client understands MESSAGE_QUEUED
+    queue_updates: bool = False
+    # Client takes the secret of a new session ticket wrapped after the AES
+    # key, tickets aren't issued to clients without it
+    wrapped_secret: bool = False
+
+
+class ServerHeader(NamedTuple):
+    # RSA-OAEP, X25519 or ticket wrapped AES key, followed by the secret of
+    # the new ticket if there's one
+    wrapped_key: bytes
+    file_size: int
+    # Frame size of the framed transport
+    chunk_size: int
+    # Hash string created by format_hash
+    file_hash: Optional[str]
+    transport: int
+    capabilities: int
+    # Session ticket for the next connection
+    ticket: Optional[bytes] = None
+    ticket_lifetime: int = 0
+    # Codec frames of the framed transport are compressed with, if any
+    codec: Optional[str] = None
+
+
+class TicketRejectedError(Exception):
+    """
+    Raised when the server doesn't accept the session ticket of the client.
+    """
+
+
+class UnknownFileError(Exception):
+    """
+    Raised when the server doesn't share the requested file.
+    """
+
+
+def _encode_fields(fields: dict[int, bytes]) -> bytes:
+    return b"".join(
+        FIELD.pack(field, len(value)) + value for field, value in fields.items()
+    )
+
+
+def _decode_fields(payload: bytes) -> dict[int, bytes]:
+    fields = {}
+    position = 0
+
+    while position < len(payload):
+        if position + FIELD.size > len(payload):
+            raise ValueError("Truncated message field")
+        field, length = FIELD.unpack_from(payload, position)
+        position += FIELD.size
+
+        if position + length > len(payload):
+            raise ValueError("Truncated message field")
+        fields[field] = payload[position : position + length]
+        position += length
+
+    return fields
+
+
+def _pack_message(message_type: int, fields: dict[int, bytes]) -> bytes:
+    payload = _encode_fields(fields)
+    return MESSAGE.pack(message_type, len(payload)) + payload
+
+
+async def _read_any_message(reader: StreamReader) -> tuple[int, dict[int, bytes]]:
+    message_type, length = MESSAGE.unpack(await reader.readexactly(MESSAGE.size))
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message is too large: {length}")
+
+    return message_type, _decode_fields(await reader.readexactly(length))
+
+
+async def read_message(reader: StreamReader, message_type: int) -> dict[int, bytes]:
+    """
+    Reads a single protocol v2 message.
+
+    Args:
+        reader (StreamReader): asyncio StreamReader
+        message_type (int): expected message type
+
+    Returns:
+        dict[int, bytes]: message fields
+
+    Raises:
+        ValueError: If the message is of a different type or malformed.
+    """
+    received_type, fields = await _read_any_message(reader)
+    if received_type != message_type:
+        raise ValueError(f"Unexpected message type: {received_type}")
+    return fields
+
+
+async def send_hello(writer: StreamWriter, request: ClientRequest) -> None:
+    """
+    Starts a protocol v2 conversation with everything the server needs.
+
+    Args:
+        writer (StreamWriter): asyncio StreamWriter
+        request (ClientRequest): request of client
+
+    Returns:
+        None
+    """
+    fields = {
+        FIELD_KEY_EXCHANGE: request.key_exchange.encode("utf-8"),
+        FIELD_PUBLIC_KEY: request.public_key,
+    }
+    if request.byte_range is not None:
+        fields[FIELD_RANGE] = U64.pack(request.byte_range.offset) + U64.pack(
+            request.byte_range.length
+        )
+    if request.transport is not None:
+        fields[FIELD_TRANSPORT] = U8.pack(request.transport)
+    if request.ticket is not None:
+        fields[FIELD_TICKET] = request.ticket
+    if request.file_id is not None:
+        fields[FIELD_FILE_ID] = request.file_id.encode("utf-8")
+    if request.codecs:
+        fields[FIELD_CODECS] = ",".join(request.codecs).encode("utf-8")
+    if request.queue_updates:
+        fields[FIELD_QUEUE_UPDATES] = b""
+    if request.wrapped_secret:
+        fields[FIELD_WRAPPED_SECRET] = b""
+
+    writer.write(
+        PROTOCOL_MAGIC
+        + U8.pack(PROTOCOL_VERSION)
+        + _pack_message(MESSAGE_HELLO, fields)
+        + HELLO_END
+    )
+    await writer.drain()
+
+
+def _decode_hello(fields: dict[int, bytes]) -> ClientRequest:
+    byte_range = None
+    if FIELD_RANGE in fields:
+        byte_range = ByteRange(
+            U64.unpack(fields[FIELD_RANGE][:8])[0],
+            U64.unpack(fields[FIELD_RANGE][8:])[0],
+        )
+
+    transport = None
+    if FIELD_TRANSPORT in fields:
+        transport = U8.unpack(fields[FIELD_TRANSPORT])[0]
+
+    file_id = fields.get(FIELD_FILE_ID)
+    codecs = fields.get(FIELD_CODECS, b"").decode("utf-8", "replace")
+
+    try:
+        return ClientRequest(
+            byte_range,
+            transport,
+            fields[FIELD_KEY_EXCHANGE].decode("utf-8"),
+            fields[FIELD_PUBLIC_KEY],
+            PROTOCOL_VERSION,
+            fields.get(FIELD_TICKET),
+            None if file_id is None else file_id.decode("utf-8"),
+            tuple(codec for codec in codecs.split(",") if codec),
+            FIELD_QUEUE_UPDATES in fields,
+            FIELD_WRAPPED_SECRET in fields,
+        )
+    except KeyError as e:
+        raise ValueError(f"Missing hello field: {e}") from None
+
+
+async def send_header(writer: StreamWriter, header: ServerHeader) -> None:
+    """
+    Answers protocol v2 hello with a single header message.
+
+    Args:
+        writer (StreamWriter): asyncio StreamWriter
+        header (ServerHeader): header
+
+    Returns:
+        None
+    """
+    fields = {
+        FIELD_WRAPPED_KEY: header.wrapped_key,
+        FIELD_FILE_SIZE: U64.pack(header.file_size),
+        FIELD_CHUNK_SIZE: U32.pack(header.chunk_size),
+        FIELD_TRANSPORT: U8.pack(header.transport),
+        FIELD_CAPABILITIES: U32.pack(header.capabilities),
+    }
+    if header.file_hash is not None:
+        fields[FIELD_FILE_HASH] = header.file_hash.encode("utf-8")
+    if header.ticket is not None:
+        fields[FIELD_NEW_TICKET] = header.ticket
+        fields[FIELD_TICKET_LIFETIME] = U32.pack(header.ticket_lifetime)
+    if header.codec is not None:
+        fields[FIELD_CODEC] = header.codec.encode("utf-8")
+
+    writer.write(_pack_message(MESSAGE_HEADER, fields))
+    await writer.drain()
+
+
+async def read_header(
+    reader: StreamReader, on_queued: Optional[Callable[[int], object]] = None
+) -> ServerHeader:
+    """
+    Reads header sent in answer to protocol v2 hello, along with the queue
+    updates sent before it.
+
+    Args:
+        reader (StreamReader): asyncio StreamReader
+        on_queued (Callable[[int], object], optional): called with the position
+            in the server queue on every queue update
+
+    Returns:
+        ServerHeader: header
+
+    Raises:
+        TicketRejectedError: If the server didn't accept the session ticket.
+        UnknownFileError: If the server doesn't share the requested file.
+        ValueError: If the header is malformed.
+    """
+    message_type, fields = await _read_any_message(reader)
+    while message_type == MESSAGE_QUEUED:
+        try:
+            position = U32.unpack(fields[FIELD_QUEUE_POSITION])[0]
+        except (KeyError, struct.error) as e:
+            raise ValueError(f"Malformed queue update: {e}") from None
+        if on_queued is not None:
+            on_queued(position)
+        message_type, fields = await _read_any_message(reader)
+
+    if message_type == MESSAGE_RETRY:
+        raise TicketRejectedError()
+    if message_type == MESSAGE_NOT_FOUND:
+        raise UnknownFileError()
+    if message_type != MESSAGE_HEADER:
+        raise ValueError(f"Unexpected message type: {message_type}")
+
+    try:
+        file_hash = fields.get(FIELD_FILE_HASH)
+        ticket_lifetime = fields.get(FIELD_TICKET_LIFETIME)
+        codec = fields.get(FIELD_CODEC)
+        return ServerHeader(
+            fields[FIELD_WRAPPED_KEY],
+            U64.unpack(fields[FIELD_FILE_SIZE])[0],
+            U32.unpack(fields[FIELD_CHUNK_SIZE])[0],
+            None if file_hash is None else file_hash.decode("utf-8"),
+            U8.unpack(fields[FIELD_TRANSPORT])[0],
+            U32.unpack(fields[FIELD_CAPABILITIES])[0],
+            fields.get(FIELD_NEW_TICKET),
+            0 if ticket_lifetime is None else U32.unpack(ticket_lifetime)[0],
+            None if codec is None else codec.decode("utf-8"),
+        )
+    except (KeyError, struct.error) as e:
+        raise ValueError(f"Malformed header: {e}") from None
+
+
+async def send_retry(writer: StreamWriter) -> None:
+    """
+    Asks the client to connect again with a full key exchange.
+
+    Args:
+        writer (StreamWriter): asyncio StreamWriter
+
+    Returns:
+        None
+    """
+    writer.write(_pack_message(MESSAGE_RETRY, {}))
+    await writer.drain()
+
+
+async def send_queued(writer: StreamWriter, position: int) -> None:
+    """
+    Tells the client where its transfer is in the server queue.
+
+    Args:
+        writer (StreamWriter): asyncio StreamWriter
+        position (int): position in the queue, starting at 1
+
+    Returns:
+        None
+    """
+    writer.write(
+        _pack_message(MESSAGE_QUEUED, {FIELD_QUEUE_POSITION: U32.pack(position)})
+    )
+    await writer.drain()
+
+
+async def send_not_found(writer: StreamWriter) -> None:
+    """
+    Tells the client that the requested file isn't shared.
+
+    Args:
+        writer (StreamWriter): asyncio StreamWriter
+
+    Returns:
+        None
+    """
+    writer.write(_pack_message(MESSAGE_NOT_FOUND, {}))
+    await writer.drain()
+
+
+async def send_ready(writer: StreamWriter, version: int) -> None:
+    """
+    Tells the server that the client is ready for TLS records.
+
+    Args:
+        writer (StreamWriter): asyncio StreamWriter
+        version (int): protocol version of the session
+
+    Returns:
+        None
+    """
+    writer.write(TLS_READY if version < 2 else _pack_message(MESSAGE_READY, {}))
+    await writer.drain()
+
+
+async def read_ready(reader: StreamReader, version: int) -> None:
+    """
+    Waits until the client is ready for TLS records.
+
+    Args:
+        reader (StreamReader): asyncio StreamReader
+        version (int): protocol version of the session
+
+    Returns:
+        None
+    """
+    if version < 2:
+        await reader.readexactly(len(TLS_READY))
+    else:
+        await read_message(reader, MESSAGE_READY)
+
+
+async def send_range_request(writer: StreamWriter, byte_range: ByteRange) -> None:
+    """
+    Asks the server for a byte range of the file instead of the whole file.
+    Must be sent before the public key.
+
+    Args:
+        writer (StreamWriter): asyncio StreamWriter
+        byte_range (ByteRange): requested range
+
+    Returns:
+        None
+    """
+    writer.write(
+        RANGE_REQUEST.pack(RANGE_REQUEST_MAGIC, byte_range.offset, byte_range.length)
+    )
+    await writer.drain()
+
+
+async def send_transport_request(writer: StreamWriter, transport: int) -> None:
+    """
+    Asks the server for a transport. Must be sent before the public key.
+
+    Args:
+        writer (StreamWriter): asyncio StreamWriter
+        transport (int): requested transport, e.g. TRANSPORT_TLS
+
+    Returns:
+        None
+    """
+    writer.write(TRANSPORT_REQUEST.pack(TRANSPORT_REQUEST_MAGIC, transport))
+    await writer.drain()
+
+
+async def send_x25519_offer(writer: StreamWriter, public_key: bytes) -> None:
+    """
+    Sends X25519 public key to server in place of the PEM public key.
+
+    Args:
+        writer (StreamWriter): asyncio StreamWriter
+        public_key (bytes): raw X25519 public key
+
+    Returns:
+        None
+    """
+    writer.write(X25519_OFFER_MAGIC + public_key + PEM_END_MARKER)
+    await writer.drain()
+
+
+async def read_request(reader: StreamReader) -> ClientRequest:
+    """
+    Reads protocol v2 hello or, for v1 clients, optional range and transport
+    requests followed by the client public key.
+
+    Args:
+        reader (StreamReader): asyncio StreamReader
+
+    Returns:
+        ClientRequest: request of client
+
+    Raises:
+        ValueError: If the request is malformed or of an unknown version.
+    """
+    byte_range = None
+    transport = None
+
+    prefix = await reader.readexactly(len(RANGE_REQUEST_MAGIC))
+    if prefix.startswith(PROTOCOL_MAGIC):
+        version = prefix[len(PROTOCOL_MAGIC)]
+        if version == PROTOCOL_VERSION:
+            request = _decode_hello(await read_message(reader, MESSAGE_HELLO))
+            if await reader.readexactly(len(HELLO_END)) != HELLO_END:
+                raise ValueError("Malformed hello")
+            return request
+        if prefix not in (
+            RANGE_REQUEST_MAGIC,
+            TRANSPORT_REQUEST_MAGIC,
+            X25519_OFFER_MAGIC,
+        ):
+            raise ValueError(f"Unsupported protocol version: {version}")
+
+    while True:
+        if prefix == RANGE_REQUEST_MAGIC:
+            _, offset, length = RANGE_REQUEST.unpack(
+                prefix + await reader.readexactly(RANGE_REQUEST.size - len(prefix))
+            )
+            byte_range = ByteRange(offset, length)
+        elif prefix == TRANSPORT_REQUEST_MAGIC:
+            _, transport = TRANSPORT_REQUEST.unpack(
+                prefix + await reader.readexactly(TRANSPORT_REQUEST.size - len(prefix))
+            )
+        else:
+            break
+
+        prefix = await reader.readexactly(len(RANGE_REQUEST_MAGIC))
+
+    if prefix == X25519_OFFER_MAGIC:
+        public_key = await reader.readexactly(X25519_KEY_SIZE)
+        if await reader.readexactly(len(PEM_END_MARKER)) != PEM_END_MARKER:
+            raise ValueError("Malformed X25519 offer")
+        return ClientRequest(byte_range, transport, KEY_EXCHANGE_X25519, public_key)
+
+    public_pem = prefix + await reader.readuntil(PEM_END_MARKER)
+    return ClientRequest(byte_range, transport, KEY_EXCHANGE_RSA, public_pem)
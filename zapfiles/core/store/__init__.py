@@ -0,0 +1,172 @@
+import os
+import shutil
+import sys
+import threading
+from os import PathLike
+from pathlib import Path
+from typing import Iterable, Optional
+
+from zapfiles.constants import ROOT_DIR
+from zapfiles.core.hash import format_hash, parse_hash
+from zapfiles.core.persistence import JsonIndex, get_signature, has_signature
+
+# Linux ioctl sharing the extents of one file with another (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# Oldest entries are dropped past this many
+MAX_ENTRIES = 16384
+
+
+def _reflink(source: Path, target: Path) -> bool:
+    if sys.platform != "linux":
+        return False
+
+    import fcntl
+
+    try:
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        return False  # filesystem can't share extents
+
+
+def _hardlink(source: Path, target: Path) -> bool:
+    try:
+        os.link(source, target)
+        return True
+    except OSError:
+        return False  # other filesystem or no hard link support
+
+
+def place_copy(source: Path, target: Path, hardlink: bool = False) -> None:
+    """
+    Places content of source at target, replacing whatever is there. Tries a
+    reflink first, which costs no space, then a hard link if allowed, then a
+    copy done by the kernel where possible.
+
+    Args:
+        source (Path): file with the content
+        target (Path): path to place it at
+        hardlink (bool): allow hard links, edits of either file change both
+
+    Returns:
+        None
+
+    Raises:
+        OSError: If source can't be read or target can't be written.
+    """
+    temp_path = target.with_name(target.name + ".store")
+    target.parent.mkdir(parents=True, exist_ok=True)
+
+    try:
+        if not _reflink(source, temp_path):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            if not (hardlink and _hardlink(source, temp_path)):
+                shutil.copyfile(source, temp_path)
+        os.replace(temp_path, target)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class ContentStore:
+    """
+    Persistent index of the files the client has downloaded or verified,
+    looked up by hash string.
+
+    Entries are only valid while size, mtime_ns and inode of the file stay the
+    same, so a file edited or replaced since is never handed out.
+    """
+
+    def __init__(self, store_path: PathLike[str]):
+        """
+        Args:
+            store_path (PathLike[str]): path to store file
+        """
+        self.store_path = Path(store_path)
+        self._index = JsonIndex(store_path)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_key(file_hash: str) -> str:
+        # Same content has the same key however the hash string is written
+        algorithm, mode, digest = parse_hash(file_hash)
+        return format_hash(digest, algorithm, mode)
+
+    def find(self, file_hash: str) -> Optional[Path]:
+        """
+        Args:
+            file_hash (str): hash string
+
+        Returns:
+            Optional[Path]: file with this content or None if there is none or
+                it has changed
+        """
+        key = self._make_key(file_hash)
+
+        with self._lock:
+            entries = self._index.load()
+            entry = entries.get(key)
+            if entry is None:
+                return None
+
+            path = Path(entry.get("path", ""))
+            try:
+                current = has_signature(entry, os.stat(path))
+            except OSError:
+                current = False
+
+            if not current:
+                del entries[key]
+                self._index.save()
+                return None
+
+            entries.move_to_end(key)
+            return path
+
+    def add(self, file_hash: str, file_path: PathLike[str]) -> None:
+        """
+        Remembers file with verified content.
+
+        Args:
+            file_hash (str): hash string of file
+            file_path (PathLike[str]): path to file
+
+        Returns:
+            None
+        """
+        self.add_many([(file_hash, file_path)])
+
+    def add_many(self, files: Iterable[tuple[str, PathLike[str]]]) -> None:
+        """
+        Remembers files with verified content, saving the store once.
+
+        Args:
+            files (Iterable[tuple[str, PathLike[str]]]): hash strings and paths
+
+        Returns:
+            None
+        """
+        with self._lock:
+            entries = self._index.load()
+            for file_hash, file_path in files:
+                path = Path(file_path).resolve()
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                key = self._make_key(file_hash)
+                entries[key] = {**get_signature(stat), "path": str(path)}
+                entries.move_to_end(key)
+
+            while len(entries) > MAX_ENTRIES:
+                entries.popitem(last=False)
+
+            self._index.save()
+
+
+content_store = ContentStore(Path(ROOT_DIR) / "cache" / "store.json")
@@ -0,0 +1,175 @@
+import os
+import struct
+import threading
+import time
+from os import PathLike
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from zapfiles.constants import ROOT_DIR
+from zapfiles.core.config.app_configuration import config
+from zapfiles.core.persistence import JsonIndex
+
+TICKET_NONCE_SIZE = 12
+ISSUED_AT = struct.Struct(">Q")
+
+
+class TicketIssuer:
+    """
+    Seals resumption secrets into session tickets only this server can open.
+
+    The ticket key only lives in memory, so restarting the server invalidates
+    every ticket it has issued.
+    """
+
+    def __init__(self, lifetime: int, ticket_key: Optional[bytes] = None):
+        """
+        Args:
+            lifetime (int): number of seconds a ticket is accepted for
+            ticket_key (bytes, optional): AES key to seal tickets with, random
+                if None
+        """
+        self.lifetime = lifetime
+        self._aead = AESGCM(ticket_key or AESGCM.generate_key(bit_length=256))
+
+    def issue(self, secret: bytes) -> bytes:
+        """
+        Args:
+            secret (bytes): resumption secret of the session
+
+        Returns:
+            bytes: opaque ticket for the client
+        """
+        nonce = os.urandom(TICKET_NONCE_SIZE)
+        return nonce + self._aead.encrypt(
+            nonce, ISSUED_AT.pack(int(time.time())) + secret, None
+        )
+
+    def open(self, ticket: bytes) -> Optional[bytes]:
+        """
+        Args:
+            ticket (bytes): ticket presented by client
+
+        Returns:
+            Optional[bytes]: resumption secret or None if the ticket is forged,
+                issued before a restart or expired
+        """
+        try:
+            plaintext = self._aead.decrypt(
+                ticket[:TICKET_NONCE_SIZE], ticket[TICKET_NONCE_SIZE:], None
+            )
+        except (InvalidTag, ValueError):
+            return None
+
+        (issued_at,) = ISSUED_AT.unpack_from(plaintext)
+        if time.time() - issued_at > self.lifetime:
+            return None
+        return plaintext[ISSUED_AT.size :]
+
+
+class Ticket(NamedTuple):
+    ticket: bytes
+    secret: bytes
+    expires_at: float
+
+
+class TicketStore:
+    """
+    Persistent session tickets of the client, one per server address.
+    """
+
+    def __init__(self, store_path: PathLike[str]):
+        """
+        Args:
+            store_path (PathLike[str]): path to store file
+        """
+        self.store_path = Path(store_path)
+        # Tickets are as good as keys to a server, only the owner can read them
+        self._index = JsonIndex(store_path, private=True)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_key(host: str, port: int) -> str:
+        return f"{host}:{port}"
+
+    def get(self, host: str, port: int) -> Optional[Ticket]:
+        """
+        Args:
+            host (str): IP address of server
+            port (int): port of server
+
+        Returns:
+            Optional[Ticket]: ticket or None if there is none or it has expired
+        """
+        key = self._make_key(host, port)
+
+        with self._lock:
+            tickets = self._index.load()
+            entry = tickets.get(key)
+            if entry is None:
+                return None
+
+            try:
+                ticket = Ticket(
+                    bytes.fromhex(entry["ticket"]),
+                    bytes.fromhex(entry["secret"]),
+                    float(entry["expires_at"]),
+                )
+            except (KeyError, ValueError, TypeError):
+                ticket = None
+
+            if ticket is None or ticket.expires_at <= time.time():
+                del tickets[key]
+                self._index.save()
+                return None
+            return ticket
+
+    def put(self, host: str, port: int, ticket: Ticket) -> None:
+        """
+        Stores ticket of server and drops expired ones.
+
+        Args:
+            host (str): IP address of server
+            port (int): port of server
+            ticket (Ticket): ticket
+
+        Returns:
+            None
+        """
+        now = time.time()
+
+        with self._lock:
+            tickets = self._index.load()
+            for key in [
+                key
+                for key, entry in tickets.items()
+                if entry.get("expires_at", 0) <= now
+            ]:
+                del tickets[key]
+
+            tickets[self._make_key(host, port)] = {
+                "ticket": ticket.ticket.hex(),
+                "secret": ticket.secret.hex(),
+                "expires_at": ticket.expires_at,
+            }
+            self._index.save()
+
+    def remove(self, host: str, port: int) -> None:
+        """
+        Args:
+            host (str): IP address of server
+            port (int): port of server
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if self._index.load().pop(self._make_key(host, port), None) is not None:
+                self._index.save()
+
+
+ticket_issuer = TicketIssuer(config.get_value("session_ticket_lifetime"))
+ticket_store = TicketStore(Path(ROOT_DIR) / "cache" / "tickets.json")
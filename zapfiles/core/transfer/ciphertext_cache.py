@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import json
+import os
+from os import PathLike
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from zapfiles.constants import ROOT_DIR
+from zapfiles.core.config.app_configuration import config
+from zapfiles.core.crypto import create_encryptor
+from zapfiles.core.persistence import get_signature, has_signature, write_json
+from zapfiles.core.transfer.sender import AES_BLOCK_PADDING, DEFAULT_CHUNK_SIZE
+
+CIPHERTEXT_SUFFIX = ".bin"
+METADATA_SUFFIX = ".json"
+
+# Files still changing after this many encryptions are sent without the cache
+MAX_BUILD_ATTEMPTS = 3
+
+
+class CachedCiphertext(NamedTuple):
+    path: Path
+    key: bytes
+    size: int
+
+
+class CiphertextCache:
+    """
+    Directory of files encrypted once under their own content key.
+
+    Every client of a cached file gets the same content key wrapped with its own
+    RSA key, so the server encrypts the file once instead of once per connection
+    and can send the ciphertext with sendfile. The ciphertext is identical to the
+    per-connection AES-CTR stream, clients don't need to know about the cache.
+
+    An entry is rebuilt under a new key once size, mtime_ns or inode of the
+    source file change, so a keystream is never reused for different content.
+    Least recently used entries are evicted once the directory grows past
+    max_size.
+    """
+
+    def __init__(self, cache_dir: PathLike[str], max_size: int):
+        """
+        Args:
+            cache_dir (PathLike[str]): directory to store ciphertext in
+            max_size (int): maximum total size of cached ciphertext in bytes
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    def _get_paths(self, file_path: Path) -> tuple[Path, Path]:
+        name = hashlib.sha256(str(file_path).encode("utf-8")).hexdigest()
+        return (
+            self.cache_dir / (name + CIPHERTEXT_SUFFIX),
+            self.cache_dir / (name + METADATA_SUFFIX),
+        )
+
+    async def get(self, file_path: PathLike[str]) -> Optional[CachedCiphertext]:
+        """
+        Returns ciphertext of file, encrypting it first if it isn't cached or the
+        file has changed. Concurrent calls for the same file share one build.
+
+        Args:
+            file_path (PathLike[str]): path to source file
+
+        Returns:
+            Optional[CachedCiphertext]: path to ciphertext, content key and file
+                size, None if the file kept changing while it was encrypted
+        """
+        resolved_path = Path(file_path).resolve()
+        lock = self._locks.setdefault(str(resolved_path), asyncio.Lock())
+
+        async with lock:
+            stat = os.stat(resolved_path)
+            entry = self._load(resolved_path, stat)
+            if entry is None:
+                entry = await asyncio.get_running_loop().run_in_executor(
+                    None, self._build, resolved_path, stat
+                )
+                if entry is None:
+                    return None
+                self._evict(keep=entry.path)
+
+            # Metadata mtime is the last use of the entry
+            os.utime(self._get_paths(resolved_path)[1])
+            return entry
+
+    def _load(
+        self, file_path: Path, stat: os.stat_result
+    ) -> Optional[CachedCiphertext]:
+        ciphertext_path, metadata_path = self._get_paths(file_path)
+
+        try:
+            with open(metadata_path, "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+
+            if has_signature(metadata["signature"], stat) and (
+                os.path.getsize(ciphertext_path) == stat.st_size
+            ):
+                return CachedCiphertext(
+                    ciphertext_path, bytes.fromhex(metadata["key"]), stat.st_size
+                )
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        return None
+
+    def _build(
+        self, file_path: Path, stat: os.stat_result
+    ) -> Optional[CachedCiphertext]:
+        """
+        Encrypts file under a new content key into the cache directory.
+
+        Args:
+            file_path (Path): resolved path to source file
+            stat (os.stat_result): stat of source file
+
+        Returns:
+            Optional[CachedCiphertext]: new entry, None if the file changed
+                during every one of MAX_BUILD_ATTEMPTS encryptions
+        """
+        ciphertext_path, metadata_path = self._get_paths(file_path)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        read_buffer = bytearray(DEFAULT_CHUNK_SIZE)
+        out_buffer = bytearray(DEFAULT_CHUNK_SIZE + AES_BLOCK_PADDING)
+        read_view, out_view = memoryview(read_buffer), memoryview(out_buffer)
+        temp_path = ciphertext_path.with_name(ciphertext_path.name + ".tmp")
+
+        for _ in range(MAX_BUILD_ATTEMPTS):
+            key = os.urandom(32)
+            encryptor = create_encryptor(key)
+
+            with open(file_path, "rb", buffering=0) as source:
+                with open(temp_path, "wb") as target:
+                    while read := source.readinto(read_buffer):
+                        encryptor.update_into(read_view[:read], out_view)
+                        target.write(out_view[:read])
+                    target.write(encryptor.finalize())
+
+            # Not trusting ciphertext of a file that changed while encrypting
+            current = os.stat(file_path)
+            if get_signature(current) == get_signature(stat):
+                break
+            stat = current
+        else:
+            os.remove(temp_path)
+            return None
+
+        os.replace(temp_path, ciphertext_path)
+
+        # Content key decrypts the ciphertext, only the owner can read it
+        metadata = {
+            "path": str(file_path),
+            "signature": get_signature(stat),
+            "key": key.hex(),
+        }
+        write_json(metadata_path, metadata, private=True)
+
+        return CachedCiphertext(ciphertext_path, key, stat.st_size)
+
+    def _evict(self, keep: Path) -> None:
+        """
+        Deletes least recently used entries until the cache fits in max_size.
+
+        Args:
+            keep (Path): ciphertext path of the entry that must stay
+
+        Returns:
+            None
+        """
+        entries = []
+        for metadata_path in self.cache_dir.glob("*" + METADATA_SUFFIX):
+            ciphertext_path = metadata_path.with_suffix(CIPHERTEXT_SUFFIX)
+            try:
+                entries.append(
+                    (
+                        metadata_path.stat().st_mtime,
+                        ciphertext_path.stat().st_size,
+                        ciphertext_path,
+                        metadata_path,
+                    )
+                )
+            except OSError:
+                continue
+
+        total_size = sum(entry[1] for entry in entries)
+        for _, size, ciphertext_path, metadata_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if ciphertext_path == keep:
+                continue
+
+            try:
+                os.remove(ciphertext_path)
+                os.remove(metadata_path)
+                total_size -= size
+            except OSError:
+                pass  # still being sent on Windows, trying again next time
+
+
+ciphertext_cache = CiphertextCache(
+    Path(ROOT_DIR) / "cache" / "ciphertext",
+    config.get_value("ciphertext_cache_max_size"),
+)
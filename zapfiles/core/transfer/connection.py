@@ -0,0 +1,252 @@
+import asyncio
+from asyncio import StreamReader, StreamWriter
+from collections import deque
+from typing import Any, Callable, Coroutine, Optional, TypeVar, cast
+
+T = TypeVar("T")
+
+ConnectionHandler = Callable[[StreamReader, StreamWriter], Coroutine[Any, Any, None]]
+
+# Incoming data is buffered up to twice this before reading is paused
+DEFAULT_LIMIT = 64 * 1024
+
+
+def get_loop_factory(
+    use_uvloop: bool = True,
+) -> Callable[[], asyncio.AbstractEventLoop]:
+    """
+    Args:
+        use_uvloop (bool): use uvloop if it's installed
+
+    Returns:
+        Callable[[], asyncio.AbstractEventLoop]: factory of uvloop loops or of
+            default asyncio loops if uvloop isn't available
+    """
+    if use_uvloop:
+        try:
+            import uvloop  # pyright: ignore[reportMissingImports]
+
+            return uvloop.new_event_loop
+        except ImportError:
+            pass  # optional, e.g. there's no uvloop for Windows
+
+    return asyncio.new_event_loop
+
+
+def run(main: Coroutine[Any, Any, T], use_uvloop: bool = True) -> T:
+    """
+    Runs coroutine like asyncio.run() does, on uvloop if it's installed.
+
+    Args:
+        main (Coroutine): coroutine to run
+        use_uvloop (bool): use uvloop if it's installed
+
+    Returns:
+        T: result of the coroutine
+    """
+    with asyncio.Runner(loop_factory=get_loop_factory(use_uvloop)) as runner:
+        return runner.run(main)
+
+
+class ConnectionWriter(StreamWriter):
+    """
+    StreamWriter of ConnectionProtocol.
+
+    StreamWriter.drain() and wait_closed() call private hooks of
+    StreamReaderProtocol, which may change with any Python release. Both are
+    overridden to ask ConnectionProtocol through its own methods instead, the
+    rest of StreamWriter only forwards to the transport. start_tls() isn't
+    supported, it needs StreamReaderProtocol.
+    """
+
+    def __init__(
+        self,
+        transport: asyncio.Transport,
+        protocol: "ConnectionProtocol",
+        reader: StreamReader,
+        loop: asyncio.AbstractEventLoop,
+    ):
+        """
+        Args:
+            transport (asyncio.Transport): transport of the connection
+            protocol (ConnectionProtocol): protocol of the connection
+            reader (StreamReader): reader of the connection
+            loop (asyncio.AbstractEventLoop): running loop
+        """
+        super().__init__(transport, protocol, reader, loop)
+        self._connection = protocol
+
+    async def drain(self) -> None:
+        """
+        Waits until the transport buffer is below its high-water mark.
+
+        Returns:
+            None
+
+        Raises:
+            ConnectionResetError: If the connection is lost.
+        """
+        if self.transport.is_closing():
+            # Letting connection_lost() run, so writing to a closed socket
+            # raises here
+            await asyncio.sleep(0)
+        await self._connection.wait_writable()
+
+    async def wait_closed(self) -> None:
+        """
+        Waits until the connection is closed.
+
+        Returns:
+            None
+        """
+        await self._connection.wait_closed()
+
+
+class ConnectionProtocol(asyncio.Protocol):
+    """
+    Lean replacement of StreamReaderProtocol for the server.
+
+    Incoming data goes straight into a StreamReader and the handler gets a
+    ConnectionWriter, a StreamWriter, so handlers work with both. Flow control
+    relies on pause_writing() and resume_writing() only: while the transport
+    buffer is below its high-water mark drain() returns without creating any
+    future.
+    """
+
+    def __init__(self, handler: ConnectionHandler, limit: int = DEFAULT_LIMIT):
+        """
+        Args:
+            handler (ConnectionHandler): coroutine function called with reader
+                and writer of every connection
+            limit (int): buffer limit of the reader
+        """
+        self._handler = handler
+        self._limit = limit
+        self._loop = asyncio.get_running_loop()
+
+        self._reader: Optional[StreamReader] = None
+        self._task: Optional[asyncio.Task] = None
+        self._paused = False
+        self._lost = False
+        self._drain_waiters: deque[asyncio.Future[None]] = deque()
+        self._closed: asyncio.Future[None] = self._loop.create_future()
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        # uvloop transports don't subclass asyncio.Transport
+        transport = cast(asyncio.Transport, transport)
+
+        self._reader = StreamReader(self._limit, loop=self._loop)
+        self._reader.set_transport(transport)
+        writer = ConnectionWriter(transport, self, self._reader, self._loop)
+
+        self._task = self._loop.create_task(self._handler(self._reader, writer))
+        self._task.add_done_callback(self._on_handler_done)
+
+    def _on_handler_done(self, task: asyncio.Task) -> None:
+        if task.cancelled():
+            return
+
+        exc = task.exception()
+        if exc is not None:
+            self._loop.call_exception_handler(
+                {
+                    "message": "Unhandled exception in connection handler",
+                    "exception": exc,
+                    "protocol": self,
+                }
+            )
+
+    def data_received(self, data: bytes) -> None:
+        if self._reader is not None:
+            self._reader.feed_data(data)
+
+    def eof_received(self) -> bool:
+        if self._reader is not None:
+            self._reader.feed_eof()
+        # Keeping the transport open, the server may still be sending
+        return True
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self._lost = True
+
+        if self._reader is not None:
+            if exc is None:
+                self._reader.feed_eof()
+            else:
+                self._reader.set_exception(exc)
+
+        while self._drain_waiters:
+            waiter = self._drain_waiters.popleft()
+            if waiter.done():
+                continue
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exc)
+
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def pause_writing(self) -> None:
+        self._paused = True
+
+    def resume_writing(self) -> None:
+        self._paused = False
+
+        while self._drain_waiters:
+            waiter = self._drain_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait_writable(self) -> None:
+        """
+        Waits while writing is paused.
+
+        Returns:
+            None
+
+        Raises:
+            ConnectionResetError: If the connection is lost.
+        """
+        if self._lost:
+            raise ConnectionResetError("Connection lost")
+        if not self._paused:
+            return
+
+        waiter = self._loop.create_future()
+        self._drain_waiters.append(waiter)
+        await waiter
+
+    async def wait_closed(self) -> None:
+        """
+        Waits until the connection is lost.
+
+        Returns:
+            None
+        """
+        await asyncio.shield(self._closed)
+
+
+async def start_protocol_server(
+    handler: ConnectionHandler,
+    host: Optional[str],
+    port: int,
+    limit: int = DEFAULT_LIMIT,
+) -> asyncio.Server:
+    """
+    Starts a server like asyncio.start_server() does, on ConnectionProtocol.
+
+    Args:
+        handler (ConnectionHandler): coroutine function called with reader and
+            writer of every connection
+        host (str, optional): address to listen on, every address if None
+        port (int): port to listen on
+        limit (int): buffer limit of readers
+
+    Returns:
+        asyncio.Server: server, already listening
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(
+        lambda: ConnectionProtocol(handler, limit), host, port
+    )
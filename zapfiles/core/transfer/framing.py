@@ -0,0 +1,321 @@
+import asyncio
+import os
+import struct
+from asyncio import StreamWriter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BufferedIOBase, RawIOBase
+from typing import Callable, Iterator, Optional
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from zapfiles.core.admission import RateLimiter
+from zapfiles.core.compression import MIN_SAVING, Codec
+from zapfiles.core.protocol import ByteRange
+from zapfiles.core.transfer.readahead import DEFAULT_READ_AHEAD_DEPTH, ReadAheadReader
+from zapfiles.core.transfer.receiver import Readable, Writable, read_exactly
+from zapfiles.core.transfer.sender import DEFAULT_HIGH_WATER_MARK
+
+FRAME_SIZE = 1024 * 1024
+TAG_SIZE = 16
+
+# Nonce is the frame counter of the session, the key is never shared
+NONCE_PREFIX = bytes(4)
+FRAME_POSITION = struct.Struct(">QQ")
+
+# With a codec frames vary in size, each is preceded by a flag and its sealed
+# size. The flag is authenticated along with the frame position
+COMPRESSED_FRAME = struct.Struct(">BI")
+FRAME_STORED = 0
+FRAME_COMPRESSED = 1
+
+
+class CorruptedFrameError(Exception):
+    """
+    Raised when a frame fails authentication. Everything before offset has
+    already been written and can be trusted.
+    """
+
+    def __init__(self, offset: int):
+        """
+        Args:
+            offset (int): file offset of the first byte of the frame
+        """
+        super().__init__(f"Frame at offset {offset} failed authentication")
+        self.offset = offset
+
+
+def iter_frames(
+    byte_range: ByteRange, frame_size: int = FRAME_SIZE
+) -> Iterator[ByteRange]:
+    """
+    Splits byte range into frames. Only the last frame can be shorter.
+
+    Args:
+        byte_range (ByteRange): transferred range
+        frame_size (int): size of a frame
+
+    Returns:
+        Iterator[ByteRange]: frames in file offsets
+    """
+    for offset in range(byte_range.offset, byte_range.end, frame_size):
+        yield ByteRange(offset, min(frame_size, byte_range.end - offset))
+
+
+def _get_nonce(index: int) -> bytes:
+    return NONCE_PREFIX + index.to_bytes(8, "big")
+
+
+def _get_workers() -> int:
+    return os.cpu_count() or 1
+
+
+class FramedSender:
+    """
+    Seals fixed-size frames with AES-GCM and sends them in order.
+    Frames are independent, so several are compressed and sealed in a thread
+    pool at once.
+    """
+
+    def __init__(
+        self,
+        frame_size: int = FRAME_SIZE,
+        high_water_mark: int = DEFAULT_HIGH_WATER_MARK,
+        codec: Optional[Codec] = None,
+        read_ahead_depth: int = DEFAULT_READ_AHEAD_DEPTH,
+        use_mmap: bool = False,
+    ):
+        """
+        Args:
+            frame_size (int): size of a frame in bytes
+            high_water_mark (int): transport buffer size that triggers drain()
+            codec (Codec, optional): codec frames are compressed with, the
+                receiver must use the same
+            read_ahead_depth (int): number of frames read ahead of the send loop
+            use_mmap (bool): map files instead of reading them
+        """
+        if frame_size <= 0:
+            raise ValueError("frame_size must be positive")
+
+        self.frame_size = frame_size
+        self.high_water_mark = max(high_water_mark, frame_size)
+        self.codec = codec
+        self.read_ahead_depth = read_ahead_depth
+        self.use_mmap = use_mmap
+
+    async def send(
+        self,
+        writer: StreamWriter,
+        aes_key: bytes,
+        source: RawIOBase | BufferedIOBase,
+        byte_range: ByteRange,
+        on_progress: Optional[Callable[[int], object]] = None,
+        limiter: Optional[RateLimiter] = None,
+    ) -> int:
+        """
+        Reads byte range from source positioned at its offset and sends it as
+        sealed frames.
+
+        Args:
+            writer (StreamWriter): asyncio StreamWriter
+            aes_key (bytes): session key, must not be used for anything else
+            source (BinaryIO): file opened in binary mode
+            byte_range (ByteRange): range to send
+            on_progress (Callable[[int], object], optional): called with the
+                number of plaintext bytes after each frame
+            limiter (RateLimiter, optional): paces the sent data
+
+        Returns:
+            int: number of plaintext bytes sent
+        """
+        loop = asyncio.get_running_loop()
+        aead = AESGCM(aes_key)
+        writer.transport.set_write_buffer_limits(high=self.high_water_mark)
+
+        workers = _get_workers()
+        in_flight: deque[tuple[asyncio.Future[bytes], int]] = deque()
+        sent = 0
+
+        def seal(index: int, frame: ByteRange, data: bytes) -> bytes:
+            position = FRAME_POSITION.pack(*frame)
+            if self.codec is None:
+                return aead.encrypt(_get_nonce(index), data, position)
+
+            # Frames that barely shrink are sent as they are
+            flag, payload = FRAME_STORED, data
+            compressed = self.codec.compress(data)
+            if len(compressed) <= len(data) * (1 - MIN_SAVING):
+                flag, payload = FRAME_COMPRESSED, compressed
+
+            sealed = aead.encrypt(_get_nonce(index), payload, position + bytes([flag]))
+            return COMPRESSED_FRAME.pack(flag, len(sealed)) + sealed
+
+        async def send_next() -> None:
+            nonlocal sent
+            future, size = in_flight.popleft()
+            frame = await future
+            if limiter is not None:
+                await limiter.consume(len(frame))
+            writer.write(frame)
+
+            sent += size
+            if on_progress is not None:
+                on_progress(size)
+
+            if writer.transport.get_write_buffer_size() > self.high_water_mark:
+                await writer.drain()
+
+        with ThreadPoolExecutor(workers) as pool:
+            async with ReadAheadReader(
+                source,
+                byte_range.length,
+                self.frame_size,
+                self.read_ahead_depth,
+                self.use_mmap,
+            ) as file_reader:
+                for index, frame in enumerate(iter_frames(byte_range, self.frame_size)):
+                    chunk = await file_reader.read()
+                    if len(chunk) != frame.length:
+                        raise EOFError("File is shorter than its size")
+
+                    # Sealing a copy, the chunk's buffer is reused by the next read
+                    data = bytes(chunk)
+                    in_flight.append(
+                        (
+                            loop.run_in_executor(pool, seal, index, frame, data),
+                            frame.length,
+                        )
+                    )
+
+                    if len(in_flight) >= workers * 2:
+                        await send_next()
+
+            while in_flight:
+                await send_next()
+
+        await writer.drain()
+        return sent
+
+
+class FramedReceiver:
+    """
+    Receives frames sealed by FramedSender, opens them in a thread pool and
+    writes them in order.
+    """
+
+    def __init__(
+        self,
+        frame_size: int = FRAME_SIZE,
+        queue_depth: int = 4,
+        codec: Optional[Codec] = None,
+    ):
+        """
+        Args:
+            frame_size (int): size of a frame in bytes
+            queue_depth (int): number of frames being opened per worker
+            codec (Codec, optional): codec picked by the sender
+        """
+        if frame_size <= 0 or queue_depth <= 0:
+            raise ValueError("frame_size and queue_depth must be positive")
+
+        self.frame_size = frame_size
+        self.queue_depth = queue_depth
+        self.codec = codec
+
+    async def receive(
+        self,
+        reader: Readable,
+        aes_key: bytes,
+        target: Writable,
+        byte_range: ByteRange,
+        on_progress: Optional[Callable[[int], object]] = None,
+    ) -> int:
+        """
+        Receives byte range and writes it to target.
+
+        Args:
+            reader (Readable): asyncio StreamReader
+            aes_key (bytes): session key
+            target (Writable): file-like writer positioned at the range offset
+            byte_range (ByteRange): range to receive
+            on_progress (Callable[[int], object], optional): called with the
+                number of received plaintext bytes
+
+        Returns:
+            int: number of bytes written
+
+        Raises:
+            CorruptedFrameError: If a frame fails authentication.
+        """
+        loop = asyncio.get_running_loop()
+        aead = AESGCM(aes_key)
+
+        workers = _get_workers()
+        in_flight: deque[asyncio.Future[bytes]] = deque()
+        written = 0
+
+        def open_frame(
+            index: int, frame: ByteRange, sealed: bytes, flag: Optional[int]
+        ) -> bytes:
+            position = FRAME_POSITION.pack(*frame)
+            try:
+                if flag is None:
+                    return aead.decrypt(_get_nonce(index), sealed, position)
+                data = aead.decrypt(_get_nonce(index), sealed, position + bytes([flag]))
+            except InvalidTag:
+                raise CorruptedFrameError(frame.offset) from None
+
+            if flag == FRAME_STORED and len(data) == frame.length:
+                return data
+            if flag == FRAME_COMPRESSED and self.codec is not None:
+                try:
+                    return self.codec.decompress(data, frame.length)
+                except ValueError:
+                    pass
+            raise CorruptedFrameError(frame.offset)
+
+        # Frames are opened in the pool and written by a single thread in order
+        with (
+            ThreadPoolExecutor(workers) as pool,
+            ThreadPoolExecutor(1) as write_pool,
+        ):
+            pending_write: Optional[asyncio.Future[int]] = None
+
+            async def write_next() -> None:
+                nonlocal pending_write, written
+                data = await in_flight.popleft()
+
+                if pending_write is not None:
+                    written += await pending_write
+                pending_write = loop.run_in_executor(write_pool, target.write, data)
+
+            try:
+                for index, frame in enumerate(iter_frames(byte_range, self.frame_size)):
+                    flag, size = None, frame.length + TAG_SIZE
+                    if self.codec is not None:
+                        header = await read_exactly(reader, COMPRESSED_FRAME.size)
+                        flag, size = COMPRESSED_FRAME.unpack(header)
+                        if size > frame.length + TAG_SIZE:
+                            raise CorruptedFrameError(frame.offset)
+
+                    sealed = await read_exactly(reader, size)
+                    in_flight.append(
+                        loop.run_in_executor(
+                            pool, open_frame, index, frame, sealed, flag
+                        )
+                    )
+                    if on_progress is not None:
+                        on_progress(frame.length)
+
+                    if len(in_flight) >= workers * self.queue_depth:
+                        await write_next()
+
+                while in_flight:
+                    await write_next()
+            finally:
+                # Frames after a bad one are dropped, earlier ones are kept
+                if pending_write is not None:
+                    written += await pending_write
+
+        return written
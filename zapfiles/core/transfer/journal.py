@@ -0,0 +1,281 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from os import PathLike
+from pathlib import Path
+from typing import Optional
+
+from zapfiles.core.protocol import ByteRange
+from zapfiles.core.transfer.receiver import Writable
+
+PART_SUFFIX = ".part"
+JOURNAL_SUFFIX = ".journal"
+
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+BLOCK_HASH_ALGORITHM = "sha256"
+
+# Journal is rewritten at most this often while blocks are being committed
+SAVE_INTERVAL = 2.0
+
+
+def get_part_path(file_path: PathLike[str]) -> Path:
+    """
+    Returns path of the partial file used while downloading file_path.
+
+    Args:
+        file_path (PathLike[str]): final path of file
+
+    Returns:
+        Path: path to partial file
+    """
+    return Path(str(file_path) + PART_SUFFIX)
+
+
+class DownloadJournal:
+    """
+    Sidecar of a .part file that records which blocks are already on disk.
+
+    Every committed block is stored with its digest, so a resumed download can
+    check the partial file before trusting it. Blocks are fixed in size and
+    independent, which lets striped downloads commit them out of order.
+    """
+
+    def __init__(
+        self,
+        part_path: PathLike[str],
+        file_hash: str,
+        file_size: int,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        blocks: Optional[dict[int, str]] = None,
+    ):
+        """
+        Args:
+            part_path (PathLike[str]): path to partial file
+            file_hash (str): expected hash of the whole file
+            file_size (int): expected size of the whole file
+            block_size (int): size of a single journal block
+            blocks (dict[int, str], optional): digests of committed blocks
+        """
+        self.part_path = Path(part_path)
+        self.path = Path(str(part_path) + JOURNAL_SUFFIX)
+        self.file_hash = file_hash
+        self.file_size = file_size
+        self.block_size = block_size
+        self.blocks: dict[int, str] = blocks or {}
+
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+
+    @classmethod
+    def load(
+        cls, part_path: PathLike[str], file_hash: str
+    ) -> Optional["DownloadJournal"]:
+        """
+        Loads journal of a partial download.
+
+        Args:
+            part_path (PathLike[str]): path to partial file
+            file_hash (str): expected hash of the whole file
+
+        Returns:
+            Optional[DownloadJournal]: journal or None if there's nothing to
+                resume or it belongs to a different file
+        """
+        journal_path = Path(str(part_path) + JOURNAL_SUFFIX)
+        if not os.path.exists(part_path) or not journal_path.exists():
+            return None
+
+        try:
+            with open(journal_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+
+            if data["hash"] != file_hash:
+                return None
+
+            return cls(
+                part_path,
+                file_hash,
+                int(data["size"]),
+                int(data["block_size"]),
+                {int(index): digest for index, digest in data["blocks"].items()},
+            )
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    @property
+    def block_count(self) -> int:
+        return -(-self.file_size // self.block_size)
+
+    @property
+    def committed(self) -> int:
+        """
+        Returns:
+            int: number of bytes already on disk
+        """
+        return sum(self.get_block(index).length for index in self.blocks)
+
+    def get_block(self, index: int) -> ByteRange:
+        """
+        Args:
+            index (int): block index
+
+        Returns:
+            ByteRange: byte range covered by the block
+        """
+        offset = index * self.block_size
+        return ByteRange(offset, min(self.block_size, self.file_size - offset))
+
+    def is_complete(self) -> bool:
+        return len(self.blocks) >= self.block_count
+
+    def missing_ranges(self) -> list[ByteRange]:
+        """
+        Returns byte ranges that still have to be downloaded.
+        Adjacent missing blocks are merged, so every range starts on a block boundary.
+
+        Returns:
+            list[ByteRange]: missing byte ranges
+        """
+        ranges: list[ByteRange] = []
+
+        for index in range(self.block_count):
+            if index in self.blocks:
+                continue
+
+            block = self.get_block(index)
+            if ranges and ranges[-1].end == block.offset:
+                ranges[-1] = ByteRange(
+                    ranges[-1].offset, ranges[-1].length + block.length
+                )
+            else:
+                ranges.append(block)
+
+        return ranges
+
+    def verify(self) -> int:
+        """
+        Re-hashes committed blocks and forgets the ones that don't match the disk.
+
+        Returns:
+            int: number of bytes that are still committed
+        """
+        with open(self.part_path, "rb") as f:
+            for index in sorted(self.blocks):
+                block = self.get_block(index)
+                f.seek(block.offset)
+                data = f.read(block.length)
+
+                digest = hashlib.new(BLOCK_HASH_ALGORITHM, data).hexdigest()
+                if len(data) != block.length or digest != self.blocks[index]:
+                    del self.blocks[index]
+
+        self.save()
+        return self.committed
+
+    def commit(self, index: int, digest: str) -> None:
+        """
+        Marks block as written. Thread-safe.
+
+        Args:
+            index (int): block index
+            digest (str): digest of block data
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.blocks[index] = digest
+            if time.monotonic() - self._last_save >= SAVE_INTERVAL:
+                self._save()
+
+    def save(self) -> None:
+        """
+        Atomically writes journal to disk. Thread-safe.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._save()
+
+    def _save(self) -> None:
+        data = {
+            "hash": self.file_hash,
+            "size": self.file_size,
+            "block_size": self.block_size,
+            "committed": self.committed,
+            "blocks": {str(index): digest for index, digest in self.blocks.items()},
+        }
+
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(data, ensure_ascii=False))
+        os.replace(temp_path, self.path)
+
+        self._last_save = time.monotonic()
+
+    def remove(self) -> None:
+        """
+        Deletes journal file.
+
+        Returns:
+            None
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class JournaledWriter:
+    """
+    File-like wrapper that hashes written data block by block and commits
+    every finished block to the journal.
+    Writes must start on a block boundary and be sequential.
+    """
+
+    def __init__(self, target: Writable, journal: DownloadJournal, offset: int = 0):
+        """
+        Args:
+            target (Writable): underlying writer
+            journal (DownloadJournal): journal to commit blocks to
+            offset (int): position of the first written byte, block aligned
+        """
+        if offset % journal.block_size:
+            raise ValueError("offset must be aligned to the journal block size")
+
+        self.target = target
+        self.journal = journal
+        self.position = offset
+        self._hasher = hashlib.new(BLOCK_HASH_ALGORITHM)
+
+    def write(self, data) -> int:
+        """
+        Writes data and commits blocks finished by it.
+
+        Args:
+            data (bytes-like): data to write
+
+        Returns:
+            int: number of bytes written
+        """
+        view = memoryview(data).cast("B")
+        size = len(view)
+        self.target.write(view)
+
+        while view:
+            index = self.position // self.journal.block_size
+            block = self.journal.get_block(index)
+            part = view[: block.end - self.position]
+
+            self._hasher.update(part)
+            self.position += len(part)
+            view = view[len(part) :]
+
+            if self.position == block.end:
+                self.journal.commit(index, self._hasher.hexdigest())
+                self._hasher = hashlib.new(BLOCK_HASH_ALGORITHM)
+
+        return size
@@ -0,0 +1,169 @@
+import socket
+import struct
+import sys
+from asyncio import IncompleteReadError, StreamReader
+from typing import Any, NamedTuple
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# Linux uapi values, Python doesn't export them
+TCP_ULP = 31
+SOL_TLS = 282
+TLS_TX = 1
+TLS_RX = 2
+TLS_1_2_VERSION = 0x0303
+TLS_CIPHER_AES_GCM_256 = 52
+
+# struct tls12_crypto_info_aes_gcm_256: version, cipher, iv, key, salt, rec_seq
+CRYPTO_INFO = struct.Struct("=HH8s32s4s8s")
+
+RECORD_HEADER = struct.Struct(">BHH")
+APPLICATION_DATA = 23
+EXPLICIT_NONCE_SIZE = 8
+TAG_SIZE = 16
+
+KEY_DERIVATION_INFO = b"zapfiles ktls"
+
+
+class TlsKeys(NamedTuple):
+    key: bytes
+    salt: bytes
+
+
+def derive_tls_keys(aes_key: bytes) -> TlsKeys:
+    """
+    Derives AES-GCM record keys from the session key, so the same key is never
+    used for both AES-CTR and AES-GCM.
+
+    Args:
+        aes_key (bytes): session key from the RSA exchange
+
+    Returns:
+        TlsKeys: record key and implicit nonce salt
+    """
+    material = HKDF(
+        algorithm=hashes.SHA256(), length=36, salt=None, info=KEY_DERIVATION_INFO
+    ).derive(aes_key)
+    return TlsKeys(material[:32], material[32:])
+
+
+def attach(sock: Any) -> bool:
+    """
+    Attaches the kernel TLS upper layer protocol to a connected TCP socket.
+    Data keeps flowing in the clear until keys are installed.
+
+    Args:
+        sock (socket.socket): connected TCP socket
+
+    Returns:
+        bool: False if the platform or kernel doesn't support kTLS
+    """
+    if sys.platform != "linux" or sock is None:
+        return False
+
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_ULP, b"tls")
+        return True
+    except OSError:
+        return False  # tls module isn't loaded
+
+
+def install(sock: Any, direction: int, keys: TlsKeys) -> bool:
+    """
+    Installs record keys into an attached socket. Both sides start with record
+    sequence number 0.
+
+    Args:
+        sock (socket.socket): socket passed to attach()
+        direction (int): TLS_TX or TLS_RX
+        keys (TlsKeys): record keys
+
+    Returns:
+        bool: False if the kernel rejected the keys
+    """
+    crypto_info = CRYPTO_INFO.pack(
+        TLS_1_2_VERSION,
+        TLS_CIPHER_AES_GCM_256,
+        bytes(EXPLICIT_NONCE_SIZE),
+        keys.key,
+        keys.salt,
+        bytes(8),
+    )
+
+    try:
+        sock.setsockopt(SOL_TLS, direction, crypto_info)
+        return True
+    except OSError:
+        return False
+
+
+class TlsRecordReader:
+    """
+    Reads TLS 1.2 AES-GCM application data records sent by a kTLS socket and
+    decrypts them in user space, for clients without kTLS.
+    Has the read() method of StreamReader.
+    """
+
+    def __init__(self, reader: StreamReader, keys: TlsKeys):
+        """
+        Args:
+            reader (StreamReader): asyncio StreamReader
+            keys (TlsKeys): record keys
+        """
+        self.reader = reader
+        self._aead = AESGCM(keys.key)
+        self._salt = keys.salt
+        self._sequence = 0
+        self._pending = memoryview(b"")
+
+    async def read(self, n: int = -1) -> bytes:
+        """
+        Reads up to n bytes of plaintext.
+
+        Args:
+            n (int): maximum number of bytes, the rest of a record if -1
+
+        Returns:
+            bytes: plaintext, empty at EOF
+
+        Raises:
+            ValueError: If a record is not application data or fails
+                authentication.
+        """
+        if not self._pending:
+            try:
+                header = await self.reader.readexactly(RECORD_HEADER.size)
+            except IncompleteReadError as e:
+                if not e.partial:
+                    return b""
+                raise
+
+            content_type, version, length = RECORD_HEADER.unpack(header)
+            if content_type != APPLICATION_DATA:
+                raise ValueError(f"Unexpected TLS record type: {content_type}")
+
+            record = await self.reader.readexactly(length)
+            plain_size = length - EXPLICIT_NONCE_SIZE - TAG_SIZE
+            associated_data = self._sequence.to_bytes(8, "big") + RECORD_HEADER.pack(
+                content_type, version, plain_size
+            )
+
+            try:
+                self._pending = memoryview(
+                    self._aead.decrypt(
+                        self._salt + record[:EXPLICIT_NONCE_SIZE],
+                        record[EXPLICIT_NONCE_SIZE:],
+                        associated_data,
+                    )
+                )
+            except InvalidTag:
+                raise ValueError("TLS record failed authentication") from None
+            self._sequence += 1
+
+        size = len(self._pending) if n < 0 else n
+        data = bytes(self._pending[:size])
+        self._pending = self._pending[size:]
+        return data
@@ -0,0 +1,367 @@
+import hashlib
+import struct
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from io import FileIO, RawIOBase
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO, Iterable, NamedTuple, Optional
+
+from zapfiles.core.hash import StreamHasher, format_hash, parse_hash
+
+# Every entry is a header, its relative posix path, its hash string and its data
+ENTRY_HEADER = struct.Struct(">HHQ")
+
+# Hash mode of directory hash strings, e.g. sha256.dir.<digest>
+DIRECTORY_MODE = "dir"
+
+# Files up to this size are buffered whole and written by the thread pool
+SMALL_FILE_SIZE = 1024 * 1024
+
+# Buffered data waiting for the thread pool, writing blocks past it
+MAX_PENDING_SIZE = 64 * 1024 * 1024
+
+
+class PackedEntry(NamedTuple):
+    # Path relative to the directory, with forward slashes
+    name: str
+    size: int
+    file_hash: str
+    # Only needed by PackedReader
+    path: Optional[Path] = None
+
+
+class MalformedPackError(Exception):
+    """
+    Raised when a packed stream can't be unpacked.
+    """
+
+
+def get_directory_hash(entries: Iterable[PackedEntry], algorithm: str) -> str:
+    """
+    Hashes the manifest of a directory, the sorted names and hash strings of
+    its files.
+
+    Args:
+        entries (Iterable[PackedEntry]): files of directory
+        algorithm (str): hash algorithm
+
+    Returns:
+        str: hash string in DIRECTORY_MODE
+    """
+    manifest = hashlib.new(algorithm)
+    for entry in sorted(entries, key=lambda entry: entry.name):
+        manifest.update(f"{entry.file_hash} {entry.name}\n".encode("utf-8"))
+    return format_hash(manifest.hexdigest(), algorithm, DIRECTORY_MODE)
+
+
+def is_directory_hash(file_hash: str) -> bool:
+    """
+    Args:
+        file_hash (str): hash string
+
+    Returns:
+        bool: True if hash string was created by get_directory_hash
+    """
+    return parse_hash(file_hash)[1] == DIRECTORY_MODE
+
+
+def _pack_header(entry: PackedEntry) -> bytes:
+    name = entry.name.encode("utf-8")
+    file_hash = entry.file_hash.encode("ascii")
+    return ENTRY_HEADER.pack(len(name), len(file_hash), entry.size) + name + file_hash
+
+
+def get_packed_size(entries: Iterable[PackedEntry]) -> int:
+    """
+    Args:
+        entries (Iterable[PackedEntry]): files to pack
+
+    Returns:
+        int: size of the packed stream in bytes
+    """
+    return sum(len(_pack_header(entry)) + entry.size for entry in entries)
+
+
+class PackedReader(RawIOBase):
+    """
+    Reads files of a directory as one packed stream, opening them one by one.
+    Nothing is staged on disk.
+
+    Every entry has exactly the size from its header. A file that has shrunk is
+    padded with zeros and one that has grown is cut, the receiver then finds
+    its hash doesn't match.
+    """
+
+    def __init__(self, entries: Iterable[PackedEntry]):
+        """
+        Args:
+            entries (Iterable[PackedEntry]): files to pack, with paths
+        """
+        super().__init__()
+        self._entries = deque(entries)
+        self._header = memoryview(b"")
+        self._file: Optional[FileIO] = None
+        self._remaining = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def _next_entry(self) -> bool:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if not self._entries:
+            return False
+
+        entry = self._entries.popleft()
+        if entry.path is None:
+            raise ValueError(f"Entry without path: {entry.name}")
+
+        self._header = memoryview(_pack_header(entry))
+        self._file = open(entry.path, "rb", buffering=0)
+        self._remaining = entry.size
+        return True
+
+    def readinto(self, buffer) -> int:
+        """
+        Fills buffer with the next part of the stream.
+
+        Args:
+            buffer (bytes-like): writable buffer
+
+        Returns:
+            int: number of bytes read, 0 at the end of the stream
+        """
+        view = memoryview(buffer).cast("B")
+        filled = 0
+
+        while filled < len(view):
+            if self._header:
+                size = min(len(self._header), len(view) - filled)
+                view[filled : filled + size] = self._header[:size]
+                self._header = self._header[size:]
+                filled += size
+            elif self._remaining and self._file is not None:
+                limit = min(self._remaining, len(view) - filled)
+                read = self._file.readinto(view[filled : filled + limit])
+                if not read:
+                    # File has shrunk, padding it to the announced size
+                    view[filled : filled + limit] = bytes(limit)
+                    read = limit
+                self._remaining -= read
+                filled += read
+            elif not self._next_entry():
+                break
+
+        return filled
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        super().close()
+
+
+def _get_target_path(target_dir: Path, name: str) -> Path:
+    """
+    Args:
+        target_dir (Path): directory to unpack into
+        name (str): entry name from the stream
+
+    Returns:
+        Path: path inside target_dir
+
+    Raises:
+        MalformedPackError: If the name points outside target_dir.
+    """
+    parts = PurePosixPath(name).parts
+    if (
+        not parts
+        or name.startswith("/")
+        or any(part in ("", ".", "..") or "\\" in part or ":" in part for part in parts)
+    ):
+        raise MalformedPackError(f"Unsafe entry name: {name!r}")
+    return target_dir.joinpath(*parts)
+
+
+def _write_small_file(path: Path, data: bytes, file_hash: str) -> bool:
+    with open(path, "wb") as f:
+        f.write(data)
+
+    hasher = StreamHasher.from_hash(file_hash)
+    hasher.update(data)
+    return hasher.hexdigest() == parse_hash(file_hash)[2]
+
+
+class PackedWriter:
+    """
+    Unpacks a packed stream into a directory while it's written, so it can be
+    the target of a transfer.
+
+    Large files are written and hashed as their data arrives. Small files are
+    buffered whole and written by a thread pool, creating them is what takes
+    the most time. Writes must be sequential.
+    """
+
+    def __init__(self, target_dir: Path, workers: int = 4):
+        """
+        Args:
+            target_dir (Path): directory to unpack into
+            workers (int): number of threads writing small files
+        """
+        self.target_dir = target_dir
+        self.entries: list[PackedEntry] = []
+        self.failed: list[str] = []
+
+        self._pool = ThreadPoolExecutor(workers)
+        self._pending: deque[tuple[str, int, Future[bool]]] = deque()
+        self._pending_size = 0
+
+        self._header = bytearray()
+        self._entry: Optional[PackedEntry] = None
+        self._remaining = 0
+        self._buffer: Optional[bytearray] = None
+        self._file: Optional[BinaryIO] = None
+        self._hasher: Optional[StreamHasher] = None
+
+    def _collect(self, block: bool) -> None:
+        while self._pending and (block or self._pending[0][2].done()):
+            name, size, future = self._pending.popleft()
+            self._pending_size -= size
+            try:
+                if not future.result():
+                    self.failed.append(name)
+            except OSError:
+                self.failed.append(name)
+
+    def _start_entry(self) -> bool:
+        """
+        Parses the entry header once it's complete.
+
+        Returns:
+            bool: True if the header is complete
+        """
+        if len(self._header) < ENTRY_HEADER.size:
+            return False
+        name_size, hash_size, size = ENTRY_HEADER.unpack_from(self._header)
+        if len(self._header) < ENTRY_HEADER.size + name_size + hash_size:
+            return False
+
+        try:
+            position = ENTRY_HEADER.size
+            name = self._header[position : position + name_size].decode("utf-8")
+            position += name_size
+            file_hash = self._header[position : position + hash_size].decode("ascii")
+        except UnicodeDecodeError:
+            raise MalformedPackError("Malformed entry header") from None
+
+        path = _get_target_path(self.target_dir, name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._entry = PackedEntry(name, size, file_hash, path)
+        self._remaining = size
+        self._header.clear()
+
+        if size <= SMALL_FILE_SIZE:
+            self._buffer = bytearray()
+        else:
+            self._file = open(path, "wb")
+            self._hasher = StreamHasher.from_hash(file_hash)
+        return True
+
+    def _finish_entry(self) -> None:
+        entry = self._entry
+        if entry is None or entry.path is None:
+            return
+        self.entries.append(entry)
+
+        if self._buffer is not None:
+            data = bytes(self._buffer)
+            self._pending.append(
+                (
+                    entry.name,
+                    len(data),
+                    self._pool.submit(
+                        _write_small_file, entry.path, data, entry.file_hash
+                    ),
+                )
+            )
+            self._pending_size += len(data)
+            self._buffer = None
+
+            self._collect(block=False)
+            while self._pending_size > MAX_PENDING_SIZE:
+                wait([self._pending[0][2]])
+                self._collect(block=False)
+        elif self._file is not None and self._hasher is not None:
+            self._file.close()
+            if self._hasher.hexdigest() != parse_hash(entry.file_hash)[2]:
+                self.failed.append(entry.name)
+            self._file = None
+            self._hasher = None
+
+        self._entry = None
+
+    def write(self, data) -> int:
+        """
+        Unpacks the next part of the stream.
+
+        Args:
+            data (bytes-like): next part of the stream
+
+        Returns:
+            int: number of bytes consumed
+
+        Raises:
+            MalformedPackError: If an entry header is malformed or unsafe.
+        """
+        view = memoryview(data).cast("B")
+        size = len(view)
+
+        while view:
+            if self._entry is None:
+                # Headers are small, reading them a byte range at a time
+                needed = ENTRY_HEADER.size
+                if len(self._header) >= ENTRY_HEADER.size:
+                    name_size, hash_size, _ = ENTRY_HEADER.unpack_from(self._header)
+                    needed += name_size + hash_size
+                part = view[: needed - len(self._header)]
+                self._header += part
+                view = view[len(part) :]
+
+                if self._start_entry() and self._remaining == 0:
+                    self._finish_entry()
+                continue
+
+            part = view[: self._remaining]
+            if self._buffer is not None:
+                self._buffer += part
+            elif self._file is not None and self._hasher is not None:
+                self._file.write(part)
+                self._hasher.update(part)
+            self._remaining -= len(part)
+            view = view[len(part) :]
+
+            if self._remaining == 0:
+                self._finish_entry()
+
+        return size
+
+    def close(self) -> None:
+        """
+        Waits for the pending writes. An entry cut short by the end of the
+        transfer is reported as failed.
+
+        Returns:
+            None
+        """
+        if self._entry is not None:
+            self.failed.append(self._entry.name)
+            if self._file is not None:
+                self._file.close()
+            self._entry = None
+
+        try:
+            self._collect(block=True)
+        finally:
+            self._pool.shutdown()
@@ -0,0 +1,254 @@
+import asyncio
+import mmap
+import os
+import queue
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from io import BufferedIOBase, RawIOBase
+from typing import Optional
+
+DEFAULT_READ_AHEAD_DEPTH = 4
+
+
+def _get_fd(source: RawIOBase | BufferedIOBase) -> Optional[int]:
+    try:
+        fd = source.fileno()
+        # Hints and mappings only make sense for regular files, not pipes
+        return fd if stat.S_ISREG(os.fstat(fd).st_mode) else None
+    except (OSError, ValueError):
+        return None  # packed directory or another file-like object
+
+
+def _fadvise(fd: Optional[int], offset: int, length: int, advice: str) -> None:
+    if fd is None or not hasattr(os, "posix_fadvise"):
+        return
+
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+    except OSError:
+        pass  # only a hint
+
+
+def _madvise(data: mmap.mmap, offset: int, length: int, advice: str) -> None:
+    if not hasattr(mmap, advice):
+        return
+
+    # Advised ranges have to start on a page boundary
+    start = offset - offset % mmap.PAGESIZE
+    try:
+        data.madvise(getattr(mmap, advice), start, offset + length - start)
+    except OSError:
+        pass  # only a hint
+
+
+class ReadAheadReader:
+    """
+    Reads a file sequentially in a dedicated thread, keeping up to depth chunks
+    ready ahead of the consumer, so the event loop never waits for the disk.
+
+    Chunks are read into a fixed pool of buffers. A chunk is only valid until
+    the next call to read(), its buffer is reused after that. With use_mmap
+    regular files are mapped instead, the thread faults the pages of the next
+    chunks in and read() returns views of the mapping without copies.
+    """
+
+    def __init__(
+        self,
+        source: RawIOBase | BufferedIOBase,
+        length: Optional[int],
+        chunk_size: int,
+        depth: int = DEFAULT_READ_AHEAD_DEPTH,
+        use_mmap: bool = False,
+    ):
+        """
+        Args:
+            source (BinaryIO): file opened in binary mode and positioned at the
+                first byte to read, a pipe or a PackedReader
+            length (int, optional): number of bytes to read, until EOF if None
+            chunk_size (int): size of a chunk in bytes, only the last one can
+                be shorter
+            depth (int): number of chunks read ahead
+            use_mmap (bool): map regular files instead of reading them
+        """
+        if chunk_size <= 0 or depth <= 0:
+            raise ValueError("chunk_size and depth must be positive")
+
+        self.source = source
+        self.length = length
+        self.chunk_size = chunk_size
+        self.depth = depth
+        self.use_mmap = use_mmap
+
+        self._free: queue.Queue[Optional[bytearray]] = queue.Queue()
+        self._filled: asyncio.Queue[Optional[tuple[bytearray, memoryview]]] = (
+            asyncio.Queue()
+        )
+        self._current: Optional[tuple[bytearray, memoryview]] = None
+        self._mapped: Optional[mmap.mmap] = None
+        self._closed = False
+        self._eof = False
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._future: Optional[asyncio.Future[None]] = None
+
+    async def __aenter__(self) -> "ReadAheadReader":
+        loop = asyncio.get_running_loop()
+        fd = _get_fd(self.source)
+        offset = self.source.tell() if fd is not None else 0
+
+        if self.use_mmap and fd is not None:
+            try:
+                self._mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                pass  # empty file or no mmap support, reading it instead
+
+        for _ in range(self.depth):
+            # Mapped chunks need no buffer, only a slot
+            size = 0 if self._mapped is not None else self.chunk_size
+            self._free.put(bytearray(size))
+
+        self._pool = ThreadPoolExecutor(1)
+        if self._mapped is not None:
+            self._future = loop.run_in_executor(
+                self._pool, self._map_stage, loop, self._mapped, offset
+            )
+        else:
+            self._future = loop.run_in_executor(
+                self._pool, self._read_stage, loop, fd, offset
+            )
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self._closed = True
+        self._release()
+        # Wakes up the read thread if it's waiting for a free buffer
+        self._free.put(None)
+
+        if self._future is not None:
+            await asyncio.gather(self._future, return_exceptions=True)
+        if self._pool is not None:
+            self._pool.shutdown()
+
+        if self._mapped is not None:
+            # Dropping chunks that were never read, they hold the mapping
+            while not self._filled.empty():
+                if (item := self._filled.get_nowait()) is not None:
+                    item[1].release()
+            try:
+                self._mapped.close()
+            except BufferError:
+                pass  # a chunk is still in use, closed once it's collected
+
+    async def read(self) -> memoryview:
+        """
+        Returns the next chunk, waiting only if the read thread is behind.
+
+        Returns:
+            memoryview: chunk, empty at the end of the range
+
+        Raises:
+            OSError: If the read thread failed to read source.
+        """
+        if self._future is None:
+            raise RuntimeError("ReadAheadReader must be used with async with")
+
+        self._release()
+        if self._eof:
+            return memoryview(b"")
+
+        item = await self._filled.get()
+        if item is None:
+            self._eof = True
+            # Re-raising the error of the read thread, if any
+            await self._future
+            return memoryview(b"")
+
+        self._current = item
+        return item[1]
+
+    def _release(self) -> None:
+        if self._current is not None:
+            buffer, view = self._current
+            view.release()
+            self._free.put(buffer)
+            self._current = None
+
+    def _remaining(self, position: int, end: Optional[int]) -> int:
+        return self.chunk_size if end is None else min(self.chunk_size, end - position)
+
+    def _read_stage(
+        self, loop: asyncio.AbstractEventLoop, fd: Optional[int], offset: int
+    ) -> None:
+        end = None if self.length is None else offset + self.length
+        position = offset
+        ahead = self.chunk_size * self.depth
+
+        try:
+            _fadvise(fd, offset, self.length or 0, "POSIX_FADV_SEQUENTIAL")
+            _fadvise(fd, offset, ahead, "POSIX_FADV_WILLNEED")
+
+            while not self._closed:
+                limit = self._remaining(position, end)
+                if limit <= 0:
+                    break
+
+                buffer = self._free.get()
+                if buffer is None:
+                    break
+
+                # Asking for the chunk depth chunks ahead while reading this one
+                _fadvise(fd, position + ahead, self.chunk_size, "POSIX_FADV_WILLNEED")
+
+                view = memoryview(buffer)
+                size = 0
+                # Pipes and packed directories return short reads
+                while size < limit:
+                    read = self.source.readinto(view[size:limit])
+                    if not read:
+                        break
+                    size += read
+
+                if not size:
+                    self._free.put(buffer)
+                    break
+
+                loop.call_soon_threadsafe(
+                    self._filled.put_nowait, (buffer, view[:size])
+                )
+                position += size
+                if size < limit:
+                    break  # EOF in the middle of a chunk
+        finally:
+            loop.call_soon_threadsafe(self._filled.put_nowait, None)
+
+    def _map_stage(
+        self, loop: asyncio.AbstractEventLoop, mapped: mmap.mmap, offset: int
+    ) -> None:
+        end = (
+            len(mapped)
+            if self.length is None
+            else min(offset + self.length, len(mapped))
+        )
+        position = offset
+        view = memoryview(mapped)
+
+        try:
+            _madvise(mapped, offset, end - offset, "MADV_SEQUENTIAL")
+
+            while not self._closed and position < end:
+                slot = self._free.get()
+                if slot is None:
+                    break
+
+                size = self._remaining(position, end)
+                _madvise(mapped, position, size, "MADV_WILLNEED")
+                # Faulting every page in here, not on the event loop
+                for page in range(position, position + size, mmap.PAGESIZE):
+                    mapped[page]
+
+                loop.call_soon_threadsafe(
+                    self._filled.put_nowait, (slot, view[position : position + size])
+                )
+                position += size
+        finally:
+            loop.call_soon_threadsafe(self._filled.put_nowait, None)
+            view.release()
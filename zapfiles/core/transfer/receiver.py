@@ -0,0 +1,327 @@
+import asyncio
+import os
+import queue
+from typing import Any, BinaryIO, Callable, Optional, Protocol
+
+from cryptography.hazmat.primitives.ciphers import CipherContext
+
+from zapfiles.core.hash import StreamHasher
+from zapfiles.core.transfer.sender import AES_BLOCK_PADDING, DEFAULT_CHUNK_SIZE
+
+DEFAULT_QUEUE_DEPTH = 4
+
+
+class Writable(Protocol):
+    def write(self, data: Any, /) -> int: ...
+
+
+class Readable(Protocol):
+    async def read(self, n: int = -1, /) -> bytes: ...
+
+
+async def read_exactly(reader: Readable, size: int) -> bytes:
+    """
+    Reads exactly size bytes like StreamReader.readexactly() does.
+
+    Args:
+        reader (Readable): asyncio StreamReader or a reader of the same shape
+        size (int): number of bytes to read
+
+    Returns:
+        bytes: data
+
+    Raises:
+        asyncio.IncompleteReadError: If EOF is reached first.
+    """
+    if isinstance(reader, asyncio.StreamReader):
+        return await reader.readexactly(size)
+
+    data = bytearray()
+    while len(data) < size:
+        chunk = await reader.read(size - len(data))
+        if not chunk:
+            raise asyncio.IncompleteReadError(bytes(data), size)
+        data += chunk
+    return bytes(data)
+
+
+def preallocate(f: BinaryIO, size: int) -> None:
+    """
+    Reserves disk space for the whole file up front.
+    Uses posix_fallocate where available and falls back to extending the file.
+
+    Args:
+        f (BinaryIO): file opened for writing
+        size (int): expected file size
+
+    Returns:
+        None
+    """
+    if size <= 0:
+        return
+
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass  # filesystem doesn't support it, falling back to truncate
+
+    try:
+        f.truncate(size)
+    except OSError:
+        pass
+
+
+class ReceivePipeline:
+    """
+    Receives, decrypts and writes file data in three stages.
+
+    The event loop only reads from the socket into ciphertext buffers.
+    A decrypt thread turns them into plaintext buffers and a writer thread puts
+    those on disk. Both buffer pools are fixed in size, so memory use is capped
+    at 2 * queue_depth * chunk_size and a slow disk only slows the socket down
+    once every buffer is in flight.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        queue_depth: int = DEFAULT_QUEUE_DEPTH,
+    ):
+        """
+        Args:
+            chunk_size (int): size of a single buffer in bytes
+            queue_depth (int): number of buffers in each pool
+        """
+        if chunk_size <= 0 or queue_depth <= 0:
+            raise ValueError("chunk_size and queue_depth must be positive")
+
+        self.chunk_size = chunk_size
+        self.queue_depth = queue_depth
+
+    async def receive(
+        self,
+        reader: Readable,
+        decryptor: Optional[CipherContext],
+        target: Writable,
+        length: Optional[int] = None,
+        on_progress: Optional[Callable[[int], object]] = None,
+    ) -> int:
+        """
+        Reads ciphertext from the stream and writes decrypted data to target.
+
+        Args:
+            reader (Readable): asyncio StreamReader or a reader of the same shape
+            decryptor (CipherContext, optional): decryptor, None if reader
+                already returns plaintext
+            target (Writable): file opened for writing in binary mode or a
+                file-like writer
+            length (int, optional): number of bytes to receive, until EOF if None
+            on_progress (Callable[[int], object], optional): called with the
+                number of received bytes
+
+        Returns:
+            int: number of bytes written
+        """
+        loop = asyncio.get_running_loop()
+
+        free_cipher: asyncio.Queue[Optional[bytearray]] = asyncio.Queue()
+        for _ in range(self.queue_depth):
+            free_cipher.put_nowait(bytearray(self.chunk_size))
+
+        free_plain: queue.Queue[bytearray] = queue.Queue()
+        for _ in range(self.queue_depth):
+            free_plain.put(bytearray(self.chunk_size + AES_BLOCK_PADDING))
+
+        to_decrypt: queue.Queue[Optional[tuple[bytearray, int]]] = queue.Queue()
+        to_write: queue.Queue[Optional[tuple[bytearray, int]]] = queue.Queue()
+
+        def abort() -> None:
+            # Wakes up the receive stage if it's waiting for a free buffer
+            loop.call_soon_threadsafe(free_cipher.put_nowait, None)
+
+        def decrypt_stage() -> None:
+            try:
+                while (item := to_decrypt.get()) is not None:
+                    cipher_buffer, size = item
+                    plain_buffer = free_plain.get()
+                    if decryptor is not None:
+                        decryptor.update_into(
+                            memoryview(cipher_buffer)[:size], plain_buffer
+                        )
+                    else:
+                        plain_buffer[:size] = memoryview(cipher_buffer)[:size]
+                    loop.call_soon_threadsafe(free_cipher.put_nowait, cipher_buffer)
+                    to_write.put((plain_buffer, size))
+
+                tail = decryptor.finalize() if decryptor is not None else b""
+                if tail:
+                    to_write.put((bytearray(tail), len(tail)))
+            except BaseException:
+                abort()
+                raise
+            finally:
+                to_write.put(None)
+
+        def write_stage() -> int:
+            written = 0
+            try:
+                while (item := to_write.get()) is not None:
+                    plain_buffer, size = item
+                    target.write(memoryview(plain_buffer)[:size])
+                    written += size
+                    free_plain.put(plain_buffer)
+            except BaseException:
+                abort()
+                # Keep draining so the decrypt stage never blocks on free_plain
+                while (item := to_write.get()) is not None:
+                    free_plain.put(item[0])
+                raise
+            return written
+
+        decrypt_future = loop.run_in_executor(None, decrypt_stage)
+        write_future = loop.run_in_executor(None, write_stage)
+
+        try:
+            remaining = length
+            while remaining is None or remaining > 0:
+                cipher_buffer = await free_cipher.get()
+                if cipher_buffer is None:
+                    break  # one of the worker stages failed
+
+                limit = (
+                    self.chunk_size
+                    if remaining is None
+                    else min(self.chunk_size, remaining)
+                )
+                size = await self._fill(reader, cipher_buffer, limit)
+                if not size:
+                    free_cipher.put_nowait(cipher_buffer)
+                    break
+
+                to_decrypt.put((cipher_buffer, size))
+                if remaining is not None:
+                    remaining -= size
+                if on_progress is not None:
+                    on_progress(size)
+
+                if size < limit:
+                    break  # EOF in the middle of a buffer
+        finally:
+            to_decrypt.put(None)
+            await asyncio.gather(decrypt_future, write_future, return_exceptions=True)
+
+        # Re-raising worker errors, if any
+        decrypt_future.result()
+        return write_future.result()
+
+    @staticmethod
+    async def _fill(reader: Readable, buffer: bytearray, limit: int) -> int:
+        """
+        Fills buffer from the stream until limit bytes are read or EOF.
+
+        Args:
+            reader (Readable): asyncio StreamReader
+            buffer (bytearray): buffer to fill
+            limit (int): number of bytes to read
+
+        Returns:
+            int: number of bytes in buffer
+        """
+        view = memoryview(buffer)
+        size = 0
+
+        while size < limit:
+            data = await reader.read(limit - size)
+            if not data:
+                break
+            view[size : size + len(data)] = data
+            size += len(data)
+
+        return size
+
+
+class PositionalWriter:
+    """
+    File-like object that writes a region of a shared file starting at offset.
+    Uses os.pwrite where available, so several writers can share one descriptor.
+    """
+
+    def __init__(self, f: BinaryIO, offset: int):
+        """
+        Args:
+            f (BinaryIO): file opened for writing in binary mode
+            offset (int): position of the first written byte
+        """
+        self.position = offset
+        self._fd = f.fileno()
+        self._file: Optional[BinaryIO] = None
+
+        if not hasattr(os, "pwrite"):
+            # No positional writes (Windows), using a dedicated handle instead
+            self._file = open(f.name, "r+b")
+            self._file.seek(offset)
+
+    def write(self, data) -> int:
+        """
+        Writes data at the current position.
+
+        Args:
+            data (bytes-like): data to write
+
+        Returns:
+            int: number of bytes written
+        """
+        view = memoryview(data).cast("B")
+
+        if self._file is not None:
+            self._file.write(view)
+        else:
+            written = 0
+            while written < len(view):
+                written += os.pwrite(self._fd, view[written:], self.position + written)
+
+        self.position += len(view)
+        return len(view)
+
+    def close(self) -> None:
+        """
+        Closes the dedicated handle, if any.
+
+        Returns:
+            None
+        """
+        if self._file is not None:
+            self._file.close()
+
+
+class HashingWriter:
+    """
+    File-like wrapper that feeds everything written through it to a hasher,
+    so the file digest is ready as soon as the last byte is on disk.
+    Writes must be sequential.
+    """
+
+    def __init__(self, target: Writable, hasher: StreamHasher):
+        """
+        Args:
+            target (Writable): underlying writer
+            hasher (StreamHasher): hasher to update
+        """
+        self.target = target
+        self.hasher = hasher
+
+    def write(self, data) -> int:
+        """
+        Writes data and updates the digest with it.
+
+        Args:
+            data (bytes-like): data to write
+
+        Returns:
+            int: number of bytes written
+        """
+        written = self.target.write(data)
+        self.hasher.update(data)
+        return written
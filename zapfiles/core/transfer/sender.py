@@ -0,0 +1,220 @@
+import asyncio
+from asyncio import StreamWriter
+from io import BufferedIOBase, RawIOBase
+from typing import BinaryIO, Callable, Optional, cast
+
+from cryptography.hazmat.primitives.ciphers import CipherContext
+
+from zapfiles.core.admission import RateLimiter
+from zapfiles.core.transfer.readahead import DEFAULT_READ_AHEAD_DEPTH, ReadAheadReader
+
+# CipherContext.update_into() needs room for one extra block minus one byte
+AES_BLOCK_PADDING = 15
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_HIGH_WATER_MARK = 4 * 1024 * 1024
+
+
+class SendEngine:
+    """
+    Encrypts and sends file data with preallocated buffers.
+
+    File data is read ahead by a ReadAheadReader thread and encrypted with
+    update_into() into a small pool of output buffers, so the hot loop neither
+    allocates nor waits for the disk. The writer is only drained when the
+    transport buffer grows past the high-water mark.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        high_water_mark: int = DEFAULT_HIGH_WATER_MARK,
+        read_ahead_depth: int = DEFAULT_READ_AHEAD_DEPTH,
+        use_mmap: bool = False,
+    ):
+        """
+        Args:
+            chunk_size (int): size of a single read in bytes
+            high_water_mark (int): transport buffer size that triggers drain()
+            read_ahead_depth (int): number of chunks read ahead of the send loop
+            use_mmap (bool): map files instead of reading them
+        """
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+
+        self.chunk_size = chunk_size
+        self.high_water_mark = max(high_water_mark, chunk_size)
+        self.read_ahead_depth = read_ahead_depth
+        self.use_mmap = use_mmap
+
+        # A buffer can be reused only after the transport has flushed it.
+        # At most high_water_mark bytes are pending after each drain check,
+        # which spans no more than high_water_mark // chunk_size + 1 chunks.
+        pool_size = self.high_water_mark // chunk_size + 2
+
+        self._out_buffers = [
+            bytearray(chunk_size + AES_BLOCK_PADDING) for _ in range(pool_size)
+        ]
+
+    async def send(
+        self,
+        writer: StreamWriter,
+        encryptor: CipherContext,
+        source: RawIOBase | BufferedIOBase,
+        length: Optional[int] = None,
+        on_progress: Optional[Callable[[int], object]] = None,
+        limiter: Optional[RateLimiter] = None,
+    ) -> int:
+        """
+        Encrypts data from source and writes it to the stream.
+
+        Args:
+            writer (StreamWriter): asyncio StreamWriter
+            encryptor (CipherContext): encryptor
+            source (BinaryIO): file opened in binary mode and positioned at
+                the first byte to send
+            length (int, optional): number of bytes to send, until EOF if None
+            on_progress (Callable[[int], object], optional): called with the
+                number of plaintext bytes after each chunk
+            limiter (RateLimiter, optional): paces the sent data
+
+        Returns:
+            int: number of bytes sent
+        """
+        writer.transport.set_write_buffer_limits(high=self.high_water_mark)
+
+        out_views = [memoryview(buffer) for buffer in self._out_buffers]
+        sent = 0
+        index = 0
+
+        async with ReadAheadReader(
+            source, length, self.chunk_size, self.read_ahead_depth, self.use_mmap
+        ) as file_reader:
+            while chunk := await file_reader.read():
+                read = len(chunk)
+                if limiter is not None:
+                    await limiter.consume(read)
+
+                out_view = out_views[index % len(out_views)]
+                encryptor.update_into(chunk, out_view)
+                writer.write(out_view[:read])
+                index += 1
+
+                sent += read
+                if on_progress is not None:
+                    on_progress(read)
+
+                if writer.transport.get_write_buffer_size() > self.high_water_mark:
+                    await writer.drain()
+                else:
+                    # Let other connections run between chunks
+                    await asyncio.sleep(0)
+
+        tail = encryptor.finalize()
+        if tail:
+            writer.write(tail)
+        await writer.drain()
+
+        return sent
+
+    async def send_file(
+        self,
+        writer: StreamWriter,
+        source: BinaryIO,
+        offset: int,
+        length: int,
+        on_progress: Optional[Callable[[int], object]] = None,
+        limiter: Optional[RateLimiter] = None,
+    ) -> int:
+        """
+        Sends already encrypted data with loop.sendfile(), which uses
+        os.sendfile() where the transport supports it and copies otherwise.
+
+        Args:
+            writer (StreamWriter): asyncio StreamWriter
+            source (BinaryIO): file opened in binary mode
+            offset (int): position of the first byte to send
+            length (int): number of bytes to send
+            on_progress (Callable[[int], object], optional): called with the
+                number of bytes after each step
+            limiter (RateLimiter, optional): paces the sent data
+
+        Returns:
+            int: number of bytes sent
+        """
+        loop = asyncio.get_running_loop()
+        await writer.drain()
+
+        # Sending in steps to report progress, paced ones are chunk-sized
+        step_size = self.high_water_mark if limiter is None else self.chunk_size
+        sent = 0
+        while sent < length:
+            size = min(step_size, length - sent)
+            if limiter is not None:
+                await limiter.consume(size)
+
+            try:
+                step = await loop.sendfile(
+                    writer.transport, source, offset + sent, size
+                )
+            except NotImplementedError:
+                # Loop has no sendfile() at all (uvloop), copying the rest
+                source.seek(offset + sent)
+                return sent + await self._copy(
+                    writer, source, length - sent, on_progress, limiter
+                )
+            if not step:
+                break
+
+            sent += step
+            if on_progress is not None:
+                on_progress(step)
+
+        return sent
+
+    async def _copy(
+        self,
+        writer: StreamWriter,
+        source: BinaryIO,
+        length: int,
+        on_progress: Optional[Callable[[int], object]] = None,
+        limiter: Optional[RateLimiter] = None,
+    ) -> int:
+        """
+        Sends data from source as it is.
+
+        Args:
+            writer (StreamWriter): asyncio StreamWriter
+            source (BinaryIO): file opened in binary mode and positioned at
+                the first byte to send
+            length (int): number of bytes to send
+            on_progress (Callable[[int], object], optional): called with the
+                number of bytes after each chunk
+            limiter (RateLimiter, optional): paces the sent data
+
+        Returns:
+            int: number of bytes sent
+        """
+        sent = 0
+
+        async with ReadAheadReader(
+            cast(RawIOBase, source),
+            length,
+            self.chunk_size,
+            self.read_ahead_depth,
+            self.use_mmap,
+        ) as file_reader:
+            while chunk := await file_reader.read():
+                if limiter is not None:
+                    await limiter.consume(len(chunk))
+                # Transport keeps the data, so it can't stay in a reused buffer
+                writer.write(bytes(chunk))
+                sent += len(chunk)
+                if on_progress is not None:
+                    on_progress(len(chunk))
+
+                if writer.transport.get_write_buffer_size() > self.high_water_mark:
+                    await writer.drain()
+
+        await writer.drain()
+        return sent
@@ -0,0 +1,285 @@
+import asyncio
+import secrets
+import struct
+from asyncio import StreamWriter
+from concurrent.futures import ThreadPoolExecutor
+from io import BufferedIOBase, RawIOBase
+from typing import BinaryIO, Callable, Optional
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from zapfiles.core.admission import RateLimiter
+from zapfiles.core.hash import StreamHasher, format_hash, parse_hash
+from zapfiles.core.transfer.framing import TAG_SIZE, CorruptedFrameError
+from zapfiles.core.transfer.receiver import Readable, Writable, read_exactly
+from zapfiles.core.transfer.sender import DEFAULT_HIGH_WATER_MARK
+
+# Hash strings of streams carry a random id in place of the digest, the real
+# digest is only known once the stream ends
+STREAM_MODE = "stream"
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# Chunk kind and sealed size, sent in the clear and authenticated with the
+# offset of the chunk
+CHUNK_HEADER = struct.Struct(">BI")
+CHUNK_OFFSET = struct.Struct(">Q")
+CHUNK_DATA = 0
+# Last chunk, holds the hash string of everything before it
+CHUNK_END = 1
+
+# Nonce is the chunk counter of the session, the key is never shared
+NONCE_PREFIX = bytes(4)
+
+
+class StreamDigestError(Exception):
+    """
+    Raised when the digest at the end of a stream doesn't match the received data.
+    """
+
+
+def new_stream_id(algorithm: str) -> str:
+    """
+    Args:
+        algorithm (str): hash algorithm of the stream digest
+
+    Returns:
+        str: hash string in STREAM_MODE with a random id
+    """
+    return format_hash(secrets.token_hex(16), algorithm, STREAM_MODE)
+
+
+def is_stream_id(file_hash: str) -> bool:
+    """
+    Args:
+        file_hash (str): hash string
+
+    Returns:
+        bool: True if hash string was created by new_stream_id
+    """
+    return parse_hash(file_hash)[1] == STREAM_MODE
+
+
+def get_stream_hasher(file_hash: str) -> StreamHasher:
+    """
+    Creates hasher for the digest sent at the end of a stream.
+
+    Args:
+        file_hash (str): hash string of a file or stream id
+
+    Returns:
+        StreamHasher: hasher, streams are hashed flat
+    """
+    algorithm, mode, _ = parse_hash(file_hash)
+    return StreamHasher(algorithm, "flat" if mode == STREAM_MODE else mode)
+
+
+def _get_nonce(index: int) -> bytes:
+    return NONCE_PREFIX + index.to_bytes(8, "big")
+
+
+def _get_aad(header: bytes, offset: int) -> bytes:
+    return header + CHUNK_OFFSET.pack(offset)
+
+
+class ChunkedSender:
+    """
+    Sends data of unknown length, e.g. from stdin, as AES-GCM sealed chunks
+    followed by its digest. The next chunk is read and sealed while the current
+    one is sent, so memory use stays at a couple of chunks.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        high_water_mark: int = DEFAULT_HIGH_WATER_MARK,
+    ):
+        """
+        Args:
+            chunk_size (int): maximum size of a chunk in bytes
+            high_water_mark (int): transport buffer size that triggers drain()
+        """
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+
+        self.chunk_size = chunk_size
+        self.high_water_mark = max(high_water_mark, chunk_size)
+
+    async def send(
+        self,
+        writer: StreamWriter,
+        aes_key: bytes,
+        source: RawIOBase | BufferedIOBase | BinaryIO,
+        hasher: StreamHasher,
+        on_progress: Optional[Callable[[int], object]] = None,
+        limiter: Optional[RateLimiter] = None,
+    ) -> int:
+        """
+        Reads source until EOF and sends it.
+
+        Args:
+            writer (StreamWriter): asyncio StreamWriter
+            aes_key (bytes): session key, must not be used for anything else
+            source (BinaryIO): file or pipe opened in binary mode
+            hasher (StreamHasher): hasher of the digest sent at the end
+            on_progress (Callable[[int], object], optional): called with the
+                number of plaintext bytes after each chunk
+            limiter (RateLimiter, optional): paces the sent data
+
+        Returns:
+            int: number of plaintext bytes sent
+        """
+        loop = asyncio.get_running_loop()
+        aead = AESGCM(aes_key)
+        writer.transport.set_write_buffer_limits(high=self.high_water_mark)
+
+        def seal_next(index: int, offset: int) -> tuple[bytes, int]:
+            # Pipes return short reads, filling the chunk unless EOF comes first
+            data = bytearray()
+            while len(data) < self.chunk_size:
+                part = source.read(self.chunk_size - len(data))
+                if not part:
+                    break
+                data += part
+
+            if data:
+                kind, payload = CHUNK_DATA, bytes(data)
+                hasher.update(payload)
+            else:
+                kind = CHUNK_END
+                payload = format_hash(
+                    hasher.hexdigest(), hasher.algorithm, hasher.mode
+                ).encode("utf-8")
+
+            header = CHUNK_HEADER.pack(kind, len(payload) + TAG_SIZE)
+            sealed = aead.encrypt(_get_nonce(index), payload, _get_aad(header, offset))
+            return header + sealed, len(data)
+
+        sent = 0
+        with ThreadPoolExecutor(1) as pool:
+            pending = loop.run_in_executor(pool, seal_next, 0, 0)
+            index = 0
+
+            while True:
+                chunk, size = await pending
+                if size:
+                    # Reading ahead while this chunk is on its way
+                    index += 1
+                    pending = loop.run_in_executor(pool, seal_next, index, sent + size)
+
+                if limiter is not None:
+                    await limiter.consume(len(chunk))
+                writer.write(chunk)
+                if not size:
+                    break
+
+                sent += size
+                if on_progress is not None:
+                    on_progress(size)
+
+                if writer.transport.get_write_buffer_size() > self.high_water_mark:
+                    await writer.drain()
+
+        await writer.drain()
+        return sent
+
+
+class ChunkedReceiver:
+    """
+    Receives chunks sealed by ChunkedSender and writes them in order, checking
+    the digest at the end.
+    """
+
+    def __init__(self, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        """
+        Args:
+            chunk_size (int): maximum size of a chunk in bytes
+        """
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+
+        self.chunk_size = chunk_size
+
+    async def receive(
+        self,
+        reader: Readable,
+        aes_key: bytes,
+        target: Writable,
+        hasher: StreamHasher,
+        on_progress: Optional[Callable[[int], object]] = None,
+    ) -> int:
+        """
+        Receives the whole stream and writes it to target.
+
+        Args:
+            reader (Readable): asyncio StreamReader
+            aes_key (bytes): session key
+            target (Writable): file-like writer, e.g. stdout
+            hasher (StreamHasher): hasher matching the one of the sender
+            on_progress (Callable[[int], object], optional): called with the
+                number of received plaintext bytes
+
+        Returns:
+            int: number of bytes written
+
+        Raises:
+            CorruptedFrameError: If a chunk fails authentication.
+            StreamDigestError: If the digest doesn't match the data.
+            ValueError: If a chunk is malformed.
+        """
+        loop = asyncio.get_running_loop()
+        aead = AESGCM(aes_key)
+
+        def open_chunk(index: int, offset: int, header: bytes, sealed: bytes) -> bytes:
+            try:
+                return aead.decrypt(_get_nonce(index), sealed, _get_aad(header, offset))
+            except InvalidTag:
+                raise CorruptedFrameError(offset) from None
+
+        def write_chunk(index: int, offset: int, header: bytes, sealed: bytes) -> int:
+            data = open_chunk(index, offset, header, sealed)
+            target.write(data)
+            hasher.update(data)
+            return len(data)
+
+        written = index = offset = 0
+        # Chunks are opened and written by a single thread in order
+        with ThreadPoolExecutor(1) as pool:
+            pending: Optional[asyncio.Future[int]] = None
+            try:
+                while True:
+                    header = await read_exactly(reader, CHUNK_HEADER.size)
+                    kind, length = CHUNK_HEADER.unpack(header)
+                    if not TAG_SIZE <= length <= self.chunk_size + TAG_SIZE:
+                        raise ValueError(f"Invalid chunk size: {length}")
+
+                    sealed = await read_exactly(reader, length)
+                    if kind == CHUNK_END:
+                        break
+                    if kind != CHUNK_DATA:
+                        raise ValueError(f"Unknown chunk kind: {kind}")
+
+                    job = loop.run_in_executor(
+                        pool, write_chunk, index, offset, header, sealed
+                    )
+                    if pending is not None:
+                        written += await pending
+                    pending = job
+
+                    index += 1
+                    offset += length - TAG_SIZE
+                    if on_progress is not None:
+                        on_progress(length - TAG_SIZE)
+            finally:
+                if pending is not None:
+                    written += await pending
+
+        announced = open_chunk(index, offset, header, sealed).decode("utf-8")
+        algorithm, mode, digest = parse_hash(announced)
+        if (algorithm, mode) != (hasher.algorithm, hasher.mode) or (
+            digest != hasher.hexdigest()
+        ):
+            raise StreamDigestError(announced)
+
+        return written
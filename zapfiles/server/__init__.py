@@ -1,11 +1,14 @@
 import asyncio
+import ipaddress
 import json
 import os
+import socket
+import sys
 from asyncio import StreamReader, StreamWriter
 from functools import partial
-from os import PathLike
 from pathlib import Path
-from typing import Optional
+from io import RawIOBase
+from typing import BinaryIO, Optional, Sequence
 
 import questionary
 import requests
@@ -13,7 +16,6 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from prettytable import PrettyTable
 from tqdm import tqdm
 
@@ -28,9 +30,61 @@ from zapfiles.cli import (
     ColorEnum,
 )
 from zapfiles.constants import ROOT_DIR
-from zapfiles.core.hash import get_file_hash
+from zapfiles.core.admission import AdmissionControl, RateLimiter
+from zapfiles.core.catalog import FileCatalog
+from zapfiles.core.compression import pick_codec
+from zapfiles.core.crypto import (
+    RESUMPTION_SECRET_SIZE,
+    create_encryptor,
+    ticket_wrap_key,
+    x25519_wrap_key,
+)
+from zapfiles.core.delta import DeltaSender
+from zapfiles.core.hash import parse_hash
 from zapfiles.core.localization import lang
 from zapfiles.core.config.app_configuration import config
+from zapfiles.core.protocol import (
+    CAPABILITY_CHUNKED,
+    CAPABILITY_COMPRESSION,
+    CAPABILITY_DELTA,
+    CAPABILITY_FRAMED,
+    CAPABILITY_RANGES,
+    CAPABILITY_TICKETS,
+    CAPABILITY_TLS,
+    CAPABILITY_X25519,
+    KEY_EXCHANGE_TICKET,
+    KEY_EXCHANGE_X25519,
+    TRANSPORT_CHUNKED,
+    TRANSPORT_DELTA,
+    TRANSPORT_FRAMED,
+    TRANSPORT_STREAM,
+    TRANSPORT_TLS,
+    ByteRange,
+    ClientRequest,
+    ServerHeader,
+    read_ready,
+    read_request,
+    send_header,
+    send_not_found,
+    send_queued,
+    send_retry,
+)
+from zapfiles.core.tickets import ticket_issuer
+from zapfiles.core.transfer import ktls
+from zapfiles.core.transfer.ciphertext_cache import ciphertext_cache
+from zapfiles.core.transfer.connection import (
+    ConnectionHandler,
+    run,
+    start_protocol_server,
+)
+from zapfiles.core.transfer.framing import FRAME_SIZE, FramedSender
+from zapfiles.core.transfer.packing import PackedReader, is_directory_hash
+from zapfiles.core.transfer.sender import SendEngine
+from zapfiles.core.transfer.streaming import (
+    ChunkedSender,
+    get_stream_hasher,
+    new_stream_id,
+)
 
 server_config = PrettyTable(
     [
@@ -41,6 +95,28 @@ server_config = PrettyTable(
 )
 
 
+class SharedStream:
+    """
+    Data from stdin or a pipe, shared under a random stream id.
+    It can only be read once, so only the first client to ask for it gets it.
+    """
+
+    def __init__(self, source: BinaryIO, name: str, algorithm: str):
+        """
+        Args:
+            source (BinaryIO): stdin or a pipe opened in binary mode
+            name (str): name clients save the stream under
+            algorithm (str): hash algorithm of the digest sent at the end
+        """
+        self.source = source
+        self.name = name
+        self.stream_id = new_stream_id(algorithm)
+        self.claimed = False
+        # Set once the client got the stream or the transfer failed
+        self.done = asyncio.Event()
+        self.sent = False
+
+
 def assert_rsa_key(key) -> RSAPublicKey:
     if not isinstance(key, RSAPublicKey):
         raise TypeError("Ключ не является RSA-ключом")
@@ -85,8 +161,202 @@ def get_public_ip() -> Optional[str]:
         return None
 
 
+def get_local_addresses() -> list[str]:
+    """
+    Gets IPv4 addresses of the local network interfaces, so clients on the
+    same network don't have to go through the public IP address.
+
+    Returns:
+        list[str]: addresses, without loopback and link-local ones
+    """
+    addresses = []
+
+    # Interface of the default route, connecting a UDP socket sends nothing
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect(("10.255.255.255", 1))
+            addresses.append(sock.getsockname()[0])
+    except OSError:
+        pass
+
+    try:
+        addresses += [
+            str(address[4][0])
+            for address in socket.getaddrinfo(
+                socket.gethostname(), None, socket.AF_INET
+            )
+        ]
+    except OSError:
+        pass
+
+    usable = []
+    for address in dict.fromkeys(addresses):
+        ip = ipaddress.ip_address(address)
+        if not (ip.is_loopback or ip.is_link_local or ip.is_unspecified):
+            usable.append(address)
+    return usable
+
+
+def get_capabilities() -> int:
+    """
+    Returns:
+        int: capabilities reported to protocol v2 clients
+    """
+    capabilities = (
+        CAPABILITY_RANGES
+        | CAPABILITY_FRAMED
+        | CAPABILITY_X25519
+        | CAPABILITY_DELTA
+        | CAPABILITY_CHUNKED
+        | CAPABILITY_COMPRESSION
+    )
+    if config.get_value("ktls"):
+        capabilities |= CAPABILITY_TLS
+    if config.get_value("session_tickets"):
+        capabilities |= CAPABILITY_TICKETS
+    return capabilities
+
+
+async def listen(handler: ConnectionHandler, port: int) -> asyncio.Server:
+    """
+    Starts listening on every address with the transport from server_transport.
+
+    Args:
+        handler (ConnectionHandler): coroutine function called with reader and
+            writer of every connection
+        port (int): port of server
+
+    Returns:
+        asyncio.Server: server, already listening
+    """
+    if config.get_value("server_transport") == "protocol":
+        return await start_protocol_server(handler, "0.0.0.0", port)
+    return await asyncio.start_server(handler, "0.0.0.0", port)
+
+
+def write_zapfile(
+    host: str,
+    port: int,
+    filename: str,
+    file_hash: str,
+    addresses: Sequence[str] = (),
+) -> str:
+    """
+    Writes zapfile of a shared file or directory into generated_zapfiles.
+    Servers from zapfile_mirrors are listed as other sources of it.
+
+    Args:
+        host (str): IP address of server
+        port (int): port of server
+        filename (str): name of file or directory
+        file_hash (str): hash string of file or directory
+        addresses (Sequence[str]): other IP addresses of server, tried by
+            clients alongside host
+
+    Returns:
+        str: name of zapfile
+    """
+    algorithm, mode, digest = parse_hash(file_hash)
+
+    os.makedirs("generated_zapfiles", exist_ok=True)
+    with open(
+        Path("generated_zapfiles") / f"{filename}.zapfile", "w", encoding="utf-8"
+    ) as f:
+        zapfile = {
+            "host": host,
+            "port": port,
+            "filename": filename,
+            "hash": digest,
+            "hash_algorithm": algorithm,
+            "hash_mode": mode,
+        }
+        mirrors = [
+            {"host": mirror.rpartition(":")[0], "port": int(mirror.rpartition(":")[2])}
+            for mirror in config.get_value("zapfile_mirrors")
+        ]
+        if addresses:
+            zapfile["addresses"] = list(addresses)
+        if mirrors:
+            zapfile["mirrors"] = mirrors
+        f.write(json.dumps(zapfile, indent=4, ensure_ascii=False))
+
+    return filename + ".zapfile"
+
+
+def get_admission_control() -> AdmissionControl:
+    """
+    Returns:
+        AdmissionControl: admission control with the limits from config
+    """
+    return AdmissionControl(
+        config.get_value("max_active_transfers"),
+        config.get_value("client_rate_limit"),
+        config.get_value("server_rate_limit"),
+    )
+
+
+async def wait_for_turn(
+    reader: StreamReader,
+    writer: StreamWriter,
+    admission: AdmissionControl,
+    request: ClientRequest,
+) -> RateLimiter:
+    """
+    Waits until admission control lets the transfer start. Clients that asked
+    for it are told their position in the queue.
+
+    Args:
+        reader (StreamReader): asyncio StreamReader
+        writer (StreamWriter): asyncio StreamWriter
+        admission (AdmissionControl): admission control of the server
+        request (ClientRequest): request of client
+
+    Returns:
+        RateLimiter: limiter of the transfer
+
+    Raises:
+        ConnectionResetError: If the client has left while waiting.
+    """
+    client_ip = writer.get_extra_info("peername")[0]
+    queued = False
+
+    async def on_position(position: int) -> None:
+        nonlocal queued
+        if not queued:
+            info(
+                lang.get_string("server.info.clientQueued").format(client_ip, position)
+            )
+            queued = True
+        if request.queue_updates:
+            await send_queued(writer, position)
+
+    turn = asyncio.ensure_future(admission.admit(client_ip, on_position))
+    # Clients send nothing before the header, so reading only notices them leaving
+    gone = asyncio.ensure_future(reader.read(1))
+    try:
+        await asyncio.wait({turn, gone}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        left = gone.done()
+        gone.cancel()
+        turn.cancel()
+        await asyncio.gather(turn, gone, return_exceptions=True)
+
+    if turn.cancelled():
+        raise ConnectionResetError("Client has left the queue")
+
+    limiter = turn.result()
+    if left:
+        admission.release(limiter)
+        raise ConnectionResetError("Client has left the queue")
+    return limiter
+
+
 async def handle_client(
-    reader: StreamReader, writer: StreamWriter, filepath: PathLike[str]
+    reader: StreamReader,
+    writer: StreamWriter,
+    catalog: FileCatalog,
+    stream: Optional[SharedStream] = None,
+    admission: Optional[AdmissionControl] = None,
 ) -> None:
     """
     Handles client connection.
@@ -94,66 +364,329 @@ async def handle_client(
     Args:
         reader (StreamReader): asyncio StreamReader
         writer (StreamWriter): asyncio StreamWriter
-        filepath (str): path to file to send
+        catalog (FileCatalog): shared files
+        stream (SharedStream, optional): stream shared alongside the files
+        admission (AdmissionControl, optional): limits of concurrent transfers
+            and bandwidth, no limits if None
 
     Returns:
         None
     """
+    # True once this client got hold of the stream
+    streaming = False
+    # Paces the transfer once admission control has let it start
+    limiter: Optional[RateLimiter] = None
     try:
         # Getting IP and port of client
         client_ip, client_port = writer.get_extra_info("peername")
         info(lang.get_string("server.info.peername").format(client_ip, client_port))
 
-        # Getting public key
-        public_key = assert_rsa_key(
-            serialization.load_pem_public_key(
-                await reader.read(450), backend=default_backend()
+        # Getting requested byte range and transport (if any) and public key
+        request = await read_request(reader)
+        byte_range, transport = request.byte_range, request.transport
+
+        # Finding the requested file or directory, v1 clients get the only
+        # shared file
+        entry = directory = None
+        if stream is not None and request.file_id == stream.stream_id:
+            pass
+        elif request.file_id is not None and is_directory_hash(request.file_id):
+            directory = await catalog.get_directory(request.file_id)
+            stream = None
+        else:
+            entry = await catalog.get(request.file_id)
+            stream = None
+
+        if stream is not None:
+            filepath, file_hash = Path(stream.name), stream.stream_id
+        elif directory is not None:
+            # Directories are sent whole as a packed stream
+            filepath, file_hash = directory.path, directory.file_hash
+            byte_range = None
+        elif entry is not None:
+            filepath, file_hash = entry.path, entry.file_hash
+        else:
+            err(lang.get_string("server.error.fileNotShared").format(request.file_id))
+            if request.version >= 2:
+                await send_not_found(writer)
+            return
+
+        # Kernel encrypts records if the client asked for them and kTLS works,
+        # AES-GCM frames are always available
+        sock = writer.get_extra_info("socket")
+        picked = TRANSPORT_STREAM
+        if (
+            transport == TRANSPORT_CHUNKED
+            and request.version >= 2
+            and directory is None
+        ):
+            picked = TRANSPORT_CHUNKED
+        elif stream is not None:
+            pass  # other transports only get the header, e.g. address probes
+        elif transport == TRANSPORT_FRAMED:
+            picked = TRANSPORT_FRAMED
+        elif (
+            transport == TRANSPORT_DELTA and request.version >= 2 and entry is not None
+        ):
+            picked = TRANSPORT_DELTA
+            byte_range = None
+        elif (
+            transport == TRANSPORT_TLS
+            and directory is None
+            and config.get_value("ktls")
+            and ktls.attach(sock)
+        ):
+            picked = TRANSPORT_TLS
+
+        # Compressing frames of files that are worth it, if the client can
+        # decode them
+        codec = None
+        if picked == TRANSPORT_FRAMED and request.codecs and entry is not None:
+            codec = await asyncio.get_running_loop().run_in_executor(
+                None, pick_codec, filepath, request.codecs
             )
-        )
 
-        # Генерация симметричного AES-ключа
-        aes_key = os.urandom(32)
-
-        # Encrypting AES key by public RSA key
-        encrypted_aes_key = public_key.encrypt(
-            aes_key,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None,
-            ),
-        )
+        if stream is not None and picked == TRANSPORT_CHUNKED:
+            if stream.claimed:
+                err(
+                    lang.get_string("server.error.fileNotShared").format(
+                        request.file_id
+                    )
+                )
+                await send_not_found(writer)
+                return
+            stream.claimed = streaming = True
+
+        # Checking the ticket first, so a rejected client doesn't wait in the
+        # queue before it has to connect again
+        secret = None
+        if request.key_exchange == KEY_EXCHANGE_TICKET:
+            if request.ticket is not None and config.get_value("session_tickets"):
+                secret = ticket_issuer.open(request.ticket)
+            if secret is None:
+                await send_retry(writer)
+                return
+
+        # Empty ranges are probes, e.g. of clients racing addresses, they
+        # never wait for a slot
+        if admission is not None and (byte_range is None or byte_range.length):
+            limiter = await wait_for_turn(reader, writer, admission, request)
+
+        # Shared content key of the cached ciphertext or a new per-client key,
+        # record and frame nonces start over on every connection, so they never
+        # share one
+        cached = None
+        if (
+            config.get_value("ciphertext_cache")
+            and picked == TRANSPORT_STREAM
+            and directory is None
+            and stream is None
+        ):
+            cached = await ciphertext_cache.get(filepath)
+
+        if cached is not None:
+            aes_key = cached.key
+        else:
+            # Генерация симметричного AES-ключа
+            aes_key = os.urandom(32)
+
+        # Secret of the next ticket goes with the AES key, so only this client
+        # can unwrap it, even if other clients share the key of the cached file
+        new_secret = None
+        key_material = aes_key
+        if (
+            request.version >= 2
+            and request.wrapped_secret
+            and config.get_value("session_tickets")
+        ):
+            new_secret = os.urandom(RESUMPTION_SECRET_SIZE)
+            key_material = aes_key + new_secret
+
+        if secret is not None:
+            # Resuming without asymmetric cryptography, the client has to do a
+            # full key exchange if the ticket is expired or from before a restart
+            encrypted_aes_key = ticket_wrap_key(
+                key_material, secret, request.public_key
+            )
+        elif request.key_exchange == KEY_EXCHANGE_X25519:
+            # Wrapping AES key with an ephemeral X25519 key agreement
+            encrypted_aes_key = x25519_wrap_key(key_material, request.public_key)
+        else:
+            # Encrypting AES key by public RSA key
+            public_key = assert_rsa_key(
+                serialization.load_pem_public_key(
+                    request.public_key, backend=default_backend()
+                )
+            )
+            encrypted_aes_key = public_key.encrypt(
+                key_material,
+                padding.OAEP(
+                    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                    algorithm=hashes.SHA256(),
+                    label=None,
+                ),
+            )
 
-        # Sending encrypted AES key to client
-        writer.write(encrypted_aes_key)
-        await writer.drain()
+        if stream is not None:
+            file_size = 0  # not known until the stream ends
+        elif directory is not None:
+            file_size = directory.packed_size
+        elif cached is not None:
+            file_size = cached.size
+        else:
+            file_size = os.path.getsize(filepath)
+
+        if request.version >= 2:
+            # Issuing a ticket for the next connection of the client
+            ticket = None
+            if new_secret is not None:
+                ticket = ticket_issuer.issue(new_secret)
+
+            # Everything the client needs arrives in a single header
+            await send_header(
+                writer,
+                ServerHeader(
+                    encrypted_aes_key,
+                    file_size,
+                    FRAME_SIZE,
+                    file_hash,
+                    picked,
+                    get_capabilities(),
+                    ticket,
+                    ticket_issuer.lifetime,
+                    None if codec is None else codec.name,
+                ),
+            )
+        else:
+            # Sending encrypted AES key and file size to client
+            writer.write(encrypted_aes_key)
+            writer.write(file_size.to_bytes(8, "big"))
 
-        # Sending file size to client
-        file_size = os.path.getsize(filepath)
-        writer.write(file_size.to_bytes(8, "big"))
-        await writer.drain()
+            # Telling client which transport is used
+            if transport is not None:
+                writer.write(bytes([picked]))
+            await writer.drain()
 
-        # Encryption and transferring file by chunks
-        aes_cipher = Cipher(
-            algorithms.AES(aes_key), modes.CTR(b"0" * 16), backend=default_backend()
+        if stream is not None and not streaming:
+            return
+
+        # Clamping requested range to the file
+        if byte_range is None:
+            byte_range = ByteRange(0, file_size)
+        else:
+            offset = min(byte_range.offset, file_size)
+            byte_range = ByteRange(offset, min(byte_range.length, file_size - offset))
+
+        if picked == TRANSPORT_TLS:
+            # Client has read everything sent in the clear once it's ready
+            await read_ready(reader, request.version)
+            if not ktls.install(sock, ktls.TLS_TX, ktls.derive_tls_keys(aes_key)):
+                raise OSError("kTLS rejected the session key")
+
+        def open_source() -> RawIOBase:
+            if directory is not None:
+                return PackedReader(directory.entries)
+
+            source = open(filepath, "rb", buffering=0)
+            source.seek(byte_range.offset)
+            return source
+
+        send_engine = SendEngine(
+            chunk_size=config.get_value("transfer_chunk_size"),
+            high_water_mark=config.get_value("send_high_water_mark"),
+            read_ahead_depth=config.get_value("read_ahead_depth"),
+            use_mmap=config.get_value("send_use_mmap"),
         )
-        encryptor = aes_cipher.encryptor()
 
         with tqdm(
-            total=file_size, unit="B", unit_scale=True, desc=os.path.basename(filepath)
+            total=None if streaming else byte_range.length,
+            unit="B",
+            unit_scale=True,
+            desc=os.path.basename(filepath),
         ) as progress_bar:
-            with open(filepath, "rb") as f:
-                while True:
-                    file_data = f.read(4096)
-                    if not file_data:
-                        break
-                    encrypted_file_data = encryptor.update(file_data)
-                    writer.write(encrypted_file_data)
-                    await writer.drain()
-                    progress_bar.update(len(file_data))
-
-        writer.write(encryptor.finalize())
-        await writer.drain()
+            if picked == TRANSPORT_CHUNKED:
+                # Sending everything the source has, the digest comes last
+                sender = ChunkedSender(
+                    FRAME_SIZE, high_water_mark=config.get_value("send_high_water_mark")
+                )
+
+                if stream is not None:
+                    await sender.send(
+                        writer,
+                        aes_key,
+                        stream.source,
+                        get_stream_hasher(file_hash),
+                        on_progress=progress_bar.update,
+                        limiter=limiter,
+                    )
+                    stream.sent = True
+                else:
+                    with open(filepath, "rb") as f:
+                        await sender.send(
+                            writer,
+                            aes_key,
+                            f,
+                            get_stream_hasher(file_hash),
+                            on_progress=progress_bar.update,
+                            limiter=limiter,
+                        )
+            elif picked == TRANSPORT_DELTA:
+                # Sending only what the client's copy lacks
+                with open(filepath, "rb") as f:
+                    await DeltaSender().send(
+                        reader,
+                        writer,
+                        aes_key,
+                        f,
+                        on_progress=progress_bar.update,
+                        limiter=limiter,
+                    )
+            elif picked == TRANSPORT_FRAMED:
+                # Sealing frames in parallel
+                sender = FramedSender(
+                    FRAME_SIZE,
+                    high_water_mark=config.get_value("send_high_water_mark"),
+                    codec=codec,
+                    read_ahead_depth=config.get_value("read_ahead_depth"),
+                    use_mmap=config.get_value("send_use_mmap"),
+                )
+
+                with open_source() as f:
+                    await sender.send(
+                        writer,
+                        aes_key,
+                        f,
+                        byte_range,
+                        on_progress=progress_bar.update,
+                        limiter=limiter,
+                    )
+            elif picked == TRANSPORT_TLS or cached is not None:
+                # File is already encrypted or is encrypted by the kernel,
+                # sending it without copies
+                with open(filepath if cached is None else cached.path, "rb") as f:
+                    await send_engine.send_file(
+                        writer,
+                        f,
+                        byte_range.offset,
+                        byte_range.length,
+                        on_progress=progress_bar.update,
+                        limiter=limiter,
+                    )
+            else:
+                # Encryption and transferring file by chunks, keystream starts
+                # at the same counter as it would for a whole-file transfer
+                encryptor = create_encryptor(aes_key, byte_range.offset)
+
+                with open_source() as f:
+                    await send_engine.send(
+                        writer,
+                        encryptor,
+                        f,
+                        byte_range.length,
+                        on_progress=progress_bar.update,
+                        limiter=limiter,
+                    )
+
         success(lang.get_string("server.info.fileSent"))
     except ConnectionResetError:
         err(lang.get_string("server.error.connectionReset"))
@@ -164,11 +697,17 @@ async def handle_client(
     except Exception as e:
         err(lang.get_string("server.error.errorHandlingClient").format(e))
     finally:
+        if admission is not None and limiter is not None:
+            admission.release(limiter)
+
         # Closing streams
         try:
             writer.close()
             await writer.wait_closed()
         finally:
+            # Stream server stops once everything is flushed
+            if streaming and stream is not None:
+                stream.done.set()
             return
 
 
@@ -218,6 +757,13 @@ async def server() -> None:
             err(lang.get_string("server.error.invalidIp"))
             return
 
+        # Clients race every address and keep the fastest, e.g. a LAN one
+        local_addresses = []
+        if config.get_value("advertise_local_addresses"):
+            local_addresses = [
+                address for address in get_local_addresses() if address != key_ip
+            ]
+
         if config.get_value("enable_tips"):
             info(lang.get_string("server.tip.storageDirectory"))
             info(lang.get_string("server.tip.fileNavigation"))
@@ -227,7 +773,7 @@ async def server() -> None:
                 message=lang.get_string("server.info.filePath")
             ).ask_async()
             try:
-                if Path(file_path).is_file():
+                if Path(file_path).is_file() or Path(file_path).is_dir():
                     break
                 err(lang.get_string("server.error.fileNotFound").format(file=file_path))
             except TypeError:
@@ -253,49 +799,135 @@ async def server() -> None:
             else:
                 break
 
-        # Starting server
-        server_args = partial(handle_client, filepath=file_path)
-        host = await asyncio.start_server(server_args, "0.0.0.0", port)
-
         clear_console()
         title()
 
         filename: str = os.path.basename(file_path)
 
         # Printing server information
-        server_config.add_row([key_ip, port, filename])
+        server_config.add_row(["\n".join([key_ip, *local_addresses]), port, filename])
         print(server_config)
 
-        file_hash = get_file_hash(file_path)
-
-        # Generating server key
-        server_key = "{}:{}:{}:{}".format(key_ip, port, filename, file_hash)
-        success(lang.get_string("server.info.serverKey").format(server_key))
-
-        os.makedirs("generated_zapfiles", exist_ok=True)
-        with open(
-            Path("generated_zapfiles") / f"{filename}.zapfile", "w", encoding="utf-8"
-        ) as f:
-            zapfile = {
-                "host": key_ip,
-                "port": port,
-                "filename": filename,
-                "hash": file_hash,
-            }
-            f.write(json.dumps(zapfile, indent=4, ensure_ascii=False))
+        # Indexing shared files
+        info(lang.get_string("server.info.indexingFiles"))
+        catalog = FileCatalog(
+            [file_path],
+            config.get_value("hash_algorithm"),
+            config.get_value("hash_mode"),
+        )
+        await asyncio.get_running_loop().run_in_executor(None, catalog.scan)
+        if not catalog.entries:
+            err(lang.get_string("server.error.noFiles"))
+            return
+
+        # Starting server
+        server_args = partial(
+            handle_client, catalog=catalog, admission=get_admission_control()
+        )
+        host = await listen(server_args, port)
+
+        # Generating server keys, shared directories also get one of their own
+        shared = [(entry.path.name, entry.file_hash) for entry in catalog.entries]
+        shared += [
+            (directory.path.name, directory.file_hash)
+            for directory in catalog.directories
+        ]
+        # Other addresses come first in keys, the main one stays last
+        key_host = ",".join([*local_addresses, key_ip])
+        for name, file_hash in shared:
+            server_key = "{}:{}:{}:{}".format(key_host, port, name, file_hash)
+            success(lang.get_string("server.info.serverKey").format(server_key))
             success(
                 lang.get_string("server.info.createdZapfile").format(
-                    filename + ".zapfile"
+                    write_zapfile(key_ip, port, name, file_hash, local_addresses)
                 )
             )
 
+        if config.get_value("ciphertext_cache"):
+            info(lang.get_string("server.info.encryptingFile"))
+            for entry in catalog.entries:
+                await ciphertext_cache.get(entry.path)
+
+        # Picking up added and changed files in the background
+        refresh_task = asyncio.create_task(
+            catalog.refresh_periodically(config.get_value("catalog_refresh_interval"))
+        )
+
         async with host:
             info(lang.get_string("server.info.running"))
-            await host.serve_forever()
+            try:
+                await host.serve_forever()
+            finally:
+                refresh_task.cancel()
     except EOFError:
         return
 
 
+async def stream_server(
+    source: str, name: str, port: int, key_ip: Optional[str] = None
+) -> bool:
+    """
+    Shares data from stdin or a named pipe without asking anything, e.g. a dump
+    piped into ZapFiles. Stops once the first client got it.
+
+    Args:
+        source (str): path to a named pipe or file, "-" for stdin
+        name (str): name clients save the stream under
+        port (int): port of server
+        key_ip (str, optional): IP address for server keys, public IP if None
+
+    Returns:
+        bool: True if the whole stream was sent
+    """
+    key_ip = key_ip or get_public_ip()
+    if not key_ip:
+        err(lang.get_string("server.error.invalidIp"))
+        return False
+
+    local_addresses = []
+    if config.get_value("advertise_local_addresses"):
+        local_addresses = [
+            address for address in get_local_addresses() if address != key_ip
+        ]
+
+    # Opening a named pipe waits for its writer
+    source_file = (
+        sys.stdin.buffer
+        if source == "-"
+        else await asyncio.get_running_loop().run_in_executor(
+            None, partial(open, source, "rb")
+        )
+    )
+    stream = SharedStream(source_file, name, config.get_value("hash_algorithm"))
+
+    server_args = partial(
+        handle_client,
+        catalog=FileCatalog([]),
+        stream=stream,
+        admission=get_admission_control(),
+    )
+    host = await listen(server_args, port)
+
+    key_host = ",".join([*local_addresses, key_ip])
+    server_key = "{}:{}:{}:{}".format(key_host, port, name, stream.stream_id)
+    success(lang.get_string("server.info.serverKey").format(server_key))
+    success(
+        lang.get_string("server.info.createdZapfile").format(
+            write_zapfile(key_ip, port, name, stream.stream_id, local_addresses)
+        )
+    )
+
+    try:
+        async with host:
+            info(lang.get_string("server.info.waitingForClient"))
+            await stream.done.wait()
+    finally:
+        if source_file is not sys.stdin.buffer:
+            source_file.close()
+
+    return stream.sent
+
+
 if __name__ == "__main__":
-    asyncio.run(server())
+    run(server(), config.get_value("use_uvloop"))
     input(lang.get_string("main.enterToExit"))